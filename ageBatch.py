@@ -0,0 +1,73 @@
+""" Offline age re-annotation: stream one text column of a CSV/JSON file (e.g.
+    characteristics or protocol strings collected by metadataExtract) through
+    numericTimeConvertBatch on all cores, and write the file back out with
+    age, duration and flag columns appended. Input is read and written in
+    chunks, so file size is not limited by memory.
+
+    Usage:
+        python ageBatch.py input.csv output.csv --column characteristics
+            --convertTo week --chunkSize 50000 --processes 8
+"""
+
+import argparse, os, sys
+import pandas as pd
+from multiprocessing import Pool
+sys.path.append('./src')
+import setup_metadataExtract as util
+
+
+def readChunks(inPath, chunkSize):
+    """ DataFrame chunks of a .csv, .json (records) or .jsonl file """
+
+    if inPath.endswith('.jsonl'):
+        return pd.read_json(inPath, lines = True, chunksize = chunkSize)
+    elif inPath.endswith('.json'):
+        frame = pd.read_json(inPath)
+        return (frame.iloc[i:i + chunkSize] for i in range(0, len(frame),
+            chunkSize))
+    return pd.read_csv(inPath, chunksize = chunkSize)
+
+
+def convertChunk(args):
+    texts, convertTo = args
+    return util.numericTimeConvertBatch(texts, convertTo = convertTo)
+
+
+def ageBatch(inPath, outPath, column, convertTo = 'week', chunkSize = 50000,
+    processes = os.cpu_count()):
+    """ Annotate column of inPath with ages and write the result to outPath
+        (CSV). Chunks are handed to the pool a few at a time, so only
+        ~2 * processes chunks are held in memory at once.
+    """
+    chunks = readChunks(inPath, chunkSize)
+    header = True
+    with Pool(processes) as pool:
+        while True:
+            wave = [chunk for _, chunk in zip(range(2 * processes), chunks)]
+            if len(wave) == 0:
+                break
+            results = pool.map(convertChunk, [(chunk[column].tolist(),
+                convertTo) for chunk in wave])
+            for chunk, (ages, durs, flags) in zip(wave, results):
+                chunk = chunk.copy()
+                chunk['age_{0}'.format(convertTo)] = ages
+                chunk['duration_{0}'.format(convertTo)] = durs
+                chunk['age_flagged'] = flags
+                chunk.to_csv(outPath, mode = 'w' if header else 'a',
+                    header = header, index = False)
+                header = False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Batch age extraction over '
+        'a text column of a CSV/JSON file')
+    parser.add_argument('inPath')
+    parser.add_argument('outPath')
+    parser.add_argument('--column', required = True)
+    parser.add_argument('--convertTo', default = 'week')
+    parser.add_argument('--chunkSize', type = int, default = 50000)
+    parser.add_argument('--processes', type = int, default = os.cpu_count())
+    args = parser.parse_args()
+
+    ageBatch(args.inPath, args.outPath, args.column, convertTo = args.convertTo,
+        chunkSize = args.chunkSize, processes = args.processes)
@@ -0,0 +1,228 @@
+""" Offline, per-stage benchmarks of the extraction pipelines, run over the
+    checked-in pages in tests/fixtures (GSM/GSE HTML, MINiML XML, GDS
+    E-fetch text, PubMed E-fetch XML, PubMed and full-text HTML). Fixture
+    pages are served from a temporary response cache under their recorded
+    URLs (tests/fixtures/recordings.json, shared with tests/ncbiStandIn.py),
+    and any request that misses it fails instead of reaching the network, so
+    runs are reproducible and independent of NCBI.
+
+    Each stage is timed on its own over repeat rounds (one round is a pass
+    over the stage's fixtures), and the round timings are written as JSON.
+    With --compare, results are checked against a stored baseline (an
+    earlier results file) and the run fails if a stage's median regressed by
+    more than --threshold.
+
+    Usage:
+        python benchmarks/runBenchmarks.py --out benchmarks/results.json
+        python benchmarks/runBenchmarks.py --compare benchmarks/baseline.json
+            --threshold 0.25
+        python benchmarks/runBenchmarks.py --stages geoAgeExtract
+            --profile metadataSpeed.prof
+"""
+
+import argparse, contextlib, copy, cProfile, datetime, io, json, os, platform
+import statistics, sys, tarfile, tempfile, time
+import requests
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.dirname(benchDir)
+fixtureDir = os.path.join(repoDir, 'tests', 'fixtures')
+sys.path.append(os.path.join(repoDir, 'src'))
+sys.path.insert(0, os.path.join(repoDir, 'gds_scraper_mt'))
+
+import geoFetch
+import setup_metadataExtract as util
+from src.geo_parser import geo_txt_parse, split_efetch_records
+from src.ftp_gzxml_parser import xml_parser
+from src.processing_data import final_processing_loop
+
+seriesFTP = ('ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE16nnn/GSE16012/miniml/'
+    'GSE16012_family.xml.tgz')
+
+
+class OfflineAdapter(requests.adapters.BaseAdapter):
+    """ Fails every request, so that a page missing from the fixtures shows up
+        as an error rather than as a (slow, variable) live fetch """
+
+    def send(self, request, **kwargs):
+        raise requests.exceptions.ConnectionError('Benchmarks run offline, {0} '
+            'is not in tests/fixtures'.format(request.url))
+
+    def close(self):
+        pass
+
+
+def readFixture(name, mode = 'r'):
+    with open(os.path.join(fixtureDir, name), mode) as fin:
+        return fin.read()
+
+
+def seedCache(cacheDir):
+    """ Point geoFetch at an empty cache in cacheDir holding only the recorded
+        pages of tests/fixtures/recordings.json, and cut it off from the
+        network """
+
+    geoFetch.configureCache(path = os.path.join(cacheDir, 'benchCache.sqlite'))
+    recordings = json.loads(readFixture('recordings.json'))
+    for url, entry in recordings.items():
+        if not entry.get('tgzMember'):
+            geoFetch.storeContent(url, readFixture(entry['file'], 'rb'),
+                encoding = 'utf-8')
+    geoFetch.maxRetries = 0
+    geoFetch.session.mount('https://', OfflineAdapter())
+    geoFetch.session.mount('http://', OfflineAdapter())
+
+
+def seriesArchive():
+    """ GSE16012_family.xml packed as the .tgz served on the GEO FTP site """
+
+    xml = readFixture('GSE16012_family.xml', 'rb')
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj = buffer, mode = 'w:gz') as tar:
+        member = tarfile.TarInfo('GSE16012_family.xml')
+        member.size = len(xml)
+        tar.addfile(member, io.BytesIO(xml))
+    return buffer.getvalue()
+
+
+def stages():
+    """ {stage name: (function, prepare)}. prepare() returns the list of
+        (args, kwargs) calls making up one round of the stage; it runs
+        outside of the timed region, so stages that mutate their input get a
+        fresh copy every round. """
+
+    ageStrings = readFixture('ageStrings.txt').splitlines()
+    samplePages = [readFixture(x) for x in ['GSM401234.html', 'GSM401240.html',
+        'GSM401250.html']]
+    efetch = readFixture('efetch_GSE16012.txt')
+    sampleIDs = ['GSM40123{0}'.format(i) for i in range(4, 10)]
+    sampleDocs = split_efetch_records(efetch, sampleIDs)
+    archive = seriesArchive()
+    fullText = readFixture('PMC2700001.html').lower()
+
+    textFileDict = geo_txt_parse([[sampleDocs[x].encode(), x] for x in
+        sampleIDs])
+    seriesPmidDict, samplesDict = xml_parser(url = seriesFTP,
+        sample_list = sampleIDs, content = archive)
+
+    def ageRound():
+        # Every round starts without memoized GSE pages, as a new run would
+        util.gseTextMemo.clear()
+        return [((page,), {}) for page in samplePages]
+
+    return {
+        'numericTimeConvert': (util.numericTimeConvert, lambda: [((text,),
+            {'convertTo': 'week'}) for text in ageStrings]),
+        'geoAgeExtract': (util.geoAgeExtract, ageRound),
+        'geo_txt_parse': (geo_txt_parse, lambda: [(([[sampleDocs[x].encode(),
+            x] for x in sampleIDs],), {})]),
+        'xml_parser': (xml_parser, lambda: [((), {'url': seriesFTP,
+            'sample_list': sampleIDs, 'content': archive})]),
+        'final_processing_loop': (final_processing_loop, lambda: [((
+            copy.deepcopy(textFileDict), samplesDict, seriesPmidDict, False,
+            False, False), {'progress': False})]),
+        'findSectionText': (util.findSectionText, lambda: [((fullText,
+            ['methods', 'procedures'], 'h2'), {})])}
+
+
+def timeStage(fn, prepare, repeat):
+    """ Seconds taken by each of repeat rounds of fn calls. The stages'
+        progress messages and warnings are discarded. """
+
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            roundTime = 0
+            for args, kwargs in prepare():
+                start = time.perf_counter()
+                fn(*args, **kwargs)
+                roundTime += time.perf_counter() - start
+            timings.append(roundTime)
+    return timings
+
+
+def runBenchmarks(stageNames = None, repeat = 20, profilePath = None):
+    """ Time each stage and return the results dict written to JSON """
+
+    allStages = stages()
+    stageNames = stageNames or list(allStages)
+    unknown = [x for x in stageNames if x not in allStages]
+    if len(unknown) > 0:
+        raise ValueError('Unknown stages {0}. Try one of {1}'.format(unknown,
+            list(allStages)))
+
+    profiler = cProfile.Profile() if profilePath is not None else None
+    results = {'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'python': platform.python_version(), 'platform': platform.platform(),
+        'repeat': repeat, 'stages': dict()}
+    for name in stageNames:
+        fn, prepare = allStages[name]
+        # Warm-up round: imports, regex compilation, first cache reads
+        timeStage(fn, prepare, 1)
+        if profiler is not None:
+            profiler.enable()
+        timings = timeStage(fn, prepare, repeat)
+        if profiler is not None:
+            profiler.disable()
+        results['stages'][name] = {'callsPerRound': len(prepare()),
+            'rounds': timings, 'median': statistics.median(timings), 'mean': statistics.mean(timings),
+            'min': min(timings), 'max': max(timings)}
+
+    if profiler is not None:
+        profiler.dump_stats(profilePath)
+    return results
+
+
+def compareResults(results, baseline, threshold = 0.25):
+    """ Print the median of each stage against the baseline. Return the stages
+        whose median grew by more than threshold (a fraction) """
+
+    regressions = []
+    print('{0:<24}{1:>14}{2:>14}{3:>10}'.format('stage', 'baseline (ms)',
+        'current (ms)', 'change'))
+    for name, current in results['stages'].items():
+        if name not in baseline['stages']:
+            print('{0:<24}{1:>14}{2:>14.3f}'.format(name, '-',
+                current['median'] * 1000))
+            continue
+        before = baseline['stages'][name]['median']
+        change = current['median'] / before - 1
+        print('{0:<24}{1:>14.3f}{2:>14.3f}{3:>+10.1%}'.format(name, before * 1000,
+            current['median'] * 1000, change))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Offline per-stage '
+        'benchmarks over tests/fixtures')
+    parser.add_argument('--stages', nargs = '+', default = None)
+    parser.add_argument('--repeat', type = int, default = 20)
+    parser.add_argument('--out', default = os.path.join(benchDir,
+        'results.json'))
+    parser.add_argument('--compare', default = None,
+        help = 'Baseline results JSON to check against')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+        help = 'Allowed fractional slow-down of a stage median')
+    parser.add_argument('--profile', default = None,
+        help = 'Also write cProfile stats of the timed rounds here')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cacheDir:
+        seedCache(cacheDir)
+        results = runBenchmarks(stageNames = args.stages, repeat = args.repeat,
+            profilePath = args.profile)
+
+    with open(args.out, 'w') as fout:
+        json.dump(results, fout, indent = 4)
+    print('Wrote {0}'.format(args.out))
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fin:
+            baseline = json.load(fin)
+        regressions = compareResults(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print('Regressed past {0:.0%}: {1}'.format(args.threshold,
+                regressions))
+            sys.exit(1)
@@ -3,15 +3,19 @@ from lxml import etree, objectify
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
-import tarfile, os, urllib, gzip, re
+import tarfile, os, urllib, gzip, re, http.client
 from src.geo_extraction_funcs import *
 
-def xml_parser(url = "", filename = "", sample_list = [], parse_platforms = False, DEBUG = 0, multichannel = False, keep_files = [None]):
+@runMetrics.timed('xml_parser')
+def xml_parser(url = "", filename = "", sample_list = [], parse_platforms = False, DEBUG = 0, multichannel = False, keep_files = [None], content = None):
     """
     This function will take in the URL for a Series FTP .tgz file, download the file, extract the .xml file from the compressed directory and then parse the .xml.
+    Unless 'xml' is in `keep_files`, the .tgz is read as a stream and the .xml member is parsed as it downloads, without writing either to disk.
 
     Try: except lxml.etree.XMLSyntaxError as e: section is to prevent illegal XML characters from breaking the script. Ideally, we'd replace all illegal characters before parsing but I couldn't find good code to do that.
 
+    The .xml is streamed by `iter_miniml()` rather than loaded whole, so memory stays flat for series with thousands of samples.
+
     First the ./Series tags are looped through and the corresponding pubmed ID is taken from each series.
 
     Then the ./Samples tags are looped through and all relevant information is captured for each sample.
@@ -24,6 +28,7 @@ def xml_parser(url = "", filename = "", sample_list = [], parse_platforms = Fals
             `DEBUG` - Int: Sets depth of debug messages. Mostly deprecated.
             `multichannel` - Bool: If set to False, multichannel files will be filtered out of the final result.
             `keep_files` - List: File types to keep during a full run. If 'xml' is in `keep_files` then the xml file won't be deleted.
+            `content` - Bytes: The .tgz at `url`, already downloaded with `tar_gz_download()`, or Str: the file it was downloaded to. Ignored if 'xml' is in `keep_files`.
 
         Returns:
             `series_pmid_dict` - Dict: Mappings from Series Accession numbers to PMIDs
@@ -58,7 +63,18 @@ def xml_parser(url = "", filename = "", sample_list = [], parse_platforms = Fals
         print(f'Parsing: {url}')
     if parse_platforms == False and re.search('.*GPL.*', url):
         print(f'{url} is to a platform and platform flag is off.')
-        return dict()
+        return {}, {}
+
+    ### Without 'xml' in `keep_files` the XML member is parsed straight off the download stream, nothing touches the disk
+    if filename == "" and 'xml' not in keep_files:
+        try:
+            with tar_gz_xml_stream(url, content = content) as xml_stream:
+                if xml_stream is None:
+                    return {}, {}
+                return parse_miniml(xml_stream, sample_list = sample_list, multichannel = multichannel)
+        except (http.client.IncompleteRead, EOFError, tarfile.ReadError) as e:
+            print(f'URL too short: {url}')
+            return {}, {}
 
     ### Files are gzipped so open the url then extract only the XML file from the tar file
     if filename == "":
@@ -70,178 +86,209 @@ def xml_parser(url = "", filename = "", sample_list = [], parse_platforms = Fals
     if xml_filename is None:
         return {}, {}
 
-    parser = etree.XMLParser(recover=True, encoding="utf-8")
     try:
-        tree_ab = ET.parse(f'output/xml/{xml_filename}', parser=parser)
+        return parse_miniml(f'output/xml/{xml_filename}', sample_list = sample_list, multichannel = multichannel)
+    finally:
+        if 'xml' not in keep_files:
+            os.unlink('output/xml/' + xml_filename)
+
+
+def parse_miniml(xml_source, sample_list = [], multichannel = False):
+    """
+    Parse the Series block and the samples of `sample_list` out of a MINiML `*_family.xml`. See `xml_parser()` for the returned dicts.
+        Args:
+            `xml_source` - Str/file: Location of the XML file, or a binary file-like object streaming it
+            `sample_list` - List: Samples to keep
+            `multichannel` - Bool: If set to False, multichannel samples get a blank data dict.
+    """
+    sample_set = set(sample_list)
+    series_pmid_dict = {}
+    samples_dict = {}
+    try:
+        for samples in iter_miniml(xml_source, sample_set, series_pmid_dict):
+            sample_id = samples.attrib['iid']
+            channel_num = np.max([int(i.text) for i in samples.findall('./Channel-Count')])
+            if multichannel == False:
+                if int(channel_num) > 1:
+                    #print('Multichannel set to false, returning blank meta-data for multichannel sample')
+                    sample_dict = {'sample_id' : sample_id,
+                                    'sample_source' : '',
+                                    'sample_title' : '',
+                                    'molecule' : '',
+                                    'organism' : '',
+                                    'treatment_protocol' : '',
+                                    'extract_protocol' : '',
+                                    'growth_protocol' : '',
+                                    'description' : 'multi',
+                                    'sample_cell_type' : '',
+                                    'sample_type' : '',
+                                    'sample_sex' : '',
+                                    'sample_tissue' : '',
+                                    'sample_age' : '',
+                                    'sample_indication' : '',
+                                    'sample_genotype' : '',
+                                    'sample_cell_line' : '',
+                                    'expression' : '',
+                                    'cells' : '',
+                                    'age_func' : ''
+                                    }
+                    samples_dict[sample_id] = sample_dict
+
+                    #sample_row_list.append(sample_dict)
+                    continue
+            sample_source = ''
+            organism = ''
+            sample_title = ''
+            molecule = ''
+            sample_indication = ''
+            treatment_protocol = ''
+            sample_description = ''
+            extract_protocol = ''
+            growth_protocol = ''
+            sample_type = ''
+            sample_cell_line = ''
+            sample_cell_type = ''
+            sample_sex = ''
+            sample_tissue = ''
+            sample_age = ''
+            sample_genotype = ''
+
+            ### Loop through elements of the sample
+            for sample_element in samples:
+                ### Potentially more than one channel?
+                ### Adding this for later but not used yet
+                channel_count = 1
+                if sample_element.tag == 'Title':
+                    sample_title = sample_element.text
+
+                elif sample_element.tag == 'Accession':
+                    accession_number = sample_element.text
+                    accession_db = sample_element.attrib['database']
+
+                elif sample_element.tag == 'Channel-Count':
+                    channel_count = sample_element.text
+
+                elif sample_element.tag == 'Description':
+                    sample_description = sample_element.text.strip()
+                elif sample_element.tag == 'Channel':
+                    channel_num = sample_element.attrib['position']
+                    for channel_value in sample_element:
+                        if channel_value.tag == 'Source':
+                            sample_source = channel_value.text
+
+                        if channel_value.tag == 'Treatment-Protocol':
+                            treatment_protocol = channel_value.text.strip()
+
+                        if channel_value.tag == 'Molecule':
+                            molecule = channel_value.text.strip()
+
+                        if channel_value.tag == 'Organism':
+                            organism = channel_value.text.strip()
+
+                        if channel_value.tag == 'Extract-Protocol':
+                            extract_protocol = channel_value.text.strip()
+
+                        if channel_value.tag == 'Growth-Protocol':
+                            growth_protocol = channel_value.text.strip()
+
+                    for char_value in sample_element.findall('./Characteristics'):
+                        try:
+                            if char_value.attrib['tag'].lower() == 'cell type':
+                                sample_cell_type = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'cell line':
+                                sample_cell_line = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'sample type':
+                                sample_type = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'sex':
+                                sample_sex = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'tissue':
+                                sample_tissue = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'age':
+                                sample_age = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'indication':
+                                sample_indication = char_value.text.strip()
+                            if char_value.attrib['tag'].lower() == 'genotype':
+                                sample_genotype = char_value.text.strip()
+                        except Exception as e:
+                            pass
+
+            if ('RNA' in sample_source) or ('RNA' in molecule):
+                expression = True
+            else:
+                expression = False
+
+
+
+            sample_dict = {'sample_id' : sample_id,
+                            'sample_source' : sample_source,
+                            'sample_title' : sample_title,
+                            'molecule' : molecule,
+                            'organism' : organism,
+                            'treatment_protocol' : treatment_protocol,
+                            'extract_protocol' : extract_protocol,
+                            'growth_protocol' : growth_protocol,
+                            'description' : sample_description,
+                            'sample_cell_type' : sample_cell_type,
+                            'sample_type' : sample_type,
+                            'sample_sex' : sample_sex,
+                            'sample_tissue' : sample_tissue,
+                            'sample_age' : sample_age,
+                            'sample_indication' : sample_indication,
+                            'sample_genotype' : sample_genotype,
+                            'sample_cell_line' : sample_cell_line,
+                            'expression' : expression,
+                            'age_func' : ''
+                            }
+            samples_dict[sample_id] = sample_dict
+
     except etree.XMLSyntaxError as e:
         print(e)
         return {}, {}
 
-    root = tree_ab.getroot()
+    return series_pmid_dict, samples_dict
 
-    if 'xml' not in keep_files:
-        os.unlink('output/xml/' + xml_filename)
 
-    #### I stole this code from the internet but it will replace the prefix that gets added
-    #### There's probably a better way to do this
-    for elem in root.getiterator():
-        if not hasattr(elem.tag, 'find'): continue
-        i = elem.tag.find('}')
+def strip_namespace(elem):
+    """
+    Drop the MINiML namespace prefix from the tags of `elem` and its children, in place.
+    """
+    for child in elem.iter():
+        if not hasattr(child.tag, 'find'): continue
+        i = child.tag.find('}')
         if i >= 0:
-            elem.tag = elem.tag[i+1:]
-    ####
+            child.tag = child.tag[i+1:]
 
-    pmids, series_acc_numbers, series_summary = [], [], []
-    series_overalldesign, series_zip = [], []
-    for series in root.findall('./Series'):
-        pmids += [i.text for i in series.findall('./Pubmed-ID')]
-        series_acc_numbers += [i.text for i in series.findall('./Accession')]
-        series_summary += [i.text.strip() for i in series.findall('./Summary')]
-        series_overalldesign += [i.text.strip() for i in series.findall('./Overall-Design')]
-        series_zip += list(zip(series_acc_numbers, pmids, series_summary, series_overalldesign))
-
-    series_pmid_dict = {key: {'pmid':pmid, 'series_summary': series_summary, 'series_design':series_design} for (key, pmid, series_summary, series_design) in series_zip}
 
+def iter_miniml(xml_source, sample_set, series_pmid_dict):
+    """
+    Stream a MINiML `*_family.xml` file and yield only the requested samples.
 
-    sample_row_list = []
-    samples_dict = {}
-    series_pubmed_id_dict = {}
-    for samples in root.findall('./Sample'):
-        sample_id = samples.attrib['iid']
-        if sample_id not in sample_list:
-            continue
-        channel_num = np.max([int(i.text) for i in samples.findall('./Channel-Count')])
-        if multichannel == False:
-            if int(channel_num) > 1:
-                #print('Multichannel set to false, returning blank meta-data for multichannel sample')
-                sample_dict = {'sample_id' : sample_id,
-                                'sample_source' : '',
-                                'sample_title' : '',
-                                'molecule' : '',
-                                'organism' : '',
-                                'treatment_protocol' : '',
-                                'extract_protocol' : '',
-                                'growth_protocol' : '',
-                                'description' : 'multi',
-                                'sample_cell_type' : '',
-                                'sample_type' : '',
-                                'sample_sex' : '',
-                                'sample_tissue' : '',
-                                'sample_age' : '',
-                                'sample_indication' : '',
-                                'sample_genotype' : '',
-                                'sample_cell_line' : '',
-                                'expression' : '',
-                                'cells' : '',
-                                'age_func' : ''
-                                }
-                samples_dict[sample_id] = sample_dict
-
-                #sample_row_list.append(sample_dict)
-                continue
-        sample_source = ''
-        organism = ''
-        sample_title = ''
-        molecule = ''
-        sample_indication = ''
-        treatment_protocol = ''
-        sample_description = ''
-        extract_protocol = ''
-        growth_protocol = ''
-        sample_type = ''
-        sample_cell_line = ''
-        sample_cell_type = ''
-        sample_sex = ''
-        sample_tissue = ''
-        sample_age = ''
-        sample_genotype = ''
-
-        ### Loop through elements of the sample
-        for sample_element in samples:
-            ### Potentially more than one channel?
-            ### Adding this for later but not used yet
-            channel_count = 1
-            if sample_element.tag == 'Title':
-                sample_title = sample_element.text
-
-            elif sample_element.tag == 'Accession':
-                accession_number = sample_element.text
-                accession_db = sample_element.attrib['database']
-
-            elif sample_element.tag == 'Channel-Count':
-                channel_count = sample_element.text
-
-            elif sample_element.tag == 'Description':
-                sample_description = sample_element.text.strip()
-            elif sample_element.tag == 'Channel':
-                channel_num = sample_element.attrib['position']
-                for channel_value in sample_element:
-                    if channel_value.tag == 'Source':
-                        sample_source = channel_value.text
-
-                    if channel_value.tag == 'Treatment-Protocol':
-                        treatment_protocol = channel_value.text.strip()
-
-                    if channel_value.tag == 'Molecule':
-                        molecule = channel_value.text.strip()
-
-                    if channel_value.tag == 'Organism':
-                        organism = channel_value.text.strip()
-
-                    if channel_value.tag == 'Extract-Protocol':
-                        extract_protocol = channel_value.text.strip()
-
-                    if channel_value.tag == 'Growth-Protocol':
-                        growth_protocol = channel_value.text.strip()
-
-                for char_value in sample_element.findall('./Characteristics'):
-                    try:
-                        if char_value.attrib['tag'].lower() == 'cell type':
-                            sample_cell_type = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'cell line':
-                            sample_cell_line = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'sample type':
-                            sample_type = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'sex':
-                            sample_sex = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'tissue':
-                            sample_tissue = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'age':
-                            sample_age = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'indication':
-                            sample_indication = char_value.text.strip()
-                        if char_value.attrib['tag'].lower() == 'genotype':
-                            sample_genotype = char_value.text.strip()
-                    except Exception as e:
-                        pass
-
-        if ('RNA' in sample_source) or ('RNA' in molecule):
-            expression = True
-        else:
-            expression = False
-
-
-
-        sample_dict = {'sample_id' : sample_id,
-                        'sample_source' : sample_source,
-                        'sample_title' : sample_title,
-                        'molecule' : molecule,
-                        'organism' : organism,
-                        'treatment_protocol' : treatment_protocol,
-                        'extract_protocol' : extract_protocol,
-                        'growth_protocol' : growth_protocol,
-                        'description' : sample_description,
-                        'sample_cell_type' : sample_cell_type,
-                        'sample_type' : sample_type,
-                        'sample_sex' : sample_sex,
-                        'sample_tissue' : sample_tissue,
-                        'sample_age' : sample_age,
-                        'sample_indication' : sample_indication,
-                        'sample_genotype' : sample_genotype,
-                        'sample_cell_line' : sample_cell_line,
-                        'expression' : expression,
-                        'age_func' : ''
-                        }
-        samples_dict[sample_id] = sample_dict
+    Uses `lxml.etree.iterparse` so the file is never held in memory as a whole. Only `Series` and `Sample` elements are built into records; every other element is discarded as soon as it closes and parsed elements are cleared (and unlinked from the root) once used, so peak memory is roughly one sample no matter how large the series is.
+    Series records are written into `series_pmid_dict` as they're seen, one record per Series block.
+        Args:
+            `xml_source` - Str/file: Location of the XML file, or a binary file-like object
+            `sample_set` - Set: Sample IDs to keep
+            `series_pmid_dict` - Dict: Filled with {Series accession : {'pmid', 'series_summary', 'series_design'}}
 
-    return series_pmid_dict, samples_dict
+        Yields:
+            `samples` - Element: Namespace-stripped Sample element. Only valid until the next one is yielded.
+    """
+    context = etree.iterparse(xml_source, events=('end',), tag=('{*}Series', '{*}Sample'), recover=True, encoding='utf-8', huge_tree=True)
+    for _, elem in context:
+        if etree.QName(elem).localname == 'Series':
+            strip_namespace(elem)
+            pmids = [i.text for i in elem.findall('./Pubmed-ID')]
+            series_acc_numbers = [i.text for i in elem.findall('./Accession')]
+            series_summary = [i.text.strip() for i in elem.findall('./Summary')]
+            series_overalldesign = [i.text.strip() for i in elem.findall('./Overall-Design')]
+            for (key, pmid, summary, design) in zip(series_acc_numbers, pmids, series_summary, series_overalldesign):
+                series_pmid_dict[key] = {'pmid':pmid, 'series_summary': summary, 'series_design':design}
+
+        elif elem.get('iid') in sample_set:
+            strip_namespace(elem)
+            yield elem
+
+        ### Free the element and everything parsed before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
@@ -1,45 +1,16 @@
 import numpy as np
-import tarfile, os, urllib, gzip, re, time, requests
+import tarfile, os, sys, urllib, gzip, re, time, requests, contextlib, io, shutil
+import urllib.request, http.client
 import xml.etree.ElementTree as ET
 from bs4 import BeautifulSoup
 
-defaultAgent = {'User-Agent': 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'}
+### Fetching/caching utilities and age parsing (ageEngine) are shared with the
+### top-level metadataExtract pipeline, and live in the repository's top-level
+### src/ directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+import geoFetch, sectionSoup, keywordMatch, runMetrics, geneAlias, ageEngine
 
-numberDict = {
-    'zero': 0,
-    'one': 1,
-    'two': 2,
-    'three': 3,
-    'four': 4,
-    'five': 5,
-    'six': 6,
-    'seven': 7,
-    'eight': 8,
-    'nine': 9,
-    'ten': 10,
-    'eleven': 11,
-    'twelve': 12,
-    'thirteen': 13,
-    'fourteen': 14,
-    'fifteen': 15,
-    'sixteen': 16,
-    'seventeen': 17,
-    'eighteen': 18,
-    'nineteen': 19,
-    'twenty': 20,
-    'thirty': 30,
-    'forty': 40,
-    'fifty': 50,
-    'sixty': 60,
-    'seventy': 70,
-    'eighty': 80,
-    'ninety': 90,
-    'hundred': 100,
-    'thousand': 1000,
-    'million': 1000000,
-    'billion': 1000000000,
-    'point': '.'
-}
+defaultAgent = {'User-Agent': 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'}
 
 
 def tar_gz_extracter(url):
@@ -56,7 +27,7 @@ def tar_gz_extracter(url):
     """
 
     try:
-        f_url = urllib.request.urlretrieve(url, filename=None)[0]
+        f_url = urllib.request.urlretrieve(geoFetch.rewriteURL(url), filename=None)[0]
     except urllib.error.ContentTooShortError as e:
         print(f'URL too short: {url}')
         return None
@@ -65,13 +36,13 @@ def tar_gz_extracter(url):
         print(f'{url} failed with the above error. Waiting 60 seconds and retrying')
         time.sleep(61)
         try:
-            f_url = urllib.request.urlretrieve(url, filename=None)[0]
+            f_url = urllib.request.urlretrieve(geoFetch.rewriteURL(url), filename=None)[0]
         except urllib.error.URLError as e:
             print(e)
             print(f'{url} failed with the above error. Waiting 5 minutes and retrying')
             time.sleep(int(61*5))
             try:
-                f_url = urllib.request.urlretrieve(url, filename=None)[0]
+                f_url = urllib.request.urlretrieve(geoFetch.rewriteURL(url), filename=None)[0]
             except urllib.error.URLError as e:
                 print(e)
                 print(f'tgz extraction failed on {url} after waiting.')
@@ -94,12 +65,117 @@ def tar_gz_extracter(url):
     return xml_name
 
 
+def open_url_retrying(url):
+    """
+    `urllib.request.urlopen(url)` retried after 1 and then 5 minutes on connection errors, as in `tar_gz_extracter()`. Returns None if every attempt failed.
+    Like every request, it goes to the `NCBI_BASE_URL` server instead when one is set (see `geoFetch.rewriteURL()`).
+    """
+    host = runMetrics.hostOf(url)
+    for wait in [61, int(61*5), None]:
+        try:
+            return urllib.request.urlopen(geoFetch.rewriteURL(url))
+        except urllib.error.URLError as e:
+            runMetrics.warn('urlError', f'{url} failed: {e}')
+            runMetrics.count('http_requests_total', host = host, status = type(e).__name__)
+            if wait is None:
+                print(f'tgz extraction failed on {url} after waiting.')
+                return None
+            print(f'{url} failed with {type(e).__name__}. Waiting {wait} seconds and retrying')
+            runMetrics.count('http_retries_total', host = host, reason = type(e).__name__)
+            time.sleep(wait)
+
+
+@runMetrics.timed('tar_gz_download')
+def tar_gz_download(url, path = None):
+    """
+    Download a series FTP .tgz into memory, or into the file at `path`, copied over in chunks so the archive is never held whole. Returns the bytes (or `path`), or None if the download failed or was cut short (the `ContentTooShortError` case of `tar_gz_extracter()`).
+    Counted in the run metrics like `geoFetch` requests, under the FTP host.
+    """
+    host = runMetrics.hostOf(url)
+    start = time.perf_counter()
+    response = open_url_retrying(url)
+    if response is None:
+        return None
+    try:
+        if path is None:
+            content = response.read()
+            size = len(content)
+        else:
+            ### Chunked reads come back short instead of raising on a cut-off body
+            with open(path, 'wb') as fout:
+                shutil.copyfileobj(response, fout)
+                size = fout.tell()
+            content = path
+            expected = response.headers.get('Content-Length')
+            if (expected is not None) and (size < int(expected)):
+                raise http.client.IncompleteRead(b'', int(expected) - size)
+    except http.client.IncompleteRead as e:
+        runMetrics.count('http_requests_total', host = host, status = 'IncompleteRead')
+        runMetrics.warn('truncatedDownload', f'URL too short: {url}')
+        if (path is not None) and os.path.exists(path):
+            os.remove(path)
+        return None
+    finally:
+        response.close()
+        runMetrics.observe('http_request_seconds', time.perf_counter() - start, host = host)
+    runMetrics.count('http_requests_total', host = host, status = getattr(response, 'status', 200))
+    runMetrics.count('http_response_bytes_total', size, host = host)
+    return content
 
+
+@contextlib.contextmanager
+def tar_gz_xml_stream(url, content = None):
+    """
+    Stream the .xml member of a series FTP .tgz without writing anything to disk. Used as a context manager:
+
+        with tar_gz_xml_stream(url) as xml_stream:
+            ...
+
+    The download is read as a gzip stream and walked member by member (`tarfile` mode 'r|gz'). The first .xml member is handed out as a file-like object to be parsed while it downloads, and the connection is closed as soon as the block exits, so nothing after that member is read.
+    Connection errors are retried with the same waits as `tar_gz_extracter()`.
+
+        Args:
+            `url` - Str: Series FTP URL leading to a .tgz file
+            `content` - Bytes: The .tgz already downloaded by `tar_gz_download()`, or Str: the file it was downloaded to. url is then not fetched
+
+        Yields:
+            `xml_stream` - file: Binary stream of the .xml member, None if the download failed or there isn't one.
+    """
+    base_name = os.path.basename(url)
+    if isinstance(content, str):
+        response = open(content, 'rb')
+    elif content is not None:
+        response = io.BytesIO(content)
+    else:
+        response = open_url_retrying(url)
+
+    if response is None:
+        yield None
+        return
+
+    try:
+        tar = tarfile.open(fileobj = response, mode = 'r|gz')
+        xml_member = None
+        for member in tar:
+            if re.match('.*.xml', member.name):
+                xml_member = member
+                break
+        if xml_member is None:
+            print(f'{base_name} did not have an .xml file. Returning None')
+            yield None
+        else:
+            yield tar.extractfile(xml_member)
+    finally:
+        response.close()
+
+
+
+@runMetrics.timed('geoAgeExtract')
 def geoAgeExtract(sample_dict, checkCell = True,
     parseAgeIDs = ['characteristics', 'description', 'treatment_protocol', 'growth_protocol'], convertTo = 'week',
     nullReturn = 'n/a', checkConverts = ['day', 'week', 'month', 'year'],
     tryAgeStudy = True, parseStudyIDs = ['series_summary', 'series_design'],
-    tryAgePMID = True, pmidSection = 'methods'):
+    tryAgePMID = True, pmidSection = 'methods', series_age = None):
     """ Extract age from GEO sample (GSM) text values in the `sample_dict`. Either/or the 'characteristics'
         or protocols/descriptions entries. See numericTimeConvert() docstring for
         more detail on the approach. Return null on cell detect. If the same age
@@ -121,6 +197,7 @@ def geoAgeExtract(sample_dict, checkCell = True,
                 extracted some GSE nor GSM
             pmidSection: Str - Full-text paper section in which to expect an age
                 value. Default to 'methods'
+            series_age: Float/Str - Age already read from the series text by `gseAgeExtract()` (`nullReturn` if none), shared by the samples of a series. If None, the series text of `sample_dict` is parsed
         Return:
             age: Float - Estimated age
             source: Str - Source of age scrape('Sample', 'Study', 'Text')
@@ -153,9 +230,12 @@ def geoAgeExtract(sample_dict, checkCell = True,
         return sum(ageCounter), 'Sample'
     else: ### charAge == nullReturn
         if tryAgeStudy is True:
-            gseAttempt, flagged = gseAgeExtract(sample_dict = sample_dict, convertTo = convertTo,
-                checkConverts = checkConverts, parseIDs = parseStudyIDs,
-                nullReturn = nullReturn)
+            if series_age is None:
+                gseAttempt, flagged = gseAgeExtract(sample_dict = sample_dict, convertTo = convertTo,
+                    checkConverts = checkConverts, parseIDs = parseStudyIDs,
+                    nullReturn = nullReturn)
+            else:
+                gseAttempt = series_age
             if gseAttempt == nullReturn and tryAgePMID is True:
                 pmidAttempt = pmidAgeExtract(sample_dict = sample_dict, sectionID = pmidSection,
                     convertTo = convertTo, checkConverts = checkConverts,
@@ -171,16 +251,7 @@ def geoAgeExtract(sample_dict, checkCell = True,
 
 def numericTimeConvert(text, convertTo = 'week', checkConverts = ['day', 'week',
     'month', 'year'], nullReturn = 'n/a'):
-    """ Convert text into a numerical time. Some general rules: Check will be
-        made for a range of numbers, e.g. 12-13, and averaged. If no match, then
-        check for single numbers, e.g. 12. However, if "for" is in front of this
-        number, then it needs to be added to other numeric matches (e.g. "12
-        weeks old for 2 weeks" == 14). This syntax is ideal, however one could
-        possibly check that the 12 != 2, with the expectation that the
-        likelihood is low that it would read "7 weeks old for 7 weeks".
-        These checks can be added in the future. Currently only able to process
-        days, weeks, months, and years (shorter time units are typically reserved
-        for exposures, such as a drug, rather than the animal's age).
+    """ Convert text into a numerical time with the shared `ageEngine.numericTimeConvert()` (see its docstring for the rules), so that this pipeline and metadataExtract read the same ages from the same text. Wide age ranges are not flagged here.
         Args:
             text: Str - text to be parsed
             convertTo: Str - Converted time units ['day', 'week', 'month', 'year']
@@ -189,146 +260,13 @@ def numericTimeConvert(text, convertTo = 'week', checkConverts = ['day', 'week',
 
         Return:
             nums - Float - Converted number in the text (to weeks)
-
-    TODO: add sentence split, excl terms (cell-stuff)
     """
-    if text == nullReturn:
-        return nullReturn
-
-
-    checkConverts = [re.sub('s$', '', x.lower()) for x in checkConverts]
-    convertTo = re.sub('s$', '', convertTo.lower())
-
-    if (any([x for x in checkConverts if x not in ['day', 'week', 'month', 'year']]) or
-        convertTo not in ['day', 'week', 'month', 'year']):
-        raise ValueError("Times must be in ['day', 'week', 'month', 'year']")
-
-    text = re.sub('(\D)\-(\D)', '\\1 \\2', text) #keep '7-8', convert 'seven-week'
-    text = re.sub('(\d+)\-(\D)', '\\1 \\2', text) #keep '7-8', convert '7-week'
-
-    splitWords = text.lower().strip().split()
-    strToNumConvert = []
-    for word in splitWords:
-        if word in numberDict:
-            strToNumConvert.append(str(numberDict[word]))
-        else:
-            strToNumConvert.append(word)
-    strToNumConvert = ' '.join(strToNumConvert)
-
-    nums = 0
-    for convertFrom in checkConverts:
-        nums = addAgeStrings(nums, strToNumConvert = strToNumConvert, convertFrom = convertFrom, convertTo = convertTo)
-
-    if nums == 0:
-        return nullReturn
-    else:
-        return nums
-
-
-def addAgeStrings(nums, strToNumConvert, convertFrom = 'day', convertTo = 'week'):
-    """ Find instances of time, and convert to a quantitative value (perhaps of
-        another time unit). Add time matches to counter, converted. Checks made
-        for durations, e.g. "for 2 weeks", and if found, these are added to nums.
-        For other matches, checks are made for multiple numbers (12-13 weeks),
-        and if found, these are averaged. Assume no ranges are reported for the
-        duration (e.g. no instances of "adminstered for 2-3 weeks"). Arguments
-        for convertFrom and convertTo are checked in numericTimeConvert().
-        Args:
-            nums: Float - counter (in weeks)
-            strToNumConvert: Str - string, presumably converted words to integers
-            convertFrom: Str - Any of ['day', 'week', 'month', 'year]
-            convertTo: Str - Any of ['day', 'week', 'month', 'year]
-        Returns:
-            Updated nums
-    """
-    convertCoef = timeConversions(convertFrom = convertFrom, convertTo = convertTo)
-
-    if convertFrom == 'day':
-        re1, re2 = '[ \-]day', r'[ \-]d[ \.s\,]'
-    if convertFrom == 'week':
-        re1, re2 = '[ \-]week', r'[ \-]wk[ \.s\,]'
-    if convertFrom == 'month':
-        re1, re2 = '[ \-]month', r'[ \-]mo[ \.s\,]'
-    if convertFrom == 'year':
-        re1, re2 = '[ \-]year', r'[ \-]yr[ \.s\,]'
-
-    timeMatches = re.compile(f'(?<!for )(\d+\-?\d+?){re1}|(?<!for )(\d+\-?\d+?){re2}|(?<!for )(\d+){re1}|(?<!for )(\d+){re2}|(?<!for )(\d+\.?\d+?){re1}|(?<!for )(\d+\.?\d+?){re2}')
-    timeMatchesDur = re.compile(f'for (\d+\-?\d+?){re1}|for (\d+\-?\d+?){re2}|for (\d+){re1}|for (\d+){re2}|for (\d+\.?\d+?){re1}|for (\d+\.?\d+?){re2}')
-
-    times = set(re.findall(timeMatches, strToNumConvert))
-    if re.findall(timeMatchesDur, strToNumConvert):
-        timeDurs = set(re.findall(timeMatchesDur, strToNumConvert)[0])
-    else:
-        timeDurs = []
-
-    for match in times:
-        for x in match:
-            if len(x.split('-')) == 2:
-                try:
-                    nums += np.mean([float(n) for n in x.split('-') if float(n) not in timeDurs])*convertCoef
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-            else:
-                try:
-                    if x not in timeDurs:
-                        nums += float(x)*convertCoef
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-
-    for match in timeDurs:
-        for x in match:
-            if len(x.split('-')) == 2:
-                try:
-                    nums += np.mean([float(n) for n in x.split('-')])*convertCoef
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print('found me')
-                    print(str(err))
-            else:
-                try:
-                    nums += int(x)*convertCoef
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-
-    return nums
-
-
-def timeConversions(convertFrom, convertTo):
-    """ Return coefficients of converting from e.g. days to weeks. Inherits from
-        addAgeStrings. Some matches are approximate (30 days per month) """
-
-    if convertFrom == convertTo:
-        return 1
-    if convertFrom == 'day' and convertTo == 'week':
-        return (1/7)
-    if convertFrom == 'day' and convertTo == 'month':
-        return (1/30)
-    if convertFrom == 'day' and convertTo == 'year':
-        return (1/365)
-    if convertFrom == 'week' and convertTo == 'month':
-        return (1/4)
-    if convertFrom == 'week' and convertTo == 'year':
-        return (1/52)
-    if convertFrom == 'week' and convertTo == 'day':
-        return 7
-    if convertFrom == 'month' and convertTo == 'day':
-        return 30
-    if convertFrom == 'year' and convertTo == 'day':
-        return 365
-    if convertFrom == 'month' and convertTo == 'week':
-        return 4
-    if convertFrom == 'year' and convertTo == 'week':
-        return 52
+    return ageEngine.numericTimeConvert(text, convertTo = convertTo, checkConverts = checkConverts,
+        nullReturn = nullReturn, flagRange = False)[0]
 
 
 
+@runMetrics.timed('gseAgeExtract')
 def gseAgeExtract(sample_dict, convertTo = 'week',
     checkConverts = ['day', 'week', 'month', 'year'],
     parseIDs = ['series_summary', 'series_design'], nullReturn = 'n/a',
@@ -374,16 +312,17 @@ def gseAgeExtract(sample_dict, convertTo = 'week',
         return nullReturn, flagged
 
 
+@runMetrics.timed('pmidAgeExtract')
 def pmidAgeExtract(sample_dict, sectionID = 'methods', convertTo = 'week',
     checkConverts = ['day', 'week', 'month', 'year'], nullReturn = 'n/a',
     flagRange = True):
     """ Attempt age extraction from PMID ID link """
 
     if len(sample_dict['pmid']) == 0:
-        print('No PMIDs found from GEO GSE metadata. Returning')
+        runMetrics.warn('noPMID', 'No PMIDs found from GEO GSE metadata. Returning')
         return nullReturn
 
-    pubContent = requests.get(sample_dict['pmid']).content
+    pubContent = geoFetch.fetchContent(sample_dict['pmid'])
 
     sectionText = pmidSectionExtraction(pmidContent = pubContent, sectionID = sectionID)
 
@@ -456,7 +395,7 @@ def pmidSectionExtraction(pmidContent, sectionID, possibleSections = ['abstract'
 
     links = [i.get('href') for i in root.findall('.//div[@class="supplemental col three_col last"]//a')]
     if len(links) == 0:
-        print('No links to full text papers found on PubMed PMID site. Returning')
+        runMetrics.warn('noFullTextLinks', 'No links to full text papers found on PubMed PMID site. Returning')
         return nullReturn
 
     if len(links) > 1:
@@ -471,12 +410,12 @@ def pmidSectionExtraction(pmidContent, sectionID, possibleSections = ['abstract'
             else:
                 pass # links = links[0]
 
-    winLink, winText, winDiv = maxSectionMatch(links = links,
+    winLink, winText, winDiv, winSoup = maxSectionMatch(links = links,
                 possibleSections = possibleSections, soupAttempts = soupAttempts,
-                nullReturn = nullReturn)
+                nullReturn = nullReturn, returnSoup = True)
 
     sectionText = findSectionText(fullText = winText, sectionTags = tags,
-                soupDiv = winDiv, nullReturn = nullReturn)
+                soupDiv = winDiv, nullReturn = nullReturn, soup = winSoup)
 
     return sectionText
 
@@ -500,12 +439,14 @@ def findTextInSectionTexts(links, possibleSections, nullReturn):
 
 
 
-def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
+@runMetrics.timed('findSectionText')
+def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a', soup = None):
     """ Within the text of a paper (from maxSectionMatch()), and using the Soup
         div argument (from maxSectionMatch()), look for the section headers
         defined by sectionTags. If the sections are found but cannot be located
         by an index-based re.findall(), an attempt is made to remove extra
-        newlines, otherwise the section cannot be found and null returned """
+        newlines, otherwise the section cannot be found and null returned.
+        `soup` is the already parsed fullText, if available """
 
     if fullText == nullReturn:
         return nullReturn
@@ -513,27 +454,19 @@ def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
     updated = False
     methodSplit = []
     countSplit, splitIndex = 0, 0
-    soup = BeautifulSoup(fullText, features = 'html.parser')
-    if soupDiv in ['h1', 'h2']:
-        for link in soup.find_all(soupDiv):
-            methodSplit.append(str(link))
-            countSplit += 1
-            for tag in sectionTags:
-                if tag in link.get_text().lower() and updated is False:
-                    updated = True
-                    splitIndex = countSplit
-
-    elif soupDiv in ['h6']:
-        for link in soup.find_all('div', class_ = soupDiv):
-            methodSplit.append(str(link))
-            countSplit += 1
-            for tag in sectionTags:
-                if tag in link.get_text().lower() and updated is False:
-                    updated = True
-                    splitIndex = countSplit
+    if soup is None:
+        soup = sectionSoup.parsePage(fullText)
+    ### h1/h2 headings, or div containers with h6 class
+    for link in sectionSoup.sectionHeaders(soup, soupDiv):
+        methodSplit.append(str(link))
+        countSplit += 1
+        for tag in sectionTags:
+            if tag in link.get_text().lower() and updated is False:
+                updated = True
+                splitIndex = countSplit
 
     if splitIndex == 0:
-        print('No section headings tagged with {0} found, returning '
+        runMetrics.warn('noSectionHeadings', 'No section headings tagged with {0} found, returning '
                 'null'.format(sectionTags))
 
         return nullReturn
@@ -546,28 +479,28 @@ def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
         fullText = re.sub(r'\n', '', fullText)
         findText = re.findall(findMe, fullText)
         if len(findText) == 0:
-            print('No text found with {0} section headers, returning '
+            runMetrics.warn('noSectionText', 'No text found with {0} section headers, returning '
                     'null'.format(sectionTags))
 
             return nullReturn
 
     if len(findText) > 1:
-        print('Warning, multiple method sections matched. Returning first')
+        runMetrics.warn('multipleSections', 'Warning, multiple method sections matched. Returning first')
 
     return findText[0]
 
+@runMetrics.timed('maxSectionMatch')
 def maxSectionMatch(links, possibleSections = ['abstract', 'introduction',
     'figures', 'materials and methods', 'methods', 'experimental procedures',
     'results', 'discussion', 'method summary', 'supplementary material',
     'acknowledgements', 'references', 'conclusions', 'supporting information',
-    'funding'], soupAttempts = ['h2', 'h1', 'h6'], nullReturn = 'n/a'):
+    'funding'], soupAttempts = ['h2', 'h1', 'h6'], nullReturn = 'n/a', returnSoup = False):
     """ Over a list of links, scan through a set of html headers and choose that
         which has the maximal number of matches to possible section IDs. Then
         return the url and the get() text of the link which wins (max-max) and
-        the Soup div. """
-
-    MAX_RETRIES = 20
-    adapter = requests.adapters.HTTPAdapter(max_retries=MAX_RETRIES)
+        the Soup div. Links are fetched concurrently (size and time capped, see
+        `sectionSoup`) and each page is parsed once for all `soupAttempts`;
+        `returnSoup` also returns the winning page's soup for findSectionText. """
 
     missings = [x for x in soupAttempts if x not in ['h1', 'h2', 'h6']]
     if len(missings) > 0:
@@ -577,44 +510,19 @@ def maxSectionMatch(links, possibleSections = ['abstract', 'introduction',
     soupAttempts = [x for x in soupAttempts if x not in missings]
 
     linkResults = dict()
-    for link in links:
+    for link, linkGet in zip(links, sectionSoup.fetchPages(links)):
         linkResults[link] = dict()
-        session = requests.Session()
-        session.mount('https://', adapter)
-        session.mount('http://', adapter)
-
-        try:
-            linkGet = session.get(link).text.lower()
-        except:
-            print(link)
+        if linkGet is None:
             linkResults[link]['text'] = ''
-            linkResults[link]['divs'] = dict()
-            linkResults[link]['divs']['h1'] = 0
-            linkResults[link]['divs']['h2'] = 0
-            linkResults[link]['divs']['h6'] = 0
+            linkResults[link]['soup'] = None
+            linkResults[link]['divs'] = {'h1' : 0, 'h2' : 0, 'h6' : 0}
             continue
 
         linkResults[link]['text'] = linkGet
-
-        linkResults[link]['divs'] = dict()
-
-        for attempt in soupAttempts:
-            linkCount = 0
-            soup = BeautifulSoup(linkGet, features = 'html.parser')
-            ### Count the number of h1/h2 headings
-            if attempt in ['h1', 'h2']:
-                for sec in soup.find_all(attempt):
-                    for x in possibleSections:
-                        if x in sec:
-                            linkCount += 1
-            ### Count the number of div containers with h6 class
-            elif attempt in ['h6']:
-                for sec in soup.find_all('div', class_ = attempt):
-                    for x in possibleSections:
-                        if x in sec:
-                            linkCount += 1
-            ### linkResults = {link : {'divs' : {attempt : linkCount}}}
-            linkResults[link]['divs'][attempt] = linkCount
+        linkResults[link]['soup'] = sectionSoup.parsePage(linkGet)
+        ### Count the number of h1/h2 headings and div containers with h6 class
+        ### linkResults = {link : {'divs' : {attempt : linkCount}}}
+        linkResults[link]['divs'] = sectionSoup.sectionCounts(linkResults[link]['soup'], soupAttempts, possibleSections)
 
     maxes = dict()
     for link in linkResults:
@@ -622,27 +530,35 @@ def maxSectionMatch(links, possibleSections = ['abstract', 'introduction',
 
     maxVal = max(maxes.values())
     if maxVal == 0:
-        print(f'No section matches found for any link. Returning null for {links}')
+        runMetrics.warn('noSectionMatch', f'No section matches found for any link. Returning null for {links}')
+        if returnSoup is True:
+            return nullReturn, nullReturn, nullReturn, None
         return nullReturn, nullReturn, nullReturn
 
     maxLink = [x for x in linkResults if maxes[x] == maxVal]
     if len(maxLink) > 1:
-        print('Tie for maximum number of matches, will return first link')
+        runMetrics.warn('sectionLinkTie', 'Tie for maximum number of matches, will return first link')
 
     maxLink = maxLink[0]
     maxDivVal = max(linkResults[maxLink]['divs'].values())
     maxDiv = [x for x in linkResults[maxLink]['divs'] if linkResults[maxLink]['divs'][x] == maxDivVal]
     if len(maxDiv) > 1:
-        print('Tie for maximum div heading, will return first')
+        runMetrics.warn('sectionDivTie', 'Tie for maximum div heading, will return first')
 
 
-    return maxLink[0], linkResults[maxLink]['text'], maxDiv[0]
+    if returnSoup is True:
+        return maxLink, linkResults[maxLink]['text'], maxDiv[0], linkResults[maxLink]['soup']
+    return maxLink, linkResults[maxLink]['text'], maxDiv[0]
 
 
+### Default in vitro vocabulary of `geoSampleCellCheck()`, compiled once
+cell_detect_kws = ['DMEM', 'FBS', 'bovine serum', 'passage']
+cell_detect_matcher = keywordMatch.KeywordMatcher({'cell' : cell_detect_kws})
+
 def geoSampleCellCheck(sample_dict,
                     parseLocations = ['treatment_protocol', 'growth_protocol'],
                     checkLocations = ['sample_cell_line', 'sample_cell_type'],
-                    cellDetectKWs = ['DMEM', 'FBS', 'bovine serum', 'passage']):
+                    cellDetectKWs = cell_detect_kws, cell_matcher = None):
 
     """
     Function used to create the 'cells' field in the output dictinary.
@@ -653,15 +569,17 @@ def geoSampleCellCheck(sample_dict,
             `sample_dict` - Dict: Contains {sampleID : data} key-value pairs for each element in the selected sample.
             `parseLocations` - List: Locations to use keywords to parse whether there are cells or not
             `checkLocations` - List: Location to check for any content at all. No cells means no content in these places.
-            `cellDetectKWs` - List:
+            `cellDetectKWs` - List: Keywords indicating in vitro assays. They're matched all at once with a `keywordMatch` automaton, so each location is scanned a single time however long the list is.
+            `cell_matcher` - KeywordMatcher: `cellDetectKWs` under 'cell'. The default list uses `cell_detect_matcher`, built once; for other lists, pass a matcher built once rather than one per sample.
 
         Returns:
             True/False depending on the input data.
     """
+    if cell_matcher is None:
+        cell_matcher = cell_detect_matcher if cellDetectKWs is cell_detect_kws else keywordMatch.KeywordMatcher({'cell' : cellDetectKWs})
     for parseLocation in parseLocations:
-        for cellDetectKW in cellDetectKWs:
-            if cellDetectKW in sample_dict[parseLocation]:
-                return True
+        if cell_matcher.search(sample_dict[parseLocation]):
+            return True
     for checkLocation in checkLocations:
         try:
             if sample_dict[checkLocation] != '':
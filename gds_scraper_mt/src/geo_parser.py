@@ -3,10 +3,13 @@ from os import path
 import itertools, os, re, requests, datetime
 import pandas as pd
 import xml.etree.ElementTree as ET
+from src.geo_extraction_funcs import runMetrics
 
+@runMetrics.timed('geo_txt_parse')
 def geo_txt_parse(loc_query_list, keep_files = [None]):
     """
     This function will take in a list of 2-element lists. Each internal list will contain a filename and a sampleID.
+    In place of the filename, the E-fetch response itself can be given as bytes (see `get_sample_data(write_file=False)`). These are parsed in memory and nothing is read from or deleted on disk.
 
     Looping through this top level list, each file will be read and data will be parsed from the individual sections of the file.
 
@@ -18,7 +21,7 @@ def geo_txt_parse(loc_query_list, keep_files = [None]):
 
         Args:
             `loc_query_list` - List: List of Two element lists. Elements created by `src.search_samples.get_sample_data`
-                - [location of text file, query_term]
+                - [location of text file (or response bytes), query_term]
                 - [GSM4667_19-10-31-1954_fetch.txt, GSM4667]
             `keep_files` - List: File types to keep during a full run. If 'txt' is in `keep_files` then the txt file won't be deleted.
 
@@ -40,8 +43,9 @@ def geo_txt_parse(loc_query_list, keep_files = [None]):
     rows_dict = {}
 
     for filename, query_name in loc_query_list:
-        if not path.exists(filename):
-            print(f'failed on {filename}')
+        in_memory = isinstance(filename, bytes)
+        if not in_memory and not path.exists(filename):
+            runMetrics.warn('missingTextFile', f'failed on {filename}')
             continue
 
         series_text_list = []
@@ -50,8 +54,11 @@ def geo_txt_parse(loc_query_list, keep_files = [None]):
         platform_text = ''
         sample_text = ''
 
-        with open(filename, 'r') as f:
-            contents = f.read()
+        if in_memory:
+            contents = filename.decode('utf-8', errors = 'replace')
+        else:
+            with open(filename, 'r') as f:
+                contents = f.read()
 
         contents = contents.strip()
 
@@ -131,7 +138,44 @@ def geo_txt_parse(loc_query_list, keep_files = [None]):
                                     'cells' : ''}
             row_list.append(row)
 
-        if 'txt' not in keep_files:
+        if 'txt' not in keep_files and not in_memory:
             os.unlink(filename)
 
     return rows_dict
+
+
+def split_efetch_records(contents, sample_ids):
+    """
+    Split a multi-sample GDS E-fetch document (see `src.search_samples.get_samples_data_batch()`) into one document per sample, each holding the sample's own record plus the series and platform records it refers to. That is the set of records a single-sample E-fetch returns, so the results can be fed to `geo_txt_parse()` unchanged.
+
+    Records are separated by blank lines. A sample record carries its accession ("Sample  Accession: GSM...") and its references ("Platform: GPL... Series: GSE... GSE...").
+
+        Args:
+            `contents` - Str: E-fetch text covering many samples
+            `sample_ids` - List: GSM accessions to pull out
+
+        Returns:
+            `sample_contents` - Dict: {sampleID : document text}, only for samples found in `contents`
+    """
+    wanted = set(sample_ids)
+    sample_records = {}
+    accession_records = {}
+    for result in contents.strip().split("\n\n"):
+        result = result.strip()
+        sample_accession = re.search('Sample\s*Accession: (GSM\d+)', result)
+        if sample_accession:
+            if sample_accession.group(1) in wanted:
+                sample_records[sample_accession.group(1)] = result
+            continue
+        for pattern in ['Series\s*Accession: (GSE\d+)', 'Platform\s*Accession: (GPL\d+)']:
+            other_accession = re.search(pattern, result)
+            if other_accession:
+                accession_records[other_accession.group(1)] = result
+
+    sample_contents = {}
+    for sample_id, sample_record in sample_records.items():
+        references = re.search('Platform: .*', sample_record)
+        references = re.findall('(GPL\d+|GSE\d+)', references.group()) if references else []
+        sample_contents[sample_id] = "\n\n".join([sample_record] + [accession_records[i] for i in references if i in accession_records])
+
+    return sample_contents
@@ -1,93 +1,228 @@
 from src.geo_extraction_funcs import *
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 import requests
 import xml.etree.ElementTree as ET
 
-def final_processing_loop(text_file_dict, samples_metadata_dict, series_pmid_dict, multichannel, metadata_filter, cells_flag):
-
-    text_file_dict_copy = text_file_dict.copy()
-    for sample_id in tqdm(text_file_dict_copy.keys(), total=len(text_file_dict_copy.keys())):
-
-        text_file_dict[sample_id].update(samples_metadata_dict[sample_id])
-
-        text_file_dict[sample_id]['cells'] = geoSampleCellCheck(text_file_dict[sample_id])
-        ### If multichannel == False, `xml_parser` will mark the multichannel samples in the metadata,
-        ### this actually removes them.
-        if (multichannel == False) and (text_file_dict[sample_id]['description'] == 'multi'):
-            text_file_dict.pop(sample_id, None)
+pubmed_efetch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&retmode=xml&id='
+### Gene dict written by the top-level wrangle.py, for `ko_genes`
+gene_index_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'refFiles', 'gene_result_mus_musculus.json')
+
+@runMetrics.timed('pubmed_metadata')
+def pubmed_metadata(pmids, batch_size = 200):
+    """
+    Title and abstract for each unique PMID, from batched PubMed E-fetch XML.
+    Each article's XML is kept in the shared response cache under its own single-PMID E-fetch URL, so only PMIDs never seen before are requested, `batch_size` per request.
+    PMIDs a successful E-fetch returns nothing for are cached as negative (empty) entries, and not requested again until those expire. A failed E-fetch (an HTTP error once the retries run out, or an `eFetchResult` error reply) caches nothing, so its PMIDs are requested again next time.
+
+        Args:
+            `pmids` - List: PubMed IDs, duplicates allowed
+            `batch_size` - Int: PMIDs per E-fetch request
+
+        Returns:
+            `pubmed_dict` - Dict: {pmid : {'article_title' : , 'abstract_article' : }}. PMIDs PubMed returned nothing for are left out.
+    """
+    articles = {}
+    missing = []
+    for pmid in sorted(set(pmids)):
+        cached_content = geoFetch.cachedContent(pubmed_efetch_base + pmid)
+        if cached_content == b'':
+            ### PubMed returned nothing for it before
             continue
-
-        ### Filters samples without metadata
-        if (metadata_filter == True) and (text_file_dict[sample_id]['description'] == ''):
-            text_file_dict.pop(sample_id, None)
+        elif cached_content is not None:
+            articles[pmid] = ET.fromstring(cached_content)
+        else:
+            missing.append(pmid)
+
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i+batch_size]
+        try:
+            root = ET.fromstring(geoFetch.fetchContent(pubmed_efetch_base + ','.join(batch), useCache = False, raiseForStatus = True))
+        except (requests.exceptions.RequestException, ET.ParseError) as e:
+            runMetrics.warn('pubmedBatchFailed', f'PubMed E-fetch of {len(batch)} PMIDs failed: {e}')
             continue
-
-        ### Filters cell samples
-        if (cells_flag == False) and (text_file_dict[sample_id]['cells'] == True):
-            text_file_dict.pop(sample_id, None)
+        if root.tag != 'PubmedArticleSet':
+            runMetrics.warn('pubmedBatchFailed', f'PubMed E-fetch of {len(batch)} PMIDs failed: {root.findtext("ERROR") or root.tag}')
             continue
+        for article in root.iter('PubmedArticle'):
+            pmid = article.findtext('./MedlineCitation/PMID')
+            if pmid in batch:
+                geoFetch.storeContent(pubmed_efetch_base + pmid, ET.tostring(article), resource = 'pubmed')
+                articles[pmid] = article
+        for pmid in batch:
+            if pmid not in articles:
+                geoFetch.storeContent(pubmed_efetch_base + pmid, b'', resource = 'pubmed', negative = True)
+
+    pubmed_dict = {}
+    for pmid, article in articles.items():
+        title = article.find('.//Article/ArticleTitle')
+        abstract = article.findall('.//Article/Abstract/AbstractText')
+        pubmed_dict[pmid] = {'article_title' : ''.join(title.itertext()).strip() if title is not None else '',
+                             'abstract_article' : ' '.join(''.join(i.itertext()).strip() for i in abstract)}
+    return pubmed_dict
+
+def series_age_extract(series_metadict):
+    """
+    Age in the summary and design of a series (`gseAgeExtract()`), the fallback of `geoAgeExtract()` for the series' samples that have no age of their own.
+    Samples only carry the series text when the series has a PMID, so series without one have no age ('n/a').
+    """
+    if series_metadict['pmid'] == '':
+        return 'n/a'
+    return gseAgeExtract(series_metadict)[0]
+
+def process_sample(sample_dict, sample_metadata, series_pmid_dict, pubmed_dict, gene_index, multichannel, metadata_filter, cells_flag):
+    """
+    `final_processing_loop()` for one sample: merge in its metadata, apply the sample filters and derive its flag fields and age.
+    `sample_dict` is updated in place and returned, or None if a filter removes the sample.
+    """
+    sample_dict.update(sample_metadata)
+
+    sample_dict['cells'] = geoSampleCellCheck(sample_dict)
+    ### If multichannel == False, `xml_parser` will mark the multichannel samples in the metadata,
+    ### this actually removes them.
+    if (multichannel == False) and (sample_dict['description'] == 'multi'):
+        return None
+
+    ### Filters samples without metadata
+    if (metadata_filter == True) and (sample_dict['description'] == ''):
+        return None
+
+    ### Filters cell samples
+    if (cells_flag == False) and (sample_dict['cells'] == True):
+        return None
+
+    sample_series_acc_num = sample_dict['series_accession']
+    series_metadict = series_pmid_dict[sample_series_acc_num]
+
+    ### Split for different categories of samples
+    wildtype_bool_pattern = '(((wild)|(Wild)|([Ww]))[ -_]?((type)|(Type)|([Tt])))'
+    if (re.findall(wildtype_bool_pattern, sample_dict['sample'].lower())) or (re.findall(wildtype_bool_pattern, sample_dict['description'].lower())):
+        sample_dict['wild_type'] = True
+    else:
+        sample_dict['wild_type'] = False
+
+    molecule_bool_pattern = '(treatment[a-z\s]*with)|(treated[a-z\s]with)'
+    if re.findall(molecule_bool_pattern, sample_dict['sample'].lower()):
+        sample_dict['molecule_bool'] = True
+    else:
+        sample_dict['molecule_bool'] = False
+
+    ko_bool_pattern = '(([Kk][-_ ]?[Oo])|(((knock)|(Knock))[- _]?((Out)|(out))))'
+    if re.search(ko_bool_pattern, sample_dict['sample'].lower()):
+        sample_dict['ko_bool'] = True
+    else:
+        sample_dict['ko_bool'] = False
+
+    if sample_dict['ko_bool'] == True:
+        ### pattern built from `sample` field
+        ko_pattern3 = "(((.*)[ -_]?){1,3})(([kK])|(knock)|(Knock))[- _]?((out)|(Out)|([Oo]))"
+        ### Group 1 grabs everything before the knockout/ko/Knock-Out group
+        for pattern, key, group_val in [(ko_pattern3, 'ko_gene3', 1)]:
+            if re.search(pattern, sample_dict['sample']):
+                sample_dict[key] = re.search(pattern, sample_dict['sample']).group(group_val)
+
+    ### Whole-word gene names next to KO tokens, from title, genotype and description
+    if gene_index is not None:
+        sample_dict['ko_genes'] = gene_index.koGenes([sample_dict.get(x, '') for x in ['sample', 'sample_genotype', 'description']])
+    else:
+        sample_dict['ko_genes'] = []
+
+    ### If the sample's series has a PMID,
+    if series_metadict["pmid"] != '':
+        sample_dict['pmid'] = f'https://www.ncbi.nlm.nih.gov/pubmed/{series_metadict["pmid"]}'
+
+        sample_dict['series_summary'] = series_metadict['series_summary']
+        sample_dict['series_design'] = series_metadict['series_design']
+
+        ### Article metadata is resolved once per PMID, before the samples
+        article = pubmed_dict.get(series_metadict["pmid"], {})
+        sample_dict['abstract_article'] = article.get('abstract_article', '')
+        sample_dict['article_title'] = article.get('article_title', '')
+    ### If no PMID,
+    else:
+        sample_dict['pmid'] = ''
+        sample_dict['series_summary'] = ''
+        sample_dict['series_design'] = ''
+        sample_dict['abstract_article'] = ''
+        sample_dict['article_title'] = ''
+
+    sample_dict['age_func'] = geoAgeExtract(sample_dict, series_age = series_metadict['series_age'])
+    ### Age source tier counts ('Sample'/'Study'/'Text', null for cells) for the run metrics
+    runMetrics.count('age_source_total', source = sample_dict['age_func'][1], found = sample_dict['age_func'][0] != 'n/a')
+
+    return sample_dict
+
+
+### Lookup tables of a `final_processing_loop()` worker process, set once per process by `init_processing_worker()`
+worker_tables = {}
+
+def init_processing_worker(series_pmid_dict, pubmed_dict, gene_index_path, filters, limiters):
+    """
+    Process pool initializer of `final_processing_loop()`: keep the series/PMID lookup tables and the gene index in the worker, so that chunks of samples are sent without them.
+    Share the parent's rate limiters (PubMed full-text age fallbacks) and start the worker's run metrics empty, relaying warnings for the parent to print.
+    """
+    geoFetch.installLimiters(limiters)
+    runMetrics.metrics.reset()
+    runMetrics.metrics.relay = True
+    worker_tables.update(series_pmid_dict = series_pmid_dict, pubmed_dict = pubmed_dict, gene_index = geneAlias.loadIndex(gene_index_path), filters = filters)
+
+def process_chunk(chunk):
+    """
+    `process_sample()` over a chunk of `[(sample_id, sample_dict, sample_metadata)]` in a worker process.
+    Returns `({sample_id : processed sample_dict, or None if removed}, metrics)` where `metrics` are the worker's run metrics for the chunk (`runMetrics.RunMetrics.drain()`).
+    """
+    processed = {}
+    for sample_id, sample_dict, sample_metadata in chunk:
+        processed[sample_id] = process_sample(sample_dict, sample_metadata, worker_tables['series_pmid_dict'], worker_tables['pubmed_dict'], worker_tables['gene_index'], *worker_tables['filters'])
+    return processed, runMetrics.metrics.drain()
+
+@runMetrics.timed('final_processing_loop')
+def final_processing_loop(text_file_dict, samples_metadata_dict, series_pmid_dict, multichannel, metadata_filter, cells_flag, progress = True, gene_index_path = gene_index_path, processes = 1, chunk_size = None, pubmed_dict = None, requests_per_second = None, limiters = None):
+    """
+    Merge the series metadata into each sample, apply the sample filters and derive the flag fields and age of the samples that are kept.
+    `pubmed_dict` holds the PubMed title/abstract of the series' PMIDs (`pubmed_metadata()`). Callers processing many series, like `scrape_gds`, resolve it once across all of them; if None, it is resolved here for these samples' series.
+    The age of each series' text is read once (`series_age_extract()`) and kept in `series_pmid_dict` as 'series_age', for the samples without an age of their own.
+    With `processes` > 1, samples are processed in chunks of `chunk_size` (by default about 4 chunks per process) by a pool of worker processes, which get the series/PMID lookup tables once, from the pool initializer (`init_processing_worker()`). The samples and their content are the same as with one process, in the same order, and the workers' run metrics are merged into this process'.
+    The workers share `limiters` (`src.geoFetch.sharedLimiters()`), by default new NCBI limiters at `requests_per_second` (`src.geoFetch.defaultRequestsPerSecond` if None). Pass the limiters of a run already under way so that its rate limit also covers the workers.
+    The process pool is for standalone use, on samples parsed beforehand. `scrape_gds` does not use it: it already runs this function per series across its own `processes` worker processes, and a pool in each of them would oversubscribe the CPUs.
+    `ko_genes` lists the gene symbols found next to KO/knockout tokens of the sample title, genotype and description (`geneAlias.GeneAliasIndex.koGenes()`), using the gene dict at `gene_index_path`. Without that file (run the top-level wrangle.py to create it), `ko_genes` is left empty.
+    """
+    gene_index = geneAlias.loadIndex(gene_index_path)
+    if gene_index is None:
+        runMetrics.warn('noGeneIndex', f'{gene_index_path} not found, `ko_genes` will be empty. Run wrangle.py to create it.')
+
+    ### PubMed traffic scales with publications, not samples
+    series_accessions = set(sample['series_accession'] for sample in text_file_dict.values())
+    if pubmed_dict is None:
+        pubmed_dict = pubmed_metadata([series_pmid_dict[i]['pmid'] for i in series_accessions if (i in series_pmid_dict) and (series_pmid_dict[i]['pmid'] != '')])
+
+    ### Series text is parsed for an age once per series, not once per sample without an age of its own
+    for i in series_accessions:
+        if i in series_pmid_dict:
+            series_pmid_dict[i]['series_age'] = series_age_extract(series_pmid_dict[i])
+
+    if processes > 1:
+        sample_ids = list(text_file_dict.keys())
+        if chunk_size is None:
+            chunk_size = max(1, -(-len(sample_ids) // (4 * processes)))
+        chunks = [[(i, text_file_dict[i], samples_metadata_dict[i]) for i in sample_ids[j:j + chunk_size]] for j in range(0, len(sample_ids), chunk_size)]
+        if limiters is None:
+            limiters = geoFetch.sharedLimiters(requestsPerSecond = requests_per_second)
+        with ProcessPoolExecutor(max_workers = processes, initializer = init_processing_worker,
+                                initargs = (series_pmid_dict, pubmed_dict, gene_index_path, (multichannel, metadata_filter, cells_flag), limiters)) as process_pool:
+            ### Chunks come back in order, so samples keep their input order
+            for processed, worker_metrics in tqdm(process_pool.map(process_chunk, chunks), total=len(chunks), disable = not progress):
+                runMetrics.metrics.merge(worker_metrics)
+                for sample_id, sample_dict in processed.items():
+                    if sample_dict is None:
+                        text_file_dict.pop(sample_id, None)
+                    else:
+                        text_file_dict[sample_id].update(sample_dict)
+        return text_file_dict
 
-        sample_series_acc_num = text_file_dict[sample_id]['series_accession']
-        series_metadict = series_pmid_dict[sample_series_acc_num]
-
-        ### Split for different categories of samples
-        wildtype_bool_pattern = '(((wild)|(Wild)|([Ww]))[ -_]?((type)|(Type)|([Tt])))'
-        if (re.findall(wildtype_bool_pattern, text_file_dict[sample_id]['sample'].lower())) or (re.findall(wildtype_bool_pattern, text_file_dict[sample_id]['description'].lower())):
-            text_file_dict[sample_id]['wild_type'] = True
-        else:
-            text_file_dict[sample_id]['wild_type'] = False
-
-        molecule_bool_pattern = '(treatment[a-z\s]*with)|(treated[a-z\s]with)'
-        if re.findall(molecule_bool_pattern, text_file_dict[sample_id]['sample'].lower()):
-            text_file_dict[sample_id]['molecule_bool'] = True
-        else:
-            text_file_dict[sample_id]['molecule_bool'] = False
-
-        ko_bool_pattern = '(([Kk][-_ ]?[Oo])|(((knock)|(Knock))[- _]?((Out)|(out))))'
-        if re.search(ko_bool_pattern, text_file_dict[sample_id]['sample'].lower()):
-            text_file_dict[sample_id]['ko_bool'] = True
-        else:
-            text_file_dict[sample_id]['ko_bool'] = False
-
-        if text_file_dict[sample_id]['ko_bool'] == True:
-            ### pattern built from `sample` field
-            ko_pattern3 = "(((.*)[ -_]?){1,3})(([kK])|(knock)|(Knock))[- _]?((out)|(Out)|([Oo]))"
-            ### Group 1 grabs everything before the knockout/ko/Knock-Out group
-            for pattern, key, group_val in [(ko_pattern3, 'ko_gene3', 1)]:
-                if re.search(pattern, text_file_dict[sample_id]['sample']):
-                    text_file_dict[sample_id][key] = re.search(pattern, text_file_dict[sample_id]['sample']).group(group_val)
-
-        ### If the sample's series has a PMID,
-        if series_metadict["pmid"] != '':
-            text_file_dict[sample_id]['pmid'] = f'https://www.ncbi.nlm.nih.gov/pubmed/{series_metadict["pmid"]}'
-
-            text_file_dict[sample_id]['series_summary'] = series_metadict['series_summary']
-            text_file_dict[sample_id]['series_design'] = series_metadict['series_design']
-
-            ### May be worth doing running this section on the set of PMID links rather than every sample
-            root = ET.fromstring(requests.get(text_file_dict[sample_id]['pmid']).content)
-            for elem in root.getiterator():
-                if not hasattr(elem.tag, 'find'): continue
-                i = elem.tag.find('}')
-                if i >= 0:
-                    elem.tag = elem.tag[i+1:]
-            try:
-                ### Index [0] of findall results is the title <h3>Abstract</h3>
-                text_file_dict[sample_id]['abstract_article'] = list(root.findall('.//div[@class="rprt_all"]//div[@class="abstr"]/')[1].itertext())[0]
-            except:
-                text_file_dict[sample_id]['article_abstract'] = ''
-            try:
-                text_file_dict[sample_id]['article_title'] = root.findall('.//div[@class="rprt_all"]//h1')[0].text
-            except:
-                text_file_dict[sample_id]['article_title'] = ''
-        ### If no PMID,
-        else:
-            text_file_dict[sample_id]['pmid'] = ''
-            text_file_dict[sample_id]['series_summary'] = ''
-            text_file_dict[sample_id]['series_design'] = ''
-            text_file_dict[sample_id]['abstract_article'] = ''
-            text_file_dict[sample_id]['article_title'] = ''
-
-        text_file_dict[sample_id]['age_func'] = geoAgeExtract(text_file_dict[sample_id])
+    text_file_dict_copy = text_file_dict.copy()
+    for sample_id in tqdm(text_file_dict_copy.keys(), total=len(text_file_dict_copy.keys()), disable = not progress):
+        if process_sample(text_file_dict[sample_id], samples_metadata_dict[sample_id], series_pmid_dict, pubmed_dict, gene_index, multichannel, metadata_filter, cells_flag) is None:
+            text_file_dict.pop(sample_id, None)
 
     return text_file_dict
@@ -0,0 +1,128 @@
+import argparse, json, os, sqlite3
+import pandas as pd
+
+class SampleStore:
+    """
+    Indexed store of `scrape_gds` results, used when 'sqlite' is in `out_types`.
+    Samples are kept in a SQLite file with `sample_id` as primary key and indexes on series and platform accessions, so appending a run is a keyed upsert of the new samples rather than a re-read and re-write of the whole output. The JSON and CSV outputs are dumps of the store, written only when asked for (`dump_store()`).
+
+        Args:
+            `path` - Str: SQLite file, created on first use
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.conn = sqlite3.connect(path, timeout = 60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS samples (sample_id TEXT PRIMARY KEY, series_accession TEXT, platform_accession TEXT, data TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS series_index ON samples (series_accession)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS platform_index ON samples (platform_accession)')
+        self.conn.commit()
+
+    def upsert(self, text_file_dict, replace = False):
+        """
+        Add samples to the store.
+            Args:
+                `text_file_dict` - Dict: {sampleID : data} as returned by `final_processing_loop()`
+                `replace` - Bool: Overwrite samples that are already stored. By default they're kept, like the `append` run type always did.
+
+            Returns:
+                `new_samples` - Dict: The part of `text_file_dict` that was written
+        """
+        existing = set()
+        if replace == False:
+            sample_ids = list(text_file_dict.keys())
+            for i in range(0, len(sample_ids), 500):
+                chunk = sample_ids[i:i+500]
+                existing.update(x[0] for x in self.conn.execute(f'SELECT sample_id FROM samples WHERE sample_id IN ({",".join("?" * len(chunk))})', chunk))
+        new_samples = {k : v for (k,v) in text_file_dict.items() if k not in existing}
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)',
+                                  [(k, v.get('series_accession', ''), v.get('platform_accession', ''), json.dumps(v)) for (k,v) in new_samples.items()])
+        return new_samples
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM samples')
+
+    def get(self, sample_id):
+        row = self.conn.execute('SELECT data FROM samples WHERE sample_id = ?', (sample_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def series_samples(self, series_accession):
+        """
+        {sampleID : data} of all stored samples of a series
+        """
+        return {k : json.loads(v) for (k,v) in self.conn.execute('SELECT sample_id, data FROM samples WHERE series_accession = ?', (series_accession,))}
+
+    def iter_samples(self):
+        for sample_id, data in self.conn.execute('SELECT sample_id, data FROM samples ORDER BY rowid'):
+            yield sample_id, json.loads(data)
+
+    def dump_json(self, path):
+        """
+        Write the store as the `{sampleID : data}` JSON file `scrape_gds` writes (indent 4), streaming sample by sample.
+        """
+        with open(path, 'w') as fout:
+            fout.write('{')
+            first = True
+            for sample_id, data in self.iter_samples():
+                fout.write('\n' if first else ',\n')
+                first = False
+                fout.write(f'    {json.dumps(sample_id)}: ' + json.dumps(data, indent = 4).replace('\n', '\n    '))
+            fout.write('}' if first else '\n}')
+
+    def dump_csv(self, path, chunk_size = 10000):
+        """
+        Write the store as the CSV `scrape_gds` writes (sampleID index, one column per field), `chunk_size` samples at a time.
+        Columns are the union of all samples' fields in order of first appearance, as `pd.DataFrame.from_dict(orient='index')` would give.
+        """
+        columns = {}
+        for _, data in self.iter_samples():
+            columns.update(dict.fromkeys(data))
+        columns = list(columns)
+
+        header = True
+        chunk = []
+        for sample in self.iter_samples():
+            chunk.append(sample)
+            if len(chunk) == chunk_size:
+                self._write_csv_chunk(path, chunk, columns, header)
+                header, chunk = False, []
+        if len(chunk) > 0 or header == True:
+            self._write_csv_chunk(path, chunk, columns, header)
+
+    def _write_csv_chunk(self, path, chunk, columns, header):
+        pd.DataFrame([data for (_, data) in chunk], index = [sample_id for (sample_id, _) in chunk], columns = columns).to_csv(path, mode = 'w' if header else 'a', header = header)
+
+    def close(self):
+        self.conn.close()
+
+def dump_store(store_path, out_path, out_types = ['json', 'csv']):
+    """
+    Write the JSON and/or CSV output of a `scrape_gds` run from its store, on demand rather than after every run.
+        Args:
+            `store_path` - Str: SQLite file written by `scrape_gds` with 'sqlite' in `out_types`
+            `out_path` - Str: Output path without extension, as `out_path` of `scrape_gds`
+            `out_types` - List: Any of 'json' and 'csv'
+    """
+    sample_store = SampleStore(store_path)
+    try:
+        if 'json' in out_types:
+            sample_store.dump_json(f'{out_path}.json')
+        if 'csv' in out_types:
+            sample_store.dump_csv(f'{out_path}.csv')
+    finally:
+        sample_store.close()
+
+
+if __name__ == '__main__':
+    ### python -m src.sample_store output/out_files/test.sqlite output/out_files/test --out_types json csv
+    parser = argparse.ArgumentParser(description = 'Dump a scrape_gds sample store to JSON/CSV')
+    parser.add_argument('store_path')
+    parser.add_argument('out_path')
+    parser.add_argument('--out_types', nargs = '+', default = ['json', 'csv'], choices = ['json', 'csv'])
+    args = parser.parse_args()
+    dump_store(args.store_path, args.out_path, out_types = args.out_types)
@@ -1,12 +1,93 @@
 import xml.etree.ElementTree as ET
-import json, os, time, sys, re, requests, glob
+import json, os, time, sys, re, requests, glob, threading, tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import pandas as pd
-from src.search_samples import get_sample_data
+from src.search_samples import get_sample_data, get_samples_data_batch
 from src.geo_parser import geo_txt_parse
 from src.ftp_gzxml_parser import xml_parser
 from src.geo_extraction_funcs import *
-from src.processing_data import final_processing_loop
+from src.processing_data import final_processing_loop, pubmed_metadata
+from src.sample_store import SampleStore
+
+def local_series_file(url, local_files_list):
+    """
+    Name of an already downloaded `output/xml/` file for the series at `url`, or "" if there isn't one or 'xml' isn't in `local_files_list`.
+    """
+    if (url is None) or ('xml' not in local_files_list):
+        return ""
+    try: ### Try to extract GSE filename from url
+        gse_sample_id = url.split('/')[-1].split('.')[0]
+    except: ### Return string that will not match a file if fail
+        gse_sample_id = 'NO_MATCH'
+    ### Use GSE sample ID to find matching files
+    search_xml_file = glob.glob(f'output/xml/{gse_sample_id}.xml')
+    if len(search_xml_file) == 0:
+        return ""
+    return search_xml_file[0].split('/')[-1]
+
+
+def parse_series(url, text_file_dict, filename = "", content = None, multichannel = False, keep_files = [None]):
+    """
+    First worker job of `scrape_gds`: gather the series metadata for the samples of one series.
+        Args:
+            `url` - Str: Series FTP URL, None if the samples had no series link
+            `text_file_dict` - Dict: {sampleID : data} of `geo_txt_parse()`, for the samples of this series
+            `filename` - Str: Local `output/xml/` file to parse instead of downloading
+            `content` - Bytes: The series .tgz, already downloaded, or Str: the file it was downloaded to
+
+        Returns:
+            `samples_metadata_dict` - Dict: {sampleID : metadata} for `final_processing_loop()`
+            `series_pmid_dict` - Dict: {Series accession : {'pmid', 'series_summary', 'series_design'}}
+    """
+    sample_ids = list(text_file_dict.keys())
+    if url == None:
+        ### Empty dict if broken URL, or if the download failed
+        series_meta_dict = dict()
+        xml_pmid_list = dict()
+    elif filename != "":
+        xml_pmid_list, series_meta_dict = xml_parser(filename=filename, sample_list=sample_ids, multichannel = multichannel, keep_files = keep_files)
+    else:
+        xml_pmid_list, series_meta_dict = xml_parser(url=url, sample_list=sample_ids, multichannel = multichannel, keep_files = keep_files, content = content)
+
+    """
+    Prepare a slot in the metadata dictionary for all the samples.
+        - Add blank sample_age to each one to use it for the geoAgeExtract()
+    Also created a series -> PMID data dict using the samples series' number
+        - Also add blank PMID, Series Summary and Design
+    """
+    samples_metadata_dict = {key:{'sample_age' : ''} for key in sample_ids}
+    series_pmid_dict = {i['series_accession']: {'pmid':'', 'series_summary': '', 'series_design':''} for i in text_file_dict.values()}
+    series_pmid_dict.update(xml_pmid_list)
+    samples_metadata_dict.update(series_meta_dict)
+    return samples_metadata_dict, series_pmid_dict
+
+
+def process_series(text_file_dict, samples_metadata_dict, series_pmid_dict, pubmed_dict, multichannel = False, metadata_filter = False, cells_flag = False):
+    """
+    Second worker job of `scrape_gds`: run `final_processing_loop()` on the samples of one series, with the series metadata of `parse_series()` and the PubMed metadata resolved across all series by the parent.
+
+        Returns:
+            `text_file_dict` - Dict: The processed samples, as returned by `final_processing_loop()`
+    """
+    return final_processing_loop(text_file_dict, samples_metadata_dict, series_pmid_dict, multichannel, metadata_filter, cells_flag, progress = False, pubmed_dict = pubmed_dict)
+
+
+def init_worker(limiters):
+    """
+    Process pool initializer: share the parent's rate limiters, and start the worker's run metrics empty (a forked worker inherits the parent's counts so far), relaying warnings for the parent to print.
+    """
+    geoFetch.installLimiters(limiters)
+    runMetrics.metrics.reset()
+    runMetrics.metrics.relay = True
+
+
+def worker_job(job, *args, **kwargs):
+    """
+    `job` (`parse_series()` or `process_series()`) in a worker process, returning `(result, metrics)` where `metrics` are the worker's run metrics for this job (`runMetrics.RunMetrics.drain()`), to be merged into the parent's.
+    """
+    return job(*args, **kwargs), runMetrics.metrics.drain()
+
 
 def scrape_gds(query_terms,
                 api_key,
@@ -18,7 +99,13 @@ def scrape_gds(query_terms,
                 keep_files = [None],
                 run_type = 'append',
                 out_types = ['json', 'csv'],
-                local_files_list = [None]):
+                local_files_list = [None],
+                download_workers = 4,
+                processes = os.cpu_count(),
+                requests_per_second = None,
+                batch_size = 200,
+                metrics_path = None,
+                prometheus_path = None):
 
     """
     Function to take in an iterator of sample IDs and output either a .json or .csv file of the sample, series and platform data and the metadata associated with the sample's series.
@@ -26,6 +113,7 @@ def scrape_gds(query_terms,
     The list of filenames and associated sampleIDs is fed to `src.geo_parser.geo_txt_parse()` which will extract the sample's sample, series and platform data. This function returns a dictionary with GSM ID keys and data dictionary values.
     The series FTP links are fed individual to `src.ftp_gzxml_parser.xml_parser()` to gather metadata on samples in each series. This function returns a dictionary of samples from that series.
     Before the data is returned, a final parsing loop is run that will update the samples with the sample's metadata, run regex checks over certain text blocks, and run the age-extraction function.
+    Series are pipelined: `download_workers` threads download series .tgz files and hand each one to a pool of `processes` worker processes, which run `xml_parser()` on it while the next downloads are in flight. The PMIDs of all series are then resolved in batched PubMed E-fetches (`src.processing_data.pubmed_metadata()`), and the pool runs `final_processing_loop()` on each series' samples. All processes share one per-host NCBI rate limit (`src.geoFetch.sharedLimiters()`).
     The data is returned in the format specified by `out_types` at the location specified in `out_path`. If `run_type` is set to `append`, progam will check for a pre-existing file to append to and create one if there isn't an existing option. Setting `run_type` to `new` will overwrite any existing file at `out_path`.
 
         Args:
@@ -36,10 +124,16 @@ def scrape_gds(query_terms,
             `cells_flag` - Boolean: Flag telling the program to skip samples with 'cells' data found in meta-data.
             `metadata_filter` - Boolean: Flag telling the program to skip samples without any series metadata
             `out_path` - Str: Output path, does not include extension as the correct extension will be added. Defaults to /output/test
-            `keep_files` - List: Flags to keep certain files used during the process. Options include 'txt' and 'xml'.
+            `keep_files` - List: Flags to keep certain files used during the process. Options include 'txt' and 'xml'. File types not listed are never written; responses are parsed in memory.
             `run_type` - Str: Set to `new` to create a new file at `out_path`. Set to `append` to append to an existing file at `out_path`.
-            `out_types` - List: Output file type. Options include 'json' and 'csv'
+            `out_types` - List: Output file type. Options include 'json', 'csv' and 'sqlite'. With 'sqlite', results are upserted into an indexed store at `out_path`.sqlite (`src.sample_store.SampleStore`) and no JSON/CSV is written, so appending costs the new samples only. Dump the store to JSON/CSV when needed with `src.sample_store.dump_store()` (or `python -m src.sample_store`).
             `local_files_list` - List: List of types of files to check for a local version of before querying API and downloading. Works for 'txt' and 'xml' files. 
+            `download_workers` - Int: Threads downloading sample text and series files
+            `processes` - Int: Worker processes parsing and processing series
+            `requests_per_second` - Int: NCBI request ceiling shared by all threads and processes. Defaults to 3, or 10 with an `api_key`.
+            `batch_size` - Int: Samples per batched E-search/E-fetch (`src.search_samples.get_samples_data_batch()`). Set to 1 to query samples one by one.
+            `metrics_path` - Str: JSON report of the run's metrics (`src.runMetrics`): requests, bytes, latencies and retries per host, cache hit rates, CPU time per stage, age source counts and warning counts. Defaults to `out_path`_metrics.json
+            `prometheus_path` - Str: Also write the metrics as a Prometheus textfile here, e.g. into node_exporter's textfile collector directory
 
         Returns:
             `text_file_dict` - Dict: Contains {sampleID : data} key-value pairs for all the requested samples.
@@ -48,19 +142,20 @@ def scrape_gds(query_terms,
                 - File type is decided by files in `out_type`. By default, create both CSV and JSON.
                 - Files will be named based on `out_path` with the corresponding extension added.
                 - Files have sampleID as key/index and then associated data as values/columns.
+                - The run metrics report goes to `metrics_path`.
     """
     for file_type in keep_files:
         if (file_type != 'txt') and (file_type != 'xml') and (file_type is not None):
             raise ValueError(f'{file_type} is not a valid option for `keep_files`. Please enter either `xml` and/or `csv`.')
     for file_type in out_types:
-        if (file_type != 'json') and (file_type != 'csv') and (file_type != 'txt') and (file_type is not None):
-            raise ValueError(f'{file_type} is not a valid option for `out_type`. Please enter either `csv` and/or `json`.')
+        if (file_type != 'json') and (file_type != 'csv') and (file_type != 'txt') and (file_type != 'sqlite') and (file_type is not None):
+            raise ValueError(f'{file_type} is not a valid option for `out_type`. Please enter `csv`, `json` and/or `sqlite`.')
     if (run_type != 'new') and (run_type != 'append'):
         raise ValueError(f'{run_type} is not a valid option for `run_type`. Please enter either `new` or `append`.')
 
     if os.path.isdir("output") == False:
         os.mkdir('output')
-    if os.path.isdir("output/txt") == False:
+    if ('txt' in keep_files) and os.path.isdir("output/txt") == False:
         os.mkdir('output/txt')
     output_folder = '/'.join(out_path.split('/')[:-1])
     if os.path.isdir(f"{output_folder}") == False:
@@ -70,26 +165,41 @@ def scrape_gds(query_terms,
         with open(f'{out_path}.txt', 'w') as f:
             f.writelines("%s\n" % sample for sample in query_terms)
 
+    runMetrics.metrics.reset()
+
+    if requests_per_second is None:
+        requests_per_second = 10 if api_key != "" else 3
+    limiters = geoFetch.sharedLimiters(requestsPerSecond = requests_per_second)
+    geoFetch.installLimiters(limiters)
+
     ### `parse_list` elements will be lists containing [filename of sample API data, sample ID]
     ### [GSM4667_19-10-31-1954_fetch.txt, GSM4667]
-    parse_list=[]
-    print('Creating sample .txt files')
-    query_terms = list(set(query_terms))
-    for query_term in tqdm(query_terms, total=len(query_terms)):
+    ### Requests are spaced by the shared rate limiter rather than a fixed sleep
+    ### E-fetch results are only written to `output/txt/` if they are to be kept
+    def fetch_samples(batch):
+        return list(get_samples_data_batch(batch, api_key=api_key, write_file=('txt' in keep_files)).items())
 
-        if 'txt' in local_files_list:
-            search_ids_file = glob.glob(f'output/txt/{query_term}_*')
-            if len(search_ids_file) == 0:
-                search_ids_file = get_sample_data(query=query_term, api_key=api_key)
-                time.sleep(.5)
-            else:
-                search_ids_file = search_ids_file[0]
-            parse_list.append([search_ids_file, query_term])
+    def fetch_sample(query_term):
+        return [(query_term, get_sample_data(query=query_term, api_key=api_key, write_file=('txt' in keep_files)))]
 
+    print('Creating sample .txt files')
+    query_terms = list(set(query_terms))
+    parse_list = []
+    remote_terms = []
+    for query_term in query_terms:
+        search_ids_file = glob.glob(f'output/txt/{query_term}_*') if 'txt' in local_files_list else []
+        if len(search_ids_file) > 0:
+            parse_list.append([search_ids_file[0], query_term])
         else:
-            search_ids_file = get_sample_data(query=query_term, api_key=api_key)
-            parse_list.append([search_ids_file, query_term])
-            time.sleep(.5)
+            remote_terms.append(query_term)
+
+    if batch_size > 1:
+        batches, fetch = [remote_terms[i:i + batch_size] for i in range(0, len(remote_terms), batch_size)], fetch_samples
+    else:
+        batches, fetch = remote_terms, fetch_sample
+    with ThreadPoolExecutor(max_workers = download_workers) as download_pool:
+        for fetched in tqdm(download_pool.map(fetch, batches), total=len(batches)):
+            parse_list += [[search_ids_file, query_term] for query_term, search_ids_file in fetched]
 
     """
     `txt_file_dict` elements are lists containing the following:
@@ -109,56 +219,88 @@ def scrape_gds(query_terms,
     """
     print('Parsing the .txt files.')
     text_file_dict = geo_txt_parse(parse_list, keep_files = keep_files)
-    ### Lists for later
-    samples_series_accession_numbers = [i['series_accession'] for i in text_file_dict.values()]
-    samples_series_ftp_links = [i['series_ftp'] for i in text_file_dict.values()]
+
+    ### Group the samples by series FTP link, each series is downloaded and processed once
+    series_samples = {}
+    for sample_id, sample_data in text_file_dict.items():
+        series_samples.setdefault(sample_data['series_ftp'], {})[sample_id] = sample_data
 
     """
-    Prepare a slot in the metadata dictionary for all the requested samples.
-        - Add blank sample_age to each one to use it for the geoAgeExtract()
-    Also created a series -> PMID data dict using all the requested samples series' number
-        - Also add blank PMID, Series Summary and Design
+    Download threads feed the process pool. Each .tgz is downloaded to a temporary file, and the process job is handed its path, so neither this process nor the pool's call queue holds whole archives. At most `max_pending` series are downloaded but not yet parsed, which bounds the disk space of those files; each is removed once its job is done.
+    Each process job runs `xml_parser` for one series and returns its metadata. Once all series are parsed, their PMIDs are resolved together, and a second job per series runs `final_processing_loop` and returns its processed samples.
     """
-    samples_metadata_dict = {key:{'sample_age' : ''} for key in query_terms}
-    series_pmid_dict = {key: {'pmid':'', 'series_summary': '', 'series_design':''} for key in samples_series_accession_numbers}
-
     print('Downloading and collecting meta-data')
-    for url in tqdm(list(set(samples_series_ftp_links)), total=len(list(set(samples_series_ftp_links)))):
-        if url == None:
-            ### Empty dict if broken URL
-            series_meta_dict = dict()
-            xml_pmid_list = []
-        else:
-            """
-            `xml_parser` will take in a Series FTP Download URL and return,
-                -   `xml_pmid_list` is a dictionary of series -> PMID data mappings
-                -   `series_meta_dict` is a dictionary of the series meta data
-            """
-            if 'xml' in local_files_list:
-                try: ### Try to extract GSE filename from url
-                    gse_sample_id = url.split('/')[-1].split('.')[0]
-                except: ### Return string that will not match a file if fail
-                    gse_sample_id = 'NO_MATCH'
-                ### Use GSE sample ID to find matching files
-                search_xml_file = glob.glob(f'output/xml/{gse_sample_id}.xml')
-                if len(search_xml_file) == 0:
-                    xml_pmid_list, series_meta_dict = xml_parser(url=url, sample_list=query_terms, multichannel = multichannel, keep_files = keep_files)
-                else: ## len() >= 1
-                    search_xml_file = search_xml_file[0].split('/')[-1]
-                    xml_pmid_list, series_meta_dict = xml_parser(filename=search_xml_file, sample_list=query_terms, multichannel = multichannel, keep_files = keep_files)
-            else:
-                xml_pmid_list, series_meta_dict = xml_parser(url=url, sample_list=query_terms, multichannel = multichannel, keep_files = keep_files)
-        ### Update relevant dictionaries
-        series_pmid_dict.update(xml_pmid_list)
-        samples_metadata_dict.update(series_meta_dict)
-
-    ### Do final processing on samples
-    ### Start by adding metadata then adding derived fields
-    print('Final parsing loop')
-    text_file_dict = final_processing_loop(text_file_dict, samples_metadata_dict, series_pmid_dict, multichannel, metadata_filter, cells_flag)
+    max_pending = download_workers + 2 * processes
+    pending = threading.BoundedSemaphore(max_pending)
+    series_futures = []
+
+    def release_series(content):
+        if (content is not None) and os.path.exists(content):
+            os.remove(content)
+        pending.release()
+
+    with tempfile.TemporaryDirectory(prefix = 'gds_series_') as spool_dir, ProcessPoolExecutor(max_workers = processes, initializer = init_worker, initargs = (limiters,)) as process_pool:
+        def download_series(url):
+            pending.acquire()
+            content = None
+            try:
+                series_url, filename = url, local_series_file(url, local_files_list)
+                if (url is not None) and (filename == "") and ('xml' not in keep_files):
+                    content = tar_gz_download(url, path = os.path.join(spool_dir, os.path.basename(url)))
+                    if content is None:
+                        series_url = None
+                future = process_pool.submit(worker_job, parse_series, series_url, series_samples[url], filename = filename, content = content,
+                                            multichannel = multichannel, keep_files = keep_files)
+            except BaseException:
+                release_series(content)
+                raise
+            future.add_done_callback(lambda f: release_series(content))
+            series_futures.append((url, future))
+
+        with ThreadPoolExecutor(max_workers = download_workers) as download_pool:
+            for download in [download_pool.submit(download_series, url) for url in series_samples]:
+                download.result()
+
+        series_meta = dict()
+        for url, future in tqdm(series_futures, total=len(series_futures)):
+            series_meta[url], worker_metrics = future.result()
+            runMetrics.metrics.merge(worker_metrics)
+
+        ### PubMed metadata for the PMIDs of all series, in batches
+        pmids = set(series['pmid'] for _, series_pmid_dict in series_meta.values() for series in series_pmid_dict.values() if series['pmid'] != '')
+        pubmed_dict = pubmed_metadata(list(pmids))
+
+        print('Processing samples')
+        process_futures = []
+        for url, (samples_metadata_dict, series_pmid_dict) in series_meta.items():
+            series_pubmed = {series['pmid'] : pubmed_dict[series['pmid']] for series in series_pmid_dict.values() if series['pmid'] in pubmed_dict}
+            process_futures.append(process_pool.submit(worker_job, process_series, series_samples[url], samples_metadata_dict, series_pmid_dict, series_pubmed,
+                                                       multichannel = multichannel, metadata_filter = metadata_filter, cells_flag = cells_flag))
+        series_meta.clear()
+
+        processed_dict = dict()
+        for future in tqdm(as_completed(process_futures), total=len(process_futures)):
+            processed_series, worker_metrics = future.result()
+            processed_dict.update(processed_series)
+            runMetrics.metrics.merge(worker_metrics)
+
+    ### Keep the input order of samples
+    text_file_dict = {k : processed_dict[k] for k in text_file_dict.keys() if k in processed_dict}
+    runMetrics.count('samples_total', len(text_file_dict))
 
     ### Export data
-    if run_type == 'new':
+    if 'sqlite' in out_types:
+        ### Keyed upsert into the store. JSON/CSV dumps of the whole store are
+        ### on demand (`dump_store()`), not part of every run
+        sample_store = SampleStore(f'{out_path}.sqlite')
+        if run_type == 'new':
+            sample_store.clear()
+        text_file_dict = sample_store.upsert(text_file_dict)
+        sample_store.close()
+        if ('json' in out_types) or ('csv' in out_types):
+            print(f'Results are in {out_path}.sqlite, run `python -m src.sample_store {out_path}.sqlite {out_path}` for JSON/CSV.')
+
+    elif run_type == 'new':
         if 'json' in out_types:
             with open(f'{out_path}.json', 'w') as fout:
                 json.dump(text_file_dict, fout, indent = 4)
@@ -187,4 +329,8 @@ def scrape_gds(query_terms,
             pre_existing_data.update(text_file_dict)
 
             pd.DataFrame.from_dict(pre_existing_data, orient='index').to_csv(f'{out_path}.csv')
+
+    runMetrics.metrics.writeJSON(metrics_path or f'{out_path}_metrics.json')
+    if prometheus_path is not None:
+        runMetrics.metrics.writePrometheus(prometheus_path)
     return text_file_dict
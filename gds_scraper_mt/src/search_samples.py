@@ -1,24 +1,41 @@
 import time, os, requests, datetime, csv, re
 import pandas as pd
 import xml.etree.ElementTree as ET
+from src.geo_extraction_funcs import geoFetch, runMetrics
+from src.geo_parser import split_efetch_records
 
-def get_sample_data(query, retmax=50, sort='relevance', api_key="", DEBUG=0):
+esearch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
+efetch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+rettype_mode = "&rettype=abstract&retmode=xml"
+
+def sample_cache_key(query, retmax=50):
+    """
+    Key of the E-fetch result of `query` in the shared response cache. WebEnv values expire, so the fetched records are cached under the query itself.
+    """
+    return efetch_base + '?db=gds' + '&term=' + query + rettype_mode + '&retmax=' + str(retmax)
+
+
+def get_sample_data(query, retmax=50, sort='relevance', api_key="", DEBUG=0, write_file=True):
     """
     This function will query the NCBI e-utils API using the `query` parameter, write the results to a text file and return the file name.
+    With `write_file` False, nothing is written and the E-fetch response is returned as bytes instead, for `src.geo_parser.geo_txt_parse()` to read in memory.
     Works in two stages:
     - E-search will send the query to the API and return a QueryKey and WebEnv.
     - The QueryKey and WebEnv are fed into the GDS E-fetch which will return a text file with Sample,
 
     There are try: except: loops in each of the request.get sections are these will sometimes fail on big runs. These loops are currently untested as of 11/01/19.
 
+    The E-fetch result is stored in the shared response cache under the WebEnv-free form of the query, so a rerun skips both requests for samples that were already fetched.
+
         Args:
             `query` - query phrase to send to the API
             `retmax` - Maximum results to pull. `Samples` in GEO seem to have 3 max (Series, Platform, sample)
             `sort` - Sort order for results. Not relevant for GEO searches
             `api_key` - Supply API key for the API request
+            `write_file` - Write the result to `output/txt/` and return its name, else return the response bytes
 
         Returns:
-            `file_name_fetch` - Filename of text file downloaded from e-fetch
+            `file_name_fetch` - Filename of text file downloaded from e-fetch (bytes of the response if not `write_file`)
     """
 
     now = datetime.datetime.now()
@@ -27,7 +44,6 @@ def get_sample_data(query, retmax=50, sort='relevance', api_key="", DEBUG=0):
 
     query_id = query
     file_name_fetch = 'output/txt/' + query + '_' + now.strftime("%y-%m-%d-%H%M") + '_fetch.txt'
-    esearch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
 
     ### More DB options here : https://www.ncbi.nlm.nih.gov/books/NBK3837/
     db = '?db=' + 'gds'
@@ -45,37 +61,121 @@ def get_sample_data(query, retmax=50, sort='relevance', api_key="", DEBUG=0):
     if DEBUG >= 2:
         print(f'Search URL : {url_search}')
 
+    cache_key = sample_cache_key(query, retmax)
+    cached_content = geoFetch.cachedContent(cache_key)
+    if cached_content is not None:
+        if write_file == False:
+            return cached_content
+        with open(file_name_fetch, 'wb') as f:
+            f.write(cached_content)
+        return file_name_fetch
+
     try:
-        docsearch_resp = requests.get(url_search)
+        docsearch_content = geoFetch.fetchContent(url_search, useCache = False)
     except requests.exceptions.ConnectionError as e:
         print(e)
         print('Sleeping for 1 min then retrying')
         time.sleep(61)
-        docsearch_resp = requests.get(url_search)
+        docsearch_content = geoFetch.fetchContent(url_search, useCache = False)
 
 
     ### Search the results
-    root_search = ET.fromstring(docsearch_resp.content)
+    root_search = ET.fromstring(docsearch_content)
     QK = "&query_key=" + root_search.findall('./QueryKey')[0].text
     WE = "&WebEnv=" + root_search.findall('./WebEnv')[0].text
 
     ### Get Abstracts with efetch
-    efetch_base = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
-    rettype_mode = "&rettype=abstract&retmode=xml"
 
     if api_key != "":
         url_ab = efetch_base + '?db=gds' + QK + WE + rettype_mode + ret_max  + f'&api_key={api_key}'
     else:
         url_ab = efetch_base + '?db=gds' + QK + WE + rettype_mode + ret_max
     try:
-        docsab_resp = requests.get(url_ab)
+        docsab_content = geoFetch.fetchContent(url_ab, cacheKey = cache_key)
     except requests.exceptions.ConnectionError as e:
         print(e)
         print('Sleeping for 1 min then retrying')
         time.sleep(61)
-        docsab_resp = requests.get(url_ab)
+        docsab_content = geoFetch.fetchContent(url_ab, cacheKey = cache_key)
+
+    if write_file == False:
+        return docsab_content
 
     with open(file_name_fetch, 'wb') as f:
-        f.write(docsab_resp.content)
+        f.write(docsab_content)
 
     return file_name_fetch
+
+
+@runMetrics.timed('get_samples_data_batch')
+def get_samples_data_batch(queries, page_size=500, api_key="", DEBUG=0, write_file=True):
+    """
+    Batch version of `get_sample_data()` for many GSM accessions at once.
+    One E-search ORs all of `queries` together and posts the matches to the history server, then E-fetch pages through them (WebEnv/query_key) `page_size` records at a time. The combined document is split into the per-sample documents `get_sample_data()` would have returned (see `src.geo_parser.split_efetch_records()`), so a batch of 200 samples costs a handful of requests instead of 400.
+    Samples already in the response cache are not queried, and per-sample results are cached just like `get_sample_data()` results. Queries the batch can't resolve fall back to `get_sample_data()`.
+
+        Args:
+            `queries` - List: GSM accessions. A couple hundred per call keeps the E-search URL short.
+            `page_size` - Int: Records per E-fetch request
+            `api_key` - Supply API key for the API request
+            `write_file` - Write each result to `output/txt/` and return its name, else return the response bytes
+
+        Returns:
+            `results` - Dict: {query : filename (or bytes if not `write_file`)} for every query
+    """
+    now = datetime.datetime.now()
+    results = {}
+    contents = {}
+    for query in queries:
+        cached_content = geoFetch.cachedContent(sample_cache_key(query))
+        if cached_content is not None:
+            contents[query] = cached_content
+    missing = [query for query in queries if query not in contents]
+
+    api_kw = f'&api_key={api_key}' if api_key != "" else ""
+    if len(missing) > 0:
+        url_search = esearch_base + '?db=gds' + '&term=' + '+OR+'.join(missing) + "&usehistory=y" + '&retmax=0' + api_kw
+        if DEBUG >= 2:
+            print(f'Search URL : {url_search}')
+        try:
+            docsearch_content = geoFetch.fetchContent(url_search, useCache = False)
+        except requests.exceptions.ConnectionError as e:
+            print(e)
+            print('Sleeping for 1 min then retrying')
+            time.sleep(61)
+            docsearch_content = geoFetch.fetchContent(url_search, useCache = False)
+
+        root_search = ET.fromstring(docsearch_content)
+        count = int(root_search.findall('./Count')[0].text)
+        QK = "&query_key=" + root_search.findall('./QueryKey')[0].text
+        WE = "&WebEnv=" + root_search.findall('./WebEnv')[0].text
+
+        pages = []
+        for retstart in range(0, count, page_size):
+            url_ab = efetch_base + '?db=gds' + QK + WE + rettype_mode + f'&retstart={retstart}&retmax={page_size}' + api_kw
+            try:
+                pages.append(geoFetch.fetchContent(url_ab, useCache = False))
+            except requests.exceptions.ConnectionError as e:
+                print(e)
+                print('Sleeping for 1 min then retrying')
+                time.sleep(61)
+                pages.append(geoFetch.fetchContent(url_ab, useCache = False))
+
+        split_contents = split_efetch_records(b'\n\n'.join(pages).decode('utf-8', errors = 'replace'), missing)
+        for query, content in split_contents.items():
+            content = content.encode('utf-8')
+            geoFetch.storeContent(sample_cache_key(query), content, resource = 'eutils')
+            contents[query] = content
+
+    for query in queries:
+        if query not in contents:
+            results[query] = get_sample_data(query, api_key=api_key, DEBUG=DEBUG, write_file=write_file)
+        elif write_file == False:
+            results[query] = contents[query]
+        else:
+            file_name_fetch = 'output/txt/' + query + '_' + now.strftime("%y-%m-%d-%H%M") + '_fetch.txt'
+            with open(file_name_fetch, 'wb') as f:
+                f.write(contents[query])
+            results[query] = file_name_fetch
+
+    return results
@@ -38,15 +38,34 @@ import re, requests, os, random, sys, json, random
 import pandas as pd
 sys.path.append('./src')
 import setup_metadataExtract as util
+import geoFetch, runMetrics
+from resultStore import ResultStore
 refDirectory = 'refFiles'
 
 
 organism = 'Mus musculus'
 queryIDs = False
 queryNum = 10000
-overwrite = True
+overwrite = False
+exportJSON = True
+maxWorkers = 8
+requestsPerSecond = 3
 
-if queryIDs == True:
+### Snakemake runs one job per shard of the sample list (see Snakefile and
+### shardSamples.py) as: python metadataExtract.py <samples CSV> <metadata JSON>
+### [requests/sec]. All samples of the CSV are extracted, and the result store
+### and run metrics are kept next to the JSON. A shard with samples that hit a
+### transient error (network, HTTP 429/5xx, see geoFetch.isTransient()) exits
+### non-zero without writing the JSON, so the job fails and its rerun retries
+### them, rather than merging an incomplete shard. Samples that fail the same
+### way on every run (e.g. a page that does not parse) are recorded as errors
+### and left out of the JSON, as are exclusions.
+shardArgs = sys.argv[1:]
+if len(shardArgs) >= 2:
+    sampleIDs = list(dict.fromkeys(pd.read_csv(shardArgs[0], dtype = str)['0']))
+    if len(shardArgs) >= 3:
+        requestsPerSecond = float(shardArgs[2])
+elif queryIDs == True:
     if organism == 'Mus musculus':
         ids = pd.read_csv('{0}/GEO_{1}Samples.csv'.format(refDirectory, re.sub(' ', 
             '', organism)))['0'].values.tolist()
@@ -58,31 +77,70 @@ else:
             'GSM172972', 'GSM1338039', 'GSM218336', 'GSM1282831', 'GSM937915', 
             'GSM557138']
 
-if 'GEO_{0}Metadata.json'.format(re.sub(' ', '', organism)) in os.listdir(refDirectory):
-    with open('{0}/GEO_{1}Metadata.json'.format(refDirectory, re.sub(' ', '',   
-        organism)), 'r') as fin:
-        metaDict = json.load(fin)
+### Results (and exclusions) are checkpointed to the store as they finish, so
+### an interrupted run resumes where it stopped. Samples already recorded are
+### skipped unless overwrite is True. The JSON file is exported from the store.
+metaJSON = '{0}/GEO_{1}Metadata.json'.format(refDirectory, re.sub(' ', '', organism))
+if len(shardArgs) >= 2:
+    metaJSON = shardArgs[1]
+metaStore = ResultStore(re.sub(r'\.json$', '', metaJSON) + '.sqlite')
+if os.path.exists(metaJSON):
+    metaStore.importJSON(metaJSON)
 
-def main(sampleIDs, organism, metaDict):
-    
-    for sample in sampleIDs:
-        if sample not in metaDict or overwrite is True:
-            try:
-                metaData = util.extractGEOSampleInfo(sampleID = sample, 
-                    organism = organism)
-                metaDict[sample] = metaData
-            except AttributeError as err:
-                print('Will continue, but take a look at this: ', str(err))
-            except Exception as err:
-                print('Actual error: ', str(err))
+### Run metrics (requests, cache hits, stage CPU time, age sources, warning 
+### counts) are written as JSON at the end of each run, and also as a 
+### Prometheus textfile if metricsTextfile is set
+metricsJSON = '{0}/GEO_{1}Metrics.json'.format(refDirectory, re.sub(' ', '', 
+    organism))
+if len(shardArgs) >= 2:
+    metricsJSON = re.sub(r'\.json$', '', metaJSON) + 'Metrics.json'
+metricsTextfile = None
 
+def main(sampleIDs, organism, metaStore):
+    
     if overwrite is True:
-        with open('{0}/GEO_{1}Metadata.json'.format(refDirectory, re.sub(' ', '', 
-            organism)), 'w') as fout:
-            json.dump(metaDict, fout, indent = 4)
+        toExtract = list(sampleIDs)
+    else:
+        done = metaStore.recorded(sampleIDs)
+        toExtract = [x for x in sampleIDs if x not in done]
+
+    transient = set()
+    try:
+        for sample, metaData, err in util.extractGEOSampleInfoBatch(toExtract, 
+            maxWorkers = maxWorkers, requestsPerSecond = requestsPerSecond, 
+            organism = organism):
+            if err is None:
+                metaStore.record(sample, 'ok', meta = metaData)
+            elif isinstance(err, util.SampleExcluded):
+                ### Multi-channel, cells, organism mismatch or invalid accession.
+                ### Anything else is an error, and retried by the next run
+                runMetrics.warn('sampleExcluded', 'Will continue, but take a '
+                    'look at this: {0}'.format(err))
+                metaStore.record(sample, 'excluded', message = str(err))
+            else:
+                runMetrics.warn('sampleError', 'Actual error: {0}'.format(err))
+                metaStore.record(sample, 'error', message = str(err))
+                if geoFetch.isTransient(err):
+                    transient.add(sample)
+            runMetrics.count('samples_total', status = 'ok' if err is None else
+                type(err).__name__)
+    finally:
+        metaStore.commit()
+        runMetrics.metrics.writeJSON(metricsJSON)
+        if metricsTextfile is not None:
+            runMetrics.metrics.writePrometheus(metricsTextfile)
+
+    if len(shardArgs) >= 2 and len(transient) > 0:
+        print('{0} of {1} samples hit transient errors, not writing {2}: {3}'
+            .format(len(transient), len(sampleIDs), metaJSON, ', '.join(sorted(
+            transient)[:10])))
+        sys.exit(1)
+
+    if exportJSON is True:
+        metaStore.exportJSON(metaJSON)
     
     print('done')
 
 if __name__ == "__main__":
 
-    main(sampleIDs, organism, metaDict)
\ No newline at end of file
+    main(sampleIDs, organism, metaStore)
\ No newline at end of file
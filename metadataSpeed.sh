@@ -1,3 +1,15 @@
-#/bin/bash
-python3.6 -m cProfile -o metadataSpeed.prof metadataExtract.py
-snakeviz metadataSpeed.prof
+#!/bin/bash
+# Offline per-stage benchmarks over tests/fixtures (see benchmarks/runBenchmarks.py).
+# Checked against benchmarks/baseline.json when there is one; save a run there
+# with `cp benchmarks/results.json benchmarks/baseline.json`.
+# Pass --profile to also write metadataSpeed.prof and open it in snakeviz.
+if [ -f benchmarks/baseline.json ]; then
+    compare="--compare benchmarks/baseline.json"
+fi
+if [ "$1" == "--profile" ]; then
+    python3 benchmarks/runBenchmarks.py $compare --profile metadataSpeed.prof
+    status=$?
+    snakeviz metadataSpeed.prof
+    exit $status
+fi
+python3 benchmarks/runBenchmarks.py $compare
@@ -1,31 +1,237 @@
-"Basic queries of GEO studies --> sample lists"
+""" Basic queries of GEO studies --> sample lists
 
-import csv, re, requests
-import pandas as pd
+    Series (GSE) accessions are read from the GEO DataSets export in
+    refFiles/GEO_MusmusculusStudies.txt, and their samples (GSM) are looked up
+    in batches through E-utilities: one esearch per batch of series posts the
+    matching GEO DataSets entries to the history server, and esummary (JSON)
+    pages through them, each summary listing the samples of one series.
+    Series a batch does not resolve are scraped off their acc.cgi page, as
+    before. Batches run on maxWorkers threads under geoFetch's per-host NCBI
+    limit, and each series' sample list is kept in the response cache, so
+    reruns do not query it again.
+
+    With a local GEOmetadb SQLite dump (dumpPath), GSE -> GSM membership is
+    read from its gse_gsm table instead and nothing is fetched.
+
+    Samples are appended to the CSV as each batch finishes, with the series
+    they belong to, and the finished series are listed in '<csv>.done', so
+    that an interrupted run picks up where it stopped.
+
+    Usage:
+        python sampleListGen.py
+        python sampleListGen.py refFiles/GEO_MusmusculusStudies.txt
+            refFiles/GEO_MusmusculusSamples.csv --apiKey <key>
+        python sampleListGen.py --dump GEOmetadb.sqlite
+"""
+
+import argparse, csv, json, os, re, sqlite3, sys
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('./src')
+import geoFetch, runMetrics
 
 geoURL = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc='
+esearchURL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
+esummaryURL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
 refDirectory = 'refFiles'
+studiesPath = '{0}/GEO_MusmusculusStudies.txt'.format(refDirectory)
+samplesPath = '{0}/GEO_MusmusculusSamples.csv'.format(refDirectory)
+
+
+def readStudies(path):
+    """ GSE accessions of a GEO DataSets text export, in file order and without
+        repeats """
 
-def main(url, directory):
-        
     studyList = []
-    with open('{0}/GEO_MusmusculusStudies.txt'.format(directory), newline = '') as fin:
+    with open(path, newline = '') as fin:
         csvRead = csv.reader(fin, delimiter=' ', quotechar='|')
         for row in csvRead:
             rowJoin = ''.join(row)
             if 'Accession:GSE' in rowJoin:
                 studyList += re.findall(r'Accession\:(GSE\d+)', rowJoin)
+    return list(dict.fromkeys(studyList))
+
+
+def studyCacheKey(study):
+    """ Key of a series' sample list (JSON) in the shared response cache """
+
+    return esummaryURL + '?db=gds&term=' + study + '[ACCN]&retmode=json'
+
+
+def studySamplesPage(study, url = geoURL):
+    """ Samples linked from the acc.cgi page of a series. Raises HTTPError if
+        the page comes back with an error status. """
+
+    urlGetText = geoFetch.fetchText(url + study, raiseForStatus = True)
+    return list(dict.fromkeys(re.findall(r'acc\=(GSM\d+)\"', urlGetText)))
+
+
+def batchSamples(studies, apiKey = '', pageSize = 500):
+    """ {GSE: [GSM, ...]} for a batch of series. Series already in the cache
+        are not queried, the rest are ORed into one esearch whose history is
+        paged through with esummary. Series the esummary results do not list
+        fall back to studySamplesPage(), whose HTTPError is passed on (the
+        batch is then not marked done). A series with no samples on its page
+        is not cached, so that a later run looks it up again.
+
+        Args:
+            studies - List: GSE accessions. A couple hundred per batch keeps
+                the esearch URL short
+            apiKey - Str: NCBI API key, if any
+            pageSize - Int: Summaries per esummary request
+    """
+
+    samples = dict()
+    for study in studies:
+        content = geoFetch.cachedContent(studyCacheKey(study))
+        if content is not None:
+            samples[study] = json.loads(content)
+    missing = [x for x in studies if x not in samples]
+
+    apiParam = '&api_key=' + apiKey if apiKey != '' else ''
+    if len(missing) > 0:
+        search = json.loads(geoFetch.fetchContent(esearchURL + '?db=gds&term=' +
+            '+OR+'.join(x + '[ACCN]' for x in missing) + '&usehistory=y'
+            '&retmax=0&retmode=json' + apiParam, useCache = False))['esearchresult']
+
+        found = dict()
+        for retstart in range(0, int(search['count']), pageSize):
+            result = json.loads(geoFetch.fetchContent(esummaryURL + '?db=gds' +
+                '&query_key=' + search['querykey'] + '&WebEnv=' + search['webenv'] +
+                '&retstart={0}&retmax={1}&retmode=json'.format(retstart, pageSize) +
+                apiParam, useCache = False))['result']
+            for uid in result.get('uids', []):
+                ### ACCN also matches the GDS and sample entries of a series
+                doc = result[uid]
+                if doc.get('entrytype') == 'GSE':
+                    found[doc['accession']] = list(dict.fromkeys(x['accession']
+                        for x in doc.get('samples', [])))
+
+        for study in missing:
+            if study not in found:
+                runMetrics.warn('studyNotSummarized', 'No esummary for {0}, '
+                    'reading its GEO page instead'.format(study))
+                found[study] = studySamplesPage(study)
+            samples[study] = found[study]
+            if len(found[study]) == 0:
+                runMetrics.warn('studyNoSamples', 'No samples found for '
+                    '{0}'.format(study))
+                continue
+            geoFetch.storeContent(studyCacheKey(study), json.dumps(
+                found[study]).encode(), resource = 'eutils')
+
+    return samples
+
+
+def dumpSamples(studies, dumpPath):
+    """ {GSE: [GSM, ...]} for studies from the gse_gsm table of a GEOmetadb
+        SQLite dump """
+
+    samples = {study: [] for study in studies}
+    conn = sqlite3.connect('file:{0}?mode=ro'.format(dumpPath), uri = True)
+    try:
+        for gse, gsm in conn.execute('SELECT DISTINCT gse, gsm FROM gse_gsm WHERE '
+            'gse IN ({0}) ORDER BY gse, gsm'.format(','.join('?' * len(studies))),
+            studies):
+            samples[gse].append(gsm)
+    finally:
+        conn.close()
+    return samples
+
+
+def readProgress(outPath):
+    """ Series finished by an earlier run on outPath. The CSV is rewritten
+        with their rows only, dropping any from a batch that was cut off.
+        Returns (finished series, next row number). """
+
+    donePath = outPath + '.done'
+    if not os.path.exists(outPath) or not os.path.exists(donePath):
+        return set(), 0
+    with open(donePath, 'r') as fin:
+        done = set(fin.read().split())
+    with open(outPath, 'r', newline = '') as fin:
+        rows = [row for row in csv.reader(fin)][1:]
+    rows = [row for row in rows if len(row) == 3 and row[2] in done]
+    with open(outPath, 'w', newline = '') as fout:
+        csvWrite = csv.writer(fout)
+        csvWrite.writerow(['', '0', 'GSE'])
+        for i, row in enumerate(rows):
+            csvWrite.writerow([i] + row[1:])
+    return done, len(rows)
+
+
+def main(studiesPath = studiesPath, outPath = samplesPath, apiKey = '',
+    batchSize = 200, maxWorkers = 4, requestsPerSecond = None, dumpPath = None,
+    resume = True):
+    """ Write the samples of every series in studiesPath to outPath, a CSV of
+        row number, GSM (column '0', as read by metadataExtract.py) and GSE.
+
+        Args:
+            studiesPath - Str: GEO DataSets export listing the series
+            outPath - Str: Sample CSV, written as batches finish
+            apiKey - Str: NCBI API key, raises the default rate to 10/sec
+            batchSize - Int: Series per esearch
+            maxWorkers - Int: Batches fetched at once
+            requestsPerSecond - Int: NCBI ceiling, 3/sec without an API key
+                and 10/sec with one by default
+            dumpPath - Str: GEOmetadb SQLite file to read instead of querying
+                E-utilities
+            resume - Bool: Skip the series finished by an earlier run on
+                outPath, else start over
+    """
+
+    studyList = readStudies(studiesPath)
+    done, rowNum = readProgress(outPath) if resume is True else (set(), 0)
+    todo = [x for x in studyList if x not in done]
+    batches = [todo[i:i + batchSize] for i in range(0, len(todo), batchSize)]
+    print('{0} studies, {1} done by an earlier run'.format(len(studyList),
+        len(studyList) - len(todo)))
+
+    if requestsPerSecond is None:
+        requestsPerSecond = 10 if apiKey != '' else 3
+    geoFetch.setRequestsPerSecond(requestsPerSecond)
+
+    if rowNum == 0:
+        with open(outPath, 'w', newline = '') as fout:
+            csv.writer(fout).writerow(['', '0', 'GSE'])
+
+    def lookup(batch):
+        if dumpPath is not None:
+            return dumpSamples(batch, dumpPath)
+        return batchSamples(batch, apiKey = apiKey)
 
-    sampleList = []
     counter = 0
-    for geo in studyList:
-        urlGetText = requests.get(url + geo).text
-        sampleList += list(set(re.findall(r'acc\=(GSM\d+)\"', urlGetText)))
-        counter += 1
-        if counter % 1000 == 0:
-            print('1k studies done')
+    with open(outPath, 'a', newline = '') as fout, open(outPath + '.done', 'a'
+        if resume is True else 'w') as fdone, ThreadPoolExecutor(max_workers =
+        maxWorkers) as pool:
+        csvWrite = csv.writer(fout)
+        ### Batches are written in order, each once all of it is in
+        for batch, samples in zip(batches, pool.map(lookup, batches)):
+            for study in batch:
+                for sample in samples[study]:
+                    csvWrite.writerow([rowNum, sample, study])
+                    rowNum += 1
+            fout.flush()
+            fdone.write(''.join(x + '\n' for x in batch))
+            fdone.flush()
+            counter += len(batch)
+            if counter // 1000 > (counter - len(batch)) // 1000:
+                print('{0}k studies done'.format(counter // 1000))
 
-    pd.DataFrame(sampleList).to_csv('{0}/GEO_MusmusculusSamples.csv'.format(directory))
 
 if __name__ == "__main__":
-    main(geoURL, refDirectory)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = 'GEO series --> sample list')
+    parser.add_argument('studies', nargs = '?', default = studiesPath)
+    parser.add_argument('out', nargs = '?', default = samplesPath)
+    parser.add_argument('--apiKey', default = os.environ.get('NCBI_API_KEY', ''))
+    parser.add_argument('--batchSize', type = int, default = 200)
+    parser.add_argument('--maxWorkers', type = int, default = 4)
+    parser.add_argument('--requestsPerSecond', type = int, default = None)
+    parser.add_argument('--dump', default = None,
+        help = 'GEOmetadb SQLite file to read GSE -> GSM from')
+    parser.add_argument('--restart', action = 'store_true',
+        help = 'Ignore the progress of an earlier run')
+    args = parser.parse_args()
+
+    main(args.studies, args.out, apiKey = args.apiKey, batchSize =
+        args.batchSize, maxWorkers = args.maxWorkers, requestsPerSecond =
+        args.requestsPerSecond, dumpPath = args.dump, resume = not args.restart)
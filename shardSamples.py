@@ -0,0 +1,99 @@
+""" Split the sample list into shards for parallel metadata extraction, and
+    merge the per-shard results back into one metadata JSON (see Snakefile).
+
+    Samples are assigned to shards by a hash (crc32) of their series, so all
+    samples of a GSE are extracted by the same job and its series page and
+    full text are fetched once. Sample lists without a GSE column (written
+    before sampleListGen recorded it) are hashed by GSM instead. Shard
+    assignment only depends on the accessions and the number of shards, so a
+    rerun writes the same shards.
+
+    Usage:
+        python shardSamples.py split refFiles/GEO_MusmusculusSamples.csv
+            --shards 32 --outDir refFiles/shards
+        python shardSamples.py merge refFiles/shards/GEO_MusmusculusMetadata_*.json
+            --out refFiles/GEO_MusmusculusMetadata.json
+"""
+
+import argparse, csv, json, os, sys, zlib
+sys.path.append('./src')
+import runMetrics
+
+
+def shardOf(accession, shards):
+    return zlib.crc32(accession.encode()) % shards
+
+
+def shardPath(outDir, stem, shard):
+    return os.path.join(outDir, '{0}_{1}.csv'.format(stem, shard))
+
+
+def splitSamples(samplesPath, shards, outDir):
+    """ Write the samples of samplesPath to shards CSVs in outDir, named
+        '<samples file name>_<shard>.csv' and laid out like samplesPath (row
+        number, GSM in column '0', GSE). Every shard file is written, empty or
+        not, as Snakemake expects all of them. Repeated samples are kept once.
+        Returns the number of samples per shard. """
+
+    with open(samplesPath, 'r', newline = '') as fin:
+        rows = list(csv.reader(fin))
+    header, rows = rows[0], rows[1:]
+    sampleCol = header.index('0')
+    seriesCol = header.index('GSE') if 'GSE' in header else None
+
+    shardRows = [[] for _ in range(shards)]
+    seen = set()
+    for row in rows:
+        sample = row[sampleCol]
+        if sample in seen:
+            continue
+        seen.add(sample)
+        key = row[seriesCol] if seriesCol is not None else sample
+        shardRows[shardOf(key, shards)].append(row)
+
+    os.makedirs(outDir, exist_ok = True)
+    stem = os.path.splitext(os.path.basename(samplesPath))[0]
+    for shard, sampleRows in enumerate(shardRows):
+        tmpPath = shardPath(outDir, stem, shard) + '.tmp'
+        with open(tmpPath, 'w', newline = '') as fout:
+            csvWrite = csv.writer(fout)
+            csvWrite.writerow(header)
+            for i, row in enumerate(sampleRows):
+                csvWrite.writerow([i] + row[1:])
+        os.replace(tmpPath, shardPath(outDir, stem, shard))
+    return [len(x) for x in shardRows]
+
+
+def mergeMetadata(shardPaths, outPath):
+    """ Merge the {sampleID: meta} JSONs of the shards into outPath, in shard
+        order, laid out like ResultStore.exportJSON(). Returns the number of
+        samples. """
+
+    metaDict = dict()
+    for path in shardPaths:
+        with open(path, 'r') as fin:
+            metaDict.update(json.load(fin))
+    runMetrics.writeAtomic(outPath, json.dumps(metaDict, indent = 4))
+    return len(metaDict)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Shard the sample list, or '
+        'merge the shard metadata')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    split = commands.add_parser('split')
+    split.add_argument('samples')
+    split.add_argument('--shards', type = int, default = 32)
+    split.add_argument('--outDir', default = 'refFiles/shards')
+    merge = commands.add_parser('merge')
+    merge.add_argument('shardJSONs', nargs = '+')
+    merge.add_argument('--out', required = True)
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        counts = splitSamples(args.samples, args.shards, args.outDir)
+        print('{0} samples in {1} shards ({2}-{3} per shard)'.format(sum(counts),
+            len(counts), min(counts), max(counts)))
+    else:
+        print('Merged {0} samples'.format(mergeMetadata(args.shardJSONs,
+            args.out)))
@@ -0,0 +1,383 @@
+""" Age extraction from free text, shared by the metadataExtract pipeline
+    (setup_metadataExtract re-exports it) and gds_scraper_mt, so that both get
+    the same ages out of the same text.
+
+    Ages are read per time unit (day, week, month, year): ranges are averaged,
+    "for/after" durations are added on top, and all of it is converted to one
+    unit (see numericTimeConvert()). Every pattern is compiled once, here at
+    import, rather than on each call. Number words are resolved with
+    numberDict once per distinct text, and units whose token ('d', 'week' or
+    'wk', 'mo', 'year' or 'yr') never appears in the text are skipped, as is
+    all of the text if it has no number at all. These checks are cheap
+    substring/word tests that only skip texts the patterns could not match,
+    so results are those of running every unit's patterns.
+"""
+import re
+import numpy as np
+import runMetrics
+
+numberDict = {'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'eleven': 11,
+    'twelve': 12, 'thirteen': 13, 'fourteen': 14, 'fifteen': 15, 'sixteen': 16,
+    'seventeen': 17, 'eighteen': 18, 'nineteen': 19, 'twenty': 20, 'thirty': 30,
+    'forty': 40, 'fifty': 50, 'sixty': 60, 'seventy': 70, 'eighty': 80,
+    'ninety': 90, 'hundred': 100, 'thousand': 1000, 'million': 1000000,
+    'billion': 1000000000, 'point': '.'}
+
+timeReDict = {'day': {'timeMatch1': r'[ \-]day', 'timeMatch2': r'[ \-]d[ \.s\,]',
+                        'timeMatch3': r'[ \-]d[ \.s\,]?$', 'timeSub1': r' ?days?',
+                        'timeSub2': r' ?ds?', 'flagRange': 84},
+            'week': {'timeMatch1': r'[ \-]week', 'timeMatch2': r'[ \-]wk[ \.s\,]',
+                        'timeMatch3': r'[ \-]wk[ \.s\,]?$', 'timeSub1': r' ?weeks?',
+                        'timeSub2': r' ?wks?', 'flagRange': 12},
+            'month': {'timeMatch1': r'[ \-]month', 'timeMatch2': r'[ \-]mo[ \.s\,]',
+                        'timeMatch3': r'[ \-]mo[ \.s\,]?$', 'timeSub1': r' ?months?',
+                        'timeSub2': r' ?mos?', 'flagRange': 3},
+            'year': {'timeMatch1': r'[ \-]year', 'timeMatch2': r'[ \-]yr[ \.s\,]',
+                        'timeMatch3': r'[ \-]yr[ \.s\,]?$', 'timeSub1': r' ?years?',
+                        'timeSub2': r' ?yrs?', 'flagRange': 0.25}}
+
+### A unit can only match where one of its tokens is in the (lowercased) text
+unitTokens = {'day': ['d'], 'week': ['week', 'wk'], 'month': ['mo'],
+    'year': ['year', 'yr']}
+numberWords = {x for x in numberDict if x != 'point'}
+digitPattern = re.compile(r'\d')
+wordHyphen = re.compile(r'(\D)\-(\D)')
+numberHyphen = re.compile(r'(\d+)\-(\D)')
+
+
+def timeMatchPattern(re1, re2, lead):
+    """ The 16-way alternation of ages (lead = '(?<!{0} )') or durations
+        (lead = '{0} ') for the unit patterns re1 and re2 """
+
+    groups = [r'(\d+\-?\d+?)', r'(\d+)', r'(\d+\.?\d+?)',
+        r'(\d+\.?\d+?\-\d+\.?\d+?)']
+    return re.compile('|'.join(lead.format(word) + group + unit for word in
+        ['for', 'after'] for group in groups for unit in [re1, re2]))
+
+
+def unitPatterns(unit):
+    """ Compiled patterns of a time unit, from timeReDict """
+
+    re1, re2 = timeReDict[unit]['timeSub1'], timeReDict[unit]['timeSub2']
+    match1, match2, match3 = [timeReDict[unit]['timeMatch{0}'.format(i)] for i
+        in [1, 2, 3]]
+    return {'timeSub': re.compile(r'(\d+\.?\d?){0}(\-\d+\.?\d?{0})|'
+            r'(\d+\.?\d?){1}(\-\d+\.?\d?{1})'.format(re1, re2)),
+        'spacers': [(re.compile(r'(\d+\.?\d?){0}(\-\d+\.?\d?{1})'.format(re1,
+            re2)), '\\1\\2'), (re.compile(r'(\d+\.?\d?){0}(\-\d+\.?\d?{1})'
+            .format(re2, re1)), '\\1\\2'), (re.compile(r'(\d+\.?\d?)({0})'
+            .format(re1)), '\\1 \\2'), (re.compile(r'(\d+\.?\d?)({0})'
+            .format(re2)), '\\1 \\2')],
+        'times': [timeMatchPattern(match1, match2, '(?<!{0} )'),
+            timeMatchPattern(match1, match3, '(?<!{0} )')],
+        'durations': [timeMatchPattern(match1, match2, '{0} '),
+            timeMatchPattern(match1, match3, '{0} ')]}
+
+compiledUnits = {unit: unitPatterns(unit) for unit in timeReDict}
+
+
+def numericTimeConvert(text, convertTo = 'week', checkConverts = ['day', 'week',
+    'month', 'year'], nullReturn = 'n/a', flagRange = True):
+    """ Convert text into a numerical time. Some general rules: Check will be
+        made for a range of numbers, e.g. 12-13, and averaged. If no match, then
+        check for single numbers, e.g. 12. However, if "for|after" is in front of
+        this number, then it will be added to other numeric matches (e.g. "12
+        weeks old for 2 weeks" == 14). Currently only able to process
+        days, weeks, months, and years (shorter time units are typically reserved
+        for exposures, such as a drug, rather than the animal's age). The regexes
+        are read in from a built-in internal dictionary (timeReDict). Additionally,
+        extremely wide time ranges can be flagged, as some experiments may only
+        sacrifice mice as they reach a certain physiological state, which could
+        vary months, and thus would be uninformative to extract a "true" age.
+
+        Args:
+            text: Str - text to be parsed
+            convertTo: Str - Converted time units ['day', 'week', 'month', 'year']
+            nullReturn: Str - Return if no numbers found
+            checkConverts: List - Time units to convert to convertTo unit
+            flagRange: Bool - Flag a unexpectedly wide range with a printout.
+                The range will be read on the built-in timeReDict dictionary.
+
+        Return:
+            numSum - Float - Converted number in the text (to weeks) from average
+                of total ages plus durations
+            flagged: Bool - If requested, a T/F flag for wide age ranges
+
+    TODO: add sentence split, excl terms (cell-stuff)
+    """
+    flagged = False
+    if text == nullReturn:
+        return nullReturn, flagged
+
+    checkConverts, convertTo = checkTimeUnits(checkConverts, convertTo)
+    nums, durs = ageComponents(text, convertTo = convertTo,
+        checkConverts = checkConverts)
+
+    if len(nums) > 0:
+
+        if flagRange is True:
+            flagged = wideRangeCheck(nums, convertTo, 'ages')
+
+        numSum = np.nanmean(nums)
+        if len(durs) > 0:
+            if flagRange is True:
+                flagged = wideRangeCheck(durs, convertTo, 'durations') or flagged
+
+            numSum += np.nansum(durs)
+
+        if numSum == 0:
+            return nullReturn, flagged
+        else:
+            return numSum, flagged
+
+    elif len(nums) == 0 and len(durs) > 0:
+        if flagRange is True:
+            flagged = wideRangeCheck(durs, convertTo, 'durations')
+
+        numSum = np.nansum(durs)
+        if numSum == 0:
+            return nullReturn, flagged
+        else:
+            return numSum, flagged
+
+    elif len(nums) == 0 and len(durs) == 0:
+        return nullReturn, flagged
+
+
+def checkTimeUnits(checkConverts, convertTo):
+    """ Normalize (lowercase, singular) and validate numericTimeConvert units """
+
+    checkConverts = [re.sub('s$', '', x.lower()) for x in checkConverts]
+    convertTo = re.sub('s$', '', convertTo.lower())
+
+    if (any([x for x in checkConverts if x not in ['day', 'week', 'month', 'year']]) or
+        convertTo not in ['day', 'week', 'month', 'year']):
+        raise ValueError("Times must be in ['day', 'week', 'month', 'year']")
+
+    return checkConverts, convertTo
+
+
+def ageComponents(text, convertTo = 'week', checkConverts = ['day', 'week',
+    'month', 'year']):
+    """ The parsing half of numericTimeConvert: return the lists of ages (nums)
+        and durations (durs) found in text, converted to convertTo. Units are
+        expected to be normalized by checkTimeUnits() already.
+    """
+    text = wordHyphen.sub('\\1 \\2', text) #keep '7-8', convert 'seven-week'
+    text = numberHyphen.sub('\\1 \\2', text).lower()
+
+    nums, durs  = [], []
+    if digitPattern.search(text) is None and numberWords.isdisjoint(text.split()):
+        return nums, durs
+
+    ### Number words resolved once per distinct text (most units leave the
+    ### text as is)
+    converted = dict()
+    for convertFrom in checkConverts:
+        if not any(x in text for x in unitTokens[convertFrom]):
+            continue
+        patterns = compiledUnits[convertFrom]
+
+        found = patterns['timeSub'].findall(text)
+        if found:
+            textUse = ''.join([x for x in found[0]])
+        else:
+            textUse = text
+
+        for spacer, repl in patterns['spacers']:
+            spaced, n = spacer.subn(repl, textUse)
+            if n > 0:
+                textUse = spaced
+                break
+
+        splitWords = ' '.join(textUse.strip().split())
+        if splitWords not in converted:
+            converted[splitWords] = ' '.join([str(numberDict[word]) if word in
+                numberDict else word for word in splitWords.split(' ')])
+
+        nums, durs = enumAgeStrings(nums, durs, strToNumConvert =
+            converted[splitWords], convertFrom = convertFrom,
+            convertTo = convertTo)
+
+    return nums, durs
+
+
+def wideRangeCheck(values, convertTo, label = 'ages', verbose = True):
+    """ Sort values in place and flag neighbouring values further apart than
+        the timeReDict flagRange of convertTo """
+
+    flagged = False
+    values.sort()
+    for i, j in enumerate(values):
+        if i+1 != len(values):
+            if (values[i+1] - values[i]) > timeReDict[convertTo]['flagRange']:
+                runMetrics.warn('wideRange', 'Warning, very wide range of {0} '
+                    'found ({1} to {2} {3})'.format(label, values[i], values[i+1],
+                    convertTo) if verbose is True else None)
+                flagged = True
+    return flagged
+
+
+def numericTimeConvertBatch(texts, convertTo = 'week', checkConverts = ['day',
+    'week', 'month', 'year'], flagRange = True, verbose = False):
+    """ numericTimeConvert over many texts at once, for offline re-annotation
+        of characteristics/protocol strings. Repeated texts (very common across
+        samples of one series) are parsed once.
+
+        Args:
+            texts: List/pd.Series/Str - Texts to parse, or the path of a file
+                with one text per line. Non-string entries (e.g. NaN) are null.
+            convertTo: Str - Converted time units ['day', 'week', 'month', 'year']
+            checkConverts: List - Time units to convert to convertTo unit
+            flagRange: Bool - Flag unexpectedly wide ranges
+            verbose: Bool - Print the wide range warnings of numericTimeConvert
+
+        Return:
+            ages - np.array: Float, numericTimeConvert's result, NaN for null
+            durations - np.array: Float, the summed durations included in ages,
+                NaN if none were found
+            flags - np.array: Bool, numericTimeConvert's flagged
+    """
+    if isinstance(texts, str):
+        with open(texts) as inFile:
+            texts = [line.rstrip('\n') for line in inFile]
+    else:
+        texts = list(texts)
+
+    checkConverts, convertTo = checkTimeUnits(checkConverts, convertTo)
+
+    uniqueIndex = dict()
+    codes = np.empty(len(texts), dtype = np.intp)
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            text = None
+        codes[i] = uniqueIndex.setdefault(text, len(uniqueIndex))
+
+    uniqueAges = np.full(len(uniqueIndex), np.nan)
+    uniqueDurs = np.full(len(uniqueIndex), np.nan)
+    uniqueFlags = np.zeros(len(uniqueIndex), dtype = bool)
+    for text, i in uniqueIndex.items():
+        if text is None:
+            continue
+        nums, durs = ageComponents(text, convertTo = convertTo,
+            checkConverts = checkConverts)
+        if flagRange is True:
+            uniqueFlags[i] = wideRangeCheck(nums, convertTo, 'ages',
+                verbose = verbose) | wideRangeCheck(durs, convertTo,
+                'durations', verbose = verbose)
+        if len(durs) > 0:
+            uniqueDurs[i] = np.nansum(durs)
+        if len(nums) > 0:
+            uniqueAges[i] = np.nanmean(nums)
+
+    uniqueAges = np.where(np.isnan(uniqueAges), 0, uniqueAges) + np.where(
+        np.isnan(uniqueDurs), 0, uniqueDurs)
+    uniqueAges[uniqueAges == 0] = np.nan
+
+    return uniqueAges[codes], uniqueDurs[codes], uniqueFlags[codes]
+
+
+def enumAgeStrings(nums, durs, strToNumConvert, convertFrom = 'day',
+    convertTo = 'week'):
+    """ Find instances of time, and convert to a quantitative value (perhaps of
+        another time unit). Add time matches to counter, converted. Checks made
+        for durations, e.g. "for 2 weeks", and if found, these are added to nums.
+        For other matches, checks are made for multiple numbers (12-13 weeks),
+        and if found, these are averaged. Assume no ranges are reported for the
+        duration (e.g. no instances of "adminstered for 2-3 weeks"). Arguments
+        for convertFrom and convertTo are checked in numericTimeConvert().
+
+        Args:
+            nums: Float - counter (in weeks)
+            strToNumConvert: Str - string, presumably converted words to integers
+            convertFrom: Str - Any of ['day', 'week', 'month', 'year]
+            convertTo: Str - Any of ['day', 'week', 'month', 'year]
+        Returns:
+            Updated nums
+    """
+    convertCoef = timeConversions(convertFrom = convertFrom, convertTo = convertTo)
+    patterns = compiledUnits[convertFrom]
+
+    times = patterns['times'][0].findall(strToNumConvert) or patterns['times'][1
+        ].findall(strToNumConvert)
+    timeDurs = patterns['durations'][0].findall(strToNumConvert) or patterns[
+        'durations'][1].findall(strToNumConvert)
+    ### Each match has one non-empty group
+    durStrings = {''.join(x) for x in timeDurs}
+
+    for match in set(times):
+        for x in match:
+            if x == '':
+                continue
+            if len(x.split('-')) == 2:
+                try:
+                    nums.append(np.mean([float(n) for n in x.split('-')])*convertCoef)
+                except ValueError:
+                    continue
+                except Exception as err:
+                    runMetrics.warn('unitConversion', 'Age conversion from '
+                        '{0} to {1} failed: {2}'.format(convertFrom, convertTo,
+                        err))
+            elif x not in durStrings:
+                try:
+                    nums.append(float(x)*convertCoef)
+                except ValueError:
+                    continue
+                except Exception as err:
+                    runMetrics.warn('unitConversion', 'Age conversion from '
+                        '{0} to {1} failed: {2}'.format(convertFrom, convertTo,
+                        err))
+
+    for match in set(timeDurs):
+        for x in match:
+            if x == '':
+                continue
+            if len(x.split('-')) == 2:
+                try:
+                    durs.append(np.mean([float(n) for n in x.split('-')])*convertCoef)
+                except ValueError:
+                    continue
+                except Exception as err:
+                    runMetrics.warn('unitConversion', 'Age conversion from '
+                        '{0} to {1} failed: {2}'.format(convertFrom, convertTo,
+                        err))
+            else:
+                try:
+                    durs.append(float(x)*convertCoef)
+                except ValueError:
+                    continue
+                except Exception as err:
+                    runMetrics.warn('unitConversion', 'Age conversion from '
+                        '{0} to {1} failed: {2}'.format(convertFrom, convertTo,
+                        err))
+
+    return nums, durs
+
+
+def timeConversions(convertFrom, convertTo):
+    """ Return coefficients of converting from e.g. days to weeks. Inherits from
+        addAgeStrings. Some matches are approximate (30 days per month) """
+
+    if convertFrom == convertTo:
+        return 1
+    if convertFrom == 'day' and convertTo == 'week':
+        return (1/7)
+    if convertFrom == 'day' and convertTo == 'month':
+        return (1/30)
+    if convertFrom == 'day' and convertTo == 'year':
+        return (1/365)
+    if convertFrom == 'week' and convertTo == 'month':
+        return (1/4)
+    if convertFrom == 'week' and convertTo == 'year':
+        return (1/52)
+    if convertFrom == 'week' and convertTo == 'day':
+        return 7
+    if convertFrom == 'month' and convertTo == 'day':
+        return 30
+    if convertFrom == 'year' and convertTo == 'day':
+        return 365
+    if convertFrom == 'month' and convertTo == 'week':
+        return 4
+    if convertFrom == 'year' and convertTo == 'week':
+        return 52
@@ -0,0 +1,150 @@
+""" Gene alias recognition for knockout samples. The gene dict written by
+    wrangle.py (setup_wrangler.geneWrangler(): {GeneID: {'Symbol', 'Aliases'}})
+    is inverted into an alias -> GeneID index, and sample text is tokenized
+    once and looked up token by token (one dict lookup per token, whatever the
+    number of aliases), so that only whole-word gene names are recognized.
+    Genes are reported when they sit next to a KO/knockout token.
+
+    Symbols and aliases are normalized as geneWrangler() does with
+    valsToAlphaNumLower (lowercase, alphanumerics and '+' only), so text tokens
+    are normalized the same way before lookup.
+"""
+import json, os, re
+
+koTokens = {'ko', 'kos', 'knockout', 'knockouts'}
+### Aliases that are also everyday words of GEO sample titles/descriptions
+### (many short mouse aliases are), which would otherwise pass for genes
+stopWords = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'from', 'in', 'into',
+    'is', 'of', 'on', 'or', 'the', 'to', 'with', 'mice', 'mouse', 'wt', 'wild',
+    'type', 'cre', 'tg', 'het', 'hom', 'null', 'mutant', 'control', 'cell',
+    'cells', 'liver', 'brain', 'heart', 'lung', 'male', 'female', 'rep',
+    'replicate', 'day', 'week', 'age', 'double', 'triple', 'conditional',
+    'specific', 'tissue', 'rna', 'dna', 'chip', 'seq', 'sample', 'total'}
+tokenPattern = re.compile(r'[^\s,;:()\[\]{}/|\'"]+')
+tokenSplit = re.compile(r'[-_.]+')
+tokenClean = re.compile(r'[^0-9a-z+]+')
+
+
+class GeneAliasIndex:
+    """ Inverted alias index over a geneWrangler() gene dict.
+
+        Args:
+            geneDict - Dict: {GeneID: {'Symbol': Str, 'Aliases': List}}
+            stopWords - Set: Normalized names never taken as genes
+    """
+    def __init__(self, geneDict, stopWords = stopWords):
+        self.symbols = dict()
+        self.aliases = dict()
+        self.maxWords = 1
+        for geneID, entry in geneDict.items():
+            geneID = str(geneID)
+            names = [(entry.get('Symbol', ''), True)] + [(x, False) for x in
+                entry.get('Aliases', [])]
+            self.symbols[geneID] = normalize(entry.get('Symbol', ''))
+            for name, isSymbol in names:
+                name = ' '.join(normalize(x) for x in str(name).split())
+                if (len(name) < 2 or name.isdigit() or name in stopWords or
+                    name in koTokens):
+                    continue
+                self.maxWords = max(self.maxWords, name.count(' ') + 1)
+                ids = self.aliases.setdefault(name, [set(), set()])
+                ### [GeneIDs with this symbol, GeneIDs with this alias]
+                ids[0 if isSymbol else 1].add(geneID)
+
+    def lookup(self, name):
+        """ GeneIDs for a normalized name: the genes whose symbol it is, else
+            the genes having it as an alias """
+
+        ids = self.aliases.get(name)
+        if ids is None:
+            return set()
+        return ids[0] or ids[1]
+
+    def tokens(self, text):
+        """ Normalized tokens of lowercased text. Hyphenated tokens are kept
+            whole when they name a gene (e.g. 'h2-ab1') or a KO, and split
+            otherwise (e.g. 'pten-ko' -> 'pten', 'ko'). """
+
+        tokens = []
+        for raw in tokenPattern.findall(text):
+            whole = tokenClean.sub('', raw)
+            if whole in self.aliases or whole in koTokens or not \
+                tokenSplit.search(raw):
+                if whole != '':
+                    tokens.append(whole)
+                continue
+            tokens += [x for x in (tokenClean.sub('', part) for part in
+                tokenSplit.split(raw)) if x != '']
+        return tokens
+
+    def koGenes(self, texts, window = 3):
+        """ Symbols of the genes named within window tokens of a KO/knockout
+            token ('knock out' counts as one) in any of texts, in order of
+            appearance. Texts are scanned independently, so a gene at the end
+            of one is never paired with a KO at the start of the next.
+            Genes before the KO token are preferred ('Pten KO'), those after
+            it are taken only if there are none ('knockout of Pten'). """
+
+        found = []
+        for text in texts:
+            text = str(text).lower()
+            ### Most samples have no KO token at all
+            if 'ko' not in text and 'knock' not in text:
+                continue
+            tokens = self.tokens(text)
+            koAt = [i for i, x in enumerate(tokens) if x in koTokens or (x ==
+                'knock' and i + 1 < len(tokens) and tokens[i + 1] == 'out')]
+            if len(koAt) == 0:
+                continue
+            genes = self.genePositions(tokens)
+            for i in koAt:
+                end = i + 2 if tokens[i] == 'knock' else i + 1
+                before = [ids for (start, stop, ids) in genes if stop <= i and
+                    stop > i - window]
+                after = [ids for (start, stop, ids) in genes if start >= end and
+                    start < end + window]
+                for ids in (before or after):
+                    for geneID in sorted(ids):
+                        if self.symbols[geneID] not in found:
+                            found.append(self.symbols[geneID])
+        return found
+
+    def genePositions(self, tokens):
+        """ (start, stop, GeneIDs) of each gene name in tokens, longest names
+            first where multi-word aliases overlap """
+
+        aliases = self.aliases
+        if self.maxWords == 1:
+            return [(i, i + 1, aliases[x][0] or aliases[x][1]) for i, x in
+                enumerate(tokens) if x in aliases]
+
+        genes = []
+        i = 0
+        while i < len(tokens):
+            for n in range(min(self.maxWords, len(tokens) - i), 0, -1):
+                ids = self.lookup(' '.join(tokens[i:i + n]))
+                if ids:
+                    genes.append((i, i + n, ids))
+                    i += n
+                    break
+            else:
+                i += 1
+        return genes
+
+
+def normalize(name):
+    return tokenClean.sub('', str(name).lower())
+
+
+_indexes = dict()
+
+def loadIndex(path):
+    """ GeneAliasIndex of the gene JSON written by wrangle.py, built once per
+        path and reused. None if the file does not exist. """
+
+    if path not in _indexes:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as fin:
+            _indexes[path] = GeneAliasIndex(json.load(fin))
+    return _indexes[path]
@@ -0,0 +1,409 @@
+""" Shared HTTP fetching for GEO, PubMed and publisher pages. Every network
+    request made during metadata extraction should go through fetchText(), so
+    that a single, configurable requests-per-second ceiling is respected no
+    matter how many worker threads are running. NCBI asks for no more than 3
+    requests/sec without an API key (10/sec with one), so limits are kept per
+    host: publisher full-text pages do not eat into the NCBI budget.
+
+    Successful responses are kept in the persistent responseCache, so reruns
+    only touch the network for pages that are new or past their TTL. Cache
+    hits skip the rate limiter entirely. Expired entries that came with an
+    ETag or Last-Modified header are revalidated with a conditional request,
+    and a 304 reuses the cached body. Throttled (429) and server error 
+    responses, dropped connections and truncated bodies are retried with
+    exponential backoff.
+
+    Requests, bytes, latencies, retries and cache lookups are counted per
+    host in runMetrics.
+
+    Setting NCBI_BASE_URL (or calling setBaseURL()) sends every request to
+    that server instead, e.g. the local stand-in in tests/ncbiStandIn.py, with
+    the original URL carried in the path. Cache keys and rate limits still
+    use the original URLs.
+"""
+import os, threading, time, requests
+import multiprocessing as mp
+from urllib.parse import urlparse
+import responseCache, runMetrics
+
+defaultRequestsPerSecond = 3
+
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections = 16,
+    pool_maxsize = 32))
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections = 16,
+    pool_maxsize = 32))
+
+retryStatuses = [429, 500, 502, 503, 504]
+maxRetries = 3
+retryBackoff = 1.0
+
+
+class RateLimiter:
+    """ Thread-safe minimum-interval limiter. wait() blocks until the next
+        request slot is available, so that no more than requestsPerSecond calls
+        return per second across all threads sharing the limiter. A
+        requestsPerSecond of None or 0 disables the limit.
+    """
+    def __init__(self, requestsPerSecond = defaultRequestsPerSecond):
+        self.lock = threading.Lock()
+        self.nextSlot = 0.0
+        self.setRate(requestsPerSecond)
+
+    def setRate(self, requestsPerSecond):
+        if requestsPerSecond:
+            self.interval = 1.0 / requestsPerSecond
+        else:
+            self.interval = 0.0
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.nextSlot)
+            self.nextSlot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SharedRateLimiter(RateLimiter):
+    """ RateLimiter whose next slot lives in shared memory, so one ceiling
+        holds across a pool of worker processes. Create it in the parent and
+        hand it to the workers with installLimiters() as the pool initializer.
+    """
+    def __init__(self, requestsPerSecond = defaultRequestsPerSecond):
+        self.lock = mp.Lock()
+        self.shared = mp.Value('d', 0.0, lock = False)
+        self.setRate(requestsPerSecond)
+
+    def wait(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.shared.value)
+            self.shared.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SingleFlight:
+    """ Per-key memo for the life of a run. The first caller for a key runs
+        fn(), concurrent callers for the same key wait for that call instead of
+        issuing their own, and later callers get the stored result. If the
+        first call raises, a waiting caller retries it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = dict()
+        self.inFlight = dict()
+
+    def do(self, key, fn):
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+            event = self.inFlight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.inFlight[key] = event
+
+        if leader is False:
+            event.wait()
+            return self.do(key, fn)
+
+        try:
+            result = fn()
+            with self.lock:
+                self.results[key] = result
+            return result
+        finally:
+            with self.lock:
+                del self.inFlight[key]
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
+_limiters = dict()
+_limiterLock = threading.Lock()
+
+def setRequestsPerSecond(requestsPerSecond):
+    """ Change the per-host ceiling for all current and future hosts """
+
+    global defaultRequestsPerSecond
+    with _limiterLock:
+        defaultRequestsPerSecond = requestsPerSecond
+        for limiter in _limiters.values():
+            limiter.setRate(requestsPerSecond)
+
+
+def hostLimiter(url):
+    """ Return the RateLimiter for the host of url, creating it on first use """
+
+    host = urlparse(url).netloc
+    with _limiterLock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(defaultRequestsPerSecond)
+        return _limiters[host]
+
+
+def setHostRate(host, requestsPerSecond):
+    """ Change the ceiling of one host only, e.g. a non-NCBI site scraped
+        with its own limit """
+
+    hostLimiter('//' + host).setRate(requestsPerSecond)
+
+
+ncbiHosts = ['eutils.ncbi.nlm.nih.gov', 'www.ncbi.nlm.nih.gov']
+
+def sharedLimiters(hosts = ncbiHosts, requestsPerSecond = None):
+    """ SharedRateLimiters for hosts, to be passed to installLimiters() in each
+        worker process """
+
+    if requestsPerSecond is None:
+        requestsPerSecond = defaultRequestsPerSecond
+    return {host: SharedRateLimiter(requestsPerSecond) for host in hosts}
+
+
+def installLimiters(limiters):
+    """ Use the given {host: limiter} in this process, e.g. as the initializer 
+        of a process pool so that all workers share the parent's limits """
+
+    with _limiterLock:
+        _limiters.update(limiters)
+
+
+baseURL = os.environ.get('NCBI_BASE_URL') or None
+
+def setBaseURL(url):
+    """ Send all requests to the server at url (None for the real hosts). Also
+        exported as NCBI_BASE_URL, for worker processes started later """
+
+    global baseURL
+    baseURL = url.rstrip('/') if url else None
+    if baseURL is None:
+        os.environ.pop('NCBI_BASE_URL', None)
+    else:
+        os.environ['NCBI_BASE_URL'] = baseURL
+
+
+def rewriteURL(url):
+    """ URL to request for url: url itself, or with a base URL set,
+        '<base>/<scheme>/<host><path>?<query>' (also for ftp:// URLs) """
+
+    if baseURL is None:
+        return url
+    scheme, rest = url.split('://', 1)
+    return '{0}/{1}/{2}'.format(baseURL, scheme, rest)
+
+
+cache = None
+cacheEnabled = True
+
+def configureCache(path = None, maxBytes = None, ttls = None, enabled = True):
+    """ Replace the shared cache, e.g. to point a run at another file, change
+        the size cap or TTLs, or switch caching off with enabled = False """
+
+    global cache, cacheEnabled
+    kwargs = dict()
+    if path is not None:
+        kwargs['path'] = path
+    if maxBytes is not None:
+        kwargs['maxBytes'] = maxBytes
+    cache = responseCache.ResponseCache(ttls = ttls, **kwargs)
+    cacheEnabled = enabled
+
+
+def getCache():
+    global cache
+    if cache is None:
+        cache = responseCache.ResponseCache()
+    return cache
+
+
+def cachedContent(key):
+    """ Cached body bytes for key (a URL or other stable key), or None """
+
+    if cacheEnabled is False:
+        return None
+    hit = getCache().get(responseCache.cacheKey(key))
+    runMetrics.count('cache_lookups_total', host = runMetrics.hostOf(key),
+        result = 'miss' if hit is None else 'hit')
+    if hit is None:
+        return None
+    return hit[0]
+
+
+def storeContent(key, body, encoding = None, resource = None, negative = None):
+    """ Store body bytes under key, for responses fetched outside of
+        fetchContent() (e.g. results that are split out of batched requests).
+        negative = True stores a "not found" entry, kept for the cache's
+        negativeTTL """
+
+    if cacheEnabled is True:
+        getCache().put(responseCache.cacheKey(key), body, encoding = encoding,
+            resource = resource, negative = negative)
+
+
+def readCapped(resp, maxBytes = None, timeout = None):
+    """ Read a streamed response body, stopping at maxBytes (the body is cut
+        there) and raising requests.exceptions.Timeout once timeout seconds 
+        have passed in total """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    chunks, size = [], 0
+    try:
+        for chunk in resp.iter_content(chunk_size = 65536):
+            chunks.append(chunk)
+            size += len(chunk)
+            if maxBytes is not None and size >= maxBytes:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                raise requests.exceptions.Timeout('Reading {0} took over {1} '
+                    'seconds'.format(resp.url, timeout))
+    finally:
+        resp.close()
+    body = b''.join(chunks)
+    if maxBytes is not None:
+        body = body[:maxBytes]
+    return body
+
+
+def requestOnce(url, headers = None, maxBytes = None, timeout = None):
+    """ One GET of url: (response, body bytes, text encoding) """
+
+    if maxBytes is None and timeout is None:
+        resp = session.get(url, headers = headers)
+        body = resp.content
+        encoding = resp.encoding or resp.apparent_encoding
+    else:
+        resp = session.get(url, headers = headers, stream = True, 
+            timeout = timeout)
+        body = readCapped(resp, maxBytes = maxBytes, timeout = timeout)
+        encoding = resp.encoding or requests.compat.chardet.detect(
+            body)['encoding']
+    return resp, body, encoding
+
+
+def fetchResponse(url, headers = None, resource = None, useCache = True,
+    cacheKey = None, maxBytes = None, timeout = None, revalidate = False,
+    raiseForStatus = False):
+    """ Return (body bytes, text encoding) for url, from the cache if possible.
+        cacheKey stores the response under a stable key other than the URL,
+        for URLs that carry session state (e.g. E-utilities WebEnv). maxBytes
+        cuts the body at that size and timeout caps the whole download, for
+        pages that can be very large (publisher full texts). revalidate checks
+        cached entries with the server even if they have not expired (a
+        conditional request, so unchanged pages are not downloaded again).
+        Error responses (4xx/5xx, once retries run out) are returned like any
+        other, unless raiseForStatus raises them as requests' HTTPError, for
+        callers that would take an error page for an empty result """
+
+    key = responseCache.cacheKey(cacheKey or url)
+    host = runMetrics.hostOf(url)
+    stale = None
+    if useCache is True and cacheEnabled is True:
+        if revalidate is False:
+            hit = getCache().get(key)
+            runMetrics.count('cache_lookups_total', host = host, result = 
+                'miss' if hit is None else 'hit')
+            if hit is not None:
+                return hit
+        stale = getCache().getStale(key)
+        if stale is not None and stale[2] is None and stale[3] is None:
+            stale = None
+
+    if stale is not None:
+        headers = dict(headers or dict())
+        if stale[2] is not None:
+            headers['If-None-Match'] = stale[2]
+        if stale[3] is not None:
+            headers['If-Modified-Since'] = stale[3]
+
+    for attempt in range(maxRetries + 1):
+        hostLimiter(url).wait()
+        start = time.perf_counter()
+        try:
+            resp, body, encoding = requestOnce(rewriteURL(url), headers = headers,
+                maxBytes = maxBytes, timeout = timeout)
+        except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError) as e:
+            runMetrics.count('http_requests_total', host = host, status =
+                type(e).__name__)
+            if attempt == maxRetries:
+                raise
+            runMetrics.count('http_retries_total', host = host, reason =
+                type(e).__name__)
+            time.sleep(retryBackoff * 2 ** attempt)
+            continue
+        finally:
+            runMetrics.observe('http_request_seconds', time.perf_counter() -
+                start, host = host)
+        runMetrics.count('http_requests_total', host = host, status =
+            resp.status_code)
+        runMetrics.count('http_response_bytes_total', len(body), host = host)
+        if resp.status_code not in retryStatuses or attempt == maxRetries:
+            break
+        runMetrics.count('http_retries_total', host = host, reason =
+            resp.status_code)
+        retryAfter = resp.headers.get('Retry-After', '')
+        time.sleep(float(retryAfter) if retryAfter.isdigit() else 
+            retryBackoff * 2 ** attempt)
+
+    if stale is not None:
+        runMetrics.count('cache_revalidations_total', host = host, result = 
+            'unchanged' if resp.status_code == 304 else 'changed')
+        if resp.status_code == 304:
+            getCache().touch(key)
+            return stale[0], stale[1]
+
+    if raiseForStatus is True and not resp.ok:
+        raise requests.exceptions.HTTPError('{0} for {1}'.format(
+            resp.status_code, url), response = resp)
+
+    if useCache is True and cacheEnabled is True and resp.ok and \
+        resp.status_code != 304:
+        getCache().put(key, body, encoding = encoding, resource = resource,
+            etag = resp.headers.get('ETag'), modified = resp.headers.get(
+            'Last-Modified'))
+
+    return body, encoding
+
+
+def fetchContent(url, headers = None, resource = None, useCache = True,
+    cacheKey = None, maxBytes = None, timeout = None, revalidate = False,
+    raiseForStatus = False):
+    """ Cached, rate-limited equivalent of requests.get(url).content """
+
+    return fetchResponse(url, headers = headers, resource = resource, 
+        useCache = useCache, cacheKey = cacheKey, maxBytes = maxBytes,
+        timeout = timeout, revalidate = revalidate, 
+        raiseForStatus = raiseForStatus)[0]
+
+
+def fetchText(url, headers = None, resource = None, useCache = True,
+    cacheKey = None, maxBytes = None, timeout = None, revalidate = False,
+    raiseForStatus = False):
+    """ Cached, rate-limited equivalent of requests.get(url).text """
+
+    body, encoding = fetchResponse(url, headers = headers, resource = resource,
+        useCache = useCache, cacheKey = cacheKey, maxBytes = maxBytes, 
+        timeout = timeout, revalidate = revalidate, 
+        raiseForStatus = raiseForStatus)
+    return str(body, encoding or 'utf-8', errors = 'replace')
+
+
+def isTransient(err):
+    """ True if err is a request failure that may pass on a later run: a
+        connection error, timeout or cut-off body, or an HTTPError 
+        (raiseForStatus) with one of the retryStatuses. Anything else, such as
+        a page that does not parse, fails the same way every time. """
+
+    if isinstance(err, requests.exceptions.HTTPError):
+        return (err.response is not None and err.response.status_code in
+            retryStatuses)
+    return isinstance(err, requests.exceptions.RequestException)
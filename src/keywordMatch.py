@@ -0,0 +1,89 @@
+""" Multi-pattern keyword matching (Aho-Corasick) for the cell, cell-sort and
+    sex vocabularies checked against GEO sample fields. All vocabularies are
+    compiled into one automaton, so a text field is scanned once, in time
+    linear in its length, no matter how many terms are looked for; enriching
+    a vocabulary (e.g. with a full cell-line list) does not slow the scan.
+    Matching is plain substring matching, as with `term in text`. Building a
+    matcher costs time in the size of its vocabularies, so callers build
+    theirs once (e.g. at import) and reuse it, rather than per sample.
+"""
+from collections import deque
+
+
+class KeywordMatcher:
+    """ Aho-Corasick automaton over labelled vocabularies.
+
+        Args:
+            vocabularies - Dict: label to list of terms, e.g.
+                {'cell': ['DMEM', 'FBS'], 'sort': ['FACS']}
+            ignoreCase - Bool: Match case-insensitively
+    """
+    def __init__(self, vocabularies, ignoreCase = False):
+        self.ignoreCase = ignoreCase
+        self.labels = list(vocabularies)
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [[]]
+
+        for label, terms in vocabularies.items():
+            for term in terms:
+                if len(term) == 0:
+                    continue
+                if ignoreCase is True:
+                    term = term.lower()
+                state = 0
+                for char in term:
+                    nextState = self.goto[state].get(char)
+                    if nextState is None:
+                        nextState = len(self.goto)
+                        self.goto.append(dict())
+                        self.fail.append(0)
+                        self.out.append([])
+                        self.goto[state][char] = nextState
+                    state = nextState
+                self.out[state].append((label, term))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nextState in self.goto[state].items():
+                queue.append(nextState)
+                failState = self.fail[state]
+                while failState and char not in self.goto[failState]:
+                    failState = self.fail[failState]
+                self.fail[nextState] = self.goto[failState].get(char, 0)
+                if self.fail[nextState] == nextState:
+                    self.fail[nextState] = 0
+                self.out[nextState] = (self.out[nextState] +
+                    self.out[self.fail[nextState]])
+
+    def finditer(self, text):
+        """ Yield (start, label, term) for every occurrence of every term """
+
+        if self.ignoreCase is True:
+            text = text.lower()
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for label, term in out[state]:
+                yield i - len(term) + 1, label, term
+
+    def scan(self, text):
+        """ {label: set of terms found in text}, for labels with any hit """
+
+        hits = dict()
+        for start, label, term in self.finditer(text):
+            hits.setdefault(label, set()).add(term)
+        return hits
+
+    def search(self, text, label = None):
+        """ True if any term (of label, if given) occurs in text """
+
+        for start, hitLabel, term in self.finditer(text):
+            if label is None or hitLabel == label:
+                return True
+        return False
+
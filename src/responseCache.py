@@ -0,0 +1,199 @@
+""" Persistent on-disk cache of HTTP response bodies, keyed by URL. GSM, GSE,
+    PubMed and publisher pages rarely change, yet every run used to download
+    them again. Entries live in a single SQLite file (WAL mode), so several
+    processes and threads can read and write the same cache at once. Each
+    entry is tagged with a resource type that decides its time-to-live, the
+    file is capped in size with least-recently-used eviction, and GEO "not
+    found" pages are cached as negative entries with their own, shorter TTL.
+    The ETag/Last-Modified validators of a response are stored with it, so
+    that expired entries can be revalidated with a conditional request (see
+    geoFetch.fetchResponse()) instead of downloaded again.
+"""
+import os, re, sqlite3, threading, time, urllib.parse
+
+day = 86400
+
+defaultPath = os.environ.get('METADATA_CACHE', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'refFiles', 'httpCache.sqlite'))
+
+### Time-to-live in seconds per resource type, None never expires
+defaultTTLs = {'gsm': 90 * day, 'gse': 30 * day, 'eutils': 30 * day,
+    'pubmed': 90 * day, 'fulltext': 180 * day, 'diet': 30 * day,
+    'other': 7 * day}
+
+negativeMarkers = ['Could not find a public or private accession']
+
+resourcePatterns = [('gsm', re.compile(r'acc\.cgi\?acc=GSM', re.I)),
+    ('gse', re.compile(r'acc\.cgi\?acc=GSE', re.I)),
+    ('eutils', re.compile(r'eutils\.ncbi\.nlm\.nih\.gov', re.I)),
+    ('pubmed', re.compile(r'ncbi\.nlm\.nih\.gov/pubmed', re.I)),
+    ('diet', re.compile(r'researchdiets\.com', re.I))]
+
+
+def resourceType(url):
+    """ Classify a URL into one of the defaultTTLs resource types """
+
+    for resource, pattern in resourcePatterns:
+        if pattern.search(url):
+            return resource
+    return 'other'
+
+
+def cacheKey(url):
+    """ API keys change request quotas, not content, and should not be written
+        to disk, so they are dropped from the key. The other parameters are
+        kept as written (not requoted), so that a URL with and without a key
+        map to the same entry. """
+
+    parts = urllib.parse.urlsplit(url)
+    params = parts.query.split('&')
+    kept = [x for x in params if x.split('=', 1)[0] != 'api_key']
+    if len(kept) == len(params):
+        return url
+    return urllib.parse.urlunsplit(parts._replace(query = '&'.join(kept)))
+
+
+class ResponseCache:
+    """ SQLite-backed response store. get() returns (body, encoding) for a
+        fresh entry or None, put() stores a body and evicts the least recently
+        used entries once the file grows past maxBytes.
+
+        Args:
+            path - Str: SQLite file, created on first use
+            maxBytes - Int: Total size cap of stored bodies
+            ttls - Dict: Resource type to TTL seconds, merged over defaultTTLs
+            negativeTTL - Int: TTL of "not found" pages, regardless of type
+    """
+    def __init__(self, path = defaultPath, maxBytes = 2 * 1024 ** 3, ttls = None,
+        negativeTTL = 7 * day):
+        self.path = os.path.abspath(path)
+        self.maxBytes = maxBytes
+        self.ttls = dict(defaultTTLs)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.negativeTTL = negativeTTL
+        self.local = threading.local()
+
+    def connection(self):
+        """ One connection per thread and per process; sqlite connections
+            cannot be shared across either """
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        conn = sqlite3.connect(self.path, timeout = 60, isolation_level = None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY '
+            'KEY, resource TEXT, body BLOB, encoding TEXT, size INTEGER, '
+            'negative INTEGER, stored REAL, accessed REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS accessedIndex ON '
+            'responses (accessed)')
+        ### Validator columns, added to caches created before they existed
+        columns = [x[1] for x in conn.execute('PRAGMA table_info(responses)')]
+        for column in ['etag', 'modified']:
+            if column not in columns:
+                try:
+                    conn.execute('ALTER TABLE responses ADD COLUMN {0} '
+                        'TEXT'.format(column))
+                except sqlite3.OperationalError:
+                    ### Added by another process in the meantime
+                    pass
+        conn.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY '
+            'KEY, size INTEGER)')
+        conn.execute('INSERT OR IGNORE INTO totals VALUES (0, 0)')
+        self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def ttl(self, resource, negative):
+        if negative:
+            return self.negativeTTL
+        return self.ttls.get(resource, self.ttls['other'])
+
+    def get(self, key):
+        conn = self.connection()
+        row = conn.execute('SELECT body, encoding, resource, negative, stored '
+            'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        body, encoding, resource, negative, stored = row
+        ttl = self.ttl(resource, negative)
+        if ttl is not None and time.time() - stored > ttl:
+            return None
+
+        conn.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+            (time.time(), key))
+        return body, encoding
+
+    def getStale(self, key):
+        """ (body, encoding, etag, modified) of an entry, fresh or expired,
+            or None. Negative entries are not returned. """
+
+        row = self.connection().execute('SELECT body, encoding, etag, modified '
+            'FROM responses WHERE key = ? AND negative = 0', (key,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def touch(self, key):
+        """ Restart the TTL of an entry, once revalidated as unchanged """
+
+        now = time.time()
+        self.connection().execute('UPDATE responses SET stored = ?, accessed = ? '
+            'WHERE key = ?', (now, now, key))
+
+    def put(self, key, body, encoding = None, resource = None, etag = None,
+        modified = None, negative = None):
+        """ negative marks a "not found" entry, detected from negativeMarkers
+            if None """
+
+        if resource is None:
+            resource = resourceType(key)
+        if negative is None:
+            negative = any(x.encode() in body for x in negativeMarkers)
+        now = time.time()
+
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO responses (key, resource, '
+                'body, encoding, size, negative, stored, accessed, etag, '
+                'modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (key, 
+                resource, body, encoding, len(body), int(negative), now, now,
+                etag, modified))
+            conn.execute('UPDATE totals SET size = size + ? WHERE id = 0',
+                (len(body) - (old[0] if old else 0),))
+            total = conn.execute('SELECT size FROM totals WHERE id = 0'
+                ).fetchone()[0]
+            if total > self.maxBytes:
+                self.evict(conn, total)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def evict(self, conn, total):
+        """ Drop least recently used entries until the total is at most 90% of
+            maxBytes """
+
+        target = int(self.maxBytes * 0.9)
+        while total > target:
+            rows = conn.execute('SELECT key, size FROM responses ORDER BY '
+                'accessed LIMIT 500').fetchall()
+            if len(rows) == 0:
+                total = 0
+                break
+            for key, size in rows:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                total -= size
+                if total <= target:
+                    break
+        conn.execute('UPDATE totals SET size = ? WHERE id = 0', (total,))
+
+    def clear(self):
+        conn = self.connection()
+        conn.execute('DELETE FROM responses')
+        conn.execute('UPDATE totals SET size = 0 WHERE id = 0')
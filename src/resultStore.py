@@ -0,0 +1,127 @@
+""" Append-only store of per-sample extraction results, so that a run can be
+    stopped at any point and resumed without losing finished samples. Results
+    are written to a SQLite file as they come in, and committed (and fsynced)
+    every commitEvery records or commitSeconds seconds, whichever comes first.
+    Excluded samples (multi-channel, cells, organism mismatch, invalid
+    accession) are recorded as well, so reruns skip them without refetching.
+    Look-ups only touch the requested sample IDs, so start-up and checkpoint
+    cost do not grow with the size of the corpus.
+
+    The JSON file used downstream (e.g. by studyAgeViz.R) is written on
+    request by exportJSON(), streamed from the store.
+"""
+import json, os, sqlite3, time
+
+validStatuses = ['ok', 'excluded', 'error']
+
+
+class ResultStore:
+    """ SQLite-backed result log, keyed by sample ID.
+
+        Args:
+            path - Str: SQLite file, created on first use
+            commitEvery - Int: Commit after this many records
+            commitSeconds - Float: Commit once this long has passed since the
+                last commit, checked as records come in
+    """
+    def __init__(self, path, commitEvery = 100, commitSeconds = 30):
+        self.path = os.path.abspath(path)
+        self.commitEvery = commitEvery
+        self.commitSeconds = commitSeconds
+        self.uncommitted = 0
+        self.lastCommit = time.monotonic()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        self.conn = sqlite3.connect(self.path, timeout = 60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (sampleID TEXT '
+            'PRIMARY KEY, status TEXT, meta TEXT, message TEXT, updated REAL)')
+        self.conn.commit()
+
+    def record(self, sampleID, status, meta = None, message = None):
+        """ Store the outcome of one sample, replacing any earlier one """
+
+        if status not in validStatuses:
+            raise ValueError('status must be in {0}'.format(validStatuses))
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+            (sampleID, status, json.dumps(meta) if meta is not None else None,
+            message, time.time()))
+        self.uncommitted += 1
+        if (self.uncommitted >= self.commitEvery or
+            time.monotonic() - self.lastCommit >= self.commitSeconds):
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+        self.lastCommit = time.monotonic()
+
+    def recorded(self, sampleIDs, statuses = ['ok', 'excluded']):
+        """ The subset of sampleIDs already stored with one of statuses """
+
+        sampleIDs = list(sampleIDs)
+        found = set()
+        for i in range(0, len(sampleIDs), 500):
+            chunk = sampleIDs[i:i + 500]
+            rows = self.conn.execute('SELECT sampleID FROM results WHERE '
+                'sampleID IN ({0}) AND status IN ({1})'.format(','.join('?' *
+                len(chunk)), ','.join('?' * len(statuses))), chunk +
+                list(statuses)).fetchall()
+            found.update(x[0] for x in rows)
+        return found
+
+    def get(self, sampleID):
+        """ Stored metadata of an 'ok' sample, or None """
+
+        row = self.conn.execute('SELECT meta FROM results WHERE sampleID = ? '
+            'AND status = ?', (sampleID, 'ok')).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def iterResults(self, status = 'ok'):
+        """ (sampleID, meta or message) of every sample with status """
+
+        for sampleID, meta, message in self.conn.execute('SELECT sampleID, '
+            'meta, message FROM results WHERE status = ?', (status,)):
+            if status == 'ok':
+                yield sampleID, json.loads(meta)
+            else:
+                yield sampleID, message
+
+    def importJSON(self, path):
+        """ One-off load of a metaDict JSON file (the old output format) as 'ok'
+            results, only if the store is still empty """
+
+        if self.conn.execute('SELECT 1 FROM results LIMIT 1').fetchone():
+            return 0
+        with open(path, 'r') as fin:
+            metaDict = json.load(fin)
+        for sampleID, meta in metaDict.items():
+            self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, '
+                '?, ?)', (sampleID, 'ok', json.dumps(meta), None, time.time()))
+        self.commit()
+        return len(metaDict)
+
+    def exportJSON(self, path):
+        """ Write all 'ok' results as {sampleID: meta}, laid out exactly like
+            json.dump(metaDict, fout, indent = 4), without holding them all in
+            memory. Written to a temporary file first and moved into place. """
+
+        self.commit()
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as fout:
+            fout.write('{')
+            first = True
+            for sampleID, meta in self.iterResults('ok'):
+                fout.write('\n' if first else ',\n')
+                first = False
+                fout.write('    {0}: {1}'.format(json.dumps(sampleID),
+                    json.dumps(meta, indent = 4).replace('\n', '\n    ')))
+            fout.write('}' if first else '\n}')
+        os.replace(tmpPath, path)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,272 @@
+""" Run-level metrics for the metadataExtract and gds_scraper_mt pipelines:
+    HTTP requests, bytes, latencies and retries per host, response cache hits,
+    CPU and wall time per pipeline stage, age source tiers and warning counts.
+    Everything is collected in-process into the module-level `metrics` and
+    written at the end of a run as a JSON report and, optionally, as a
+    Prometheus textfile (for node_exporter's textfile collector).
+
+    Warnings raised per sample (wide age ranges, missing PMIDs, unmatched
+    sections...) are counted by kind with warn() and only the first of each
+    kind is printed, instead of one print per sample in the hot loops.
+
+    Worker processes report back with drain() (their counts since the last
+    drain), which the parent adds to its own with merge(). A worker's metrics
+    set to relay keep their warnings for the parent, which prints the first of
+    each kind over the whole run.
+"""
+import contextlib, functools, json, os, threading, time
+from urllib.parse import urlparse
+
+latencyBuckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+prometheusPrefix = 'metadata_'
+
+
+def hostOf(url):
+    return urlparse(url).netloc or 'unknown'
+
+
+def metricKey(name, labels):
+    return name, tuple(sorted((k, str(v)) for (k, v) in labels.items()))
+
+
+class RunMetrics:
+    """ Thread-safe counters and histograms keyed by (name, labels), where
+        labels is a sorted tuple of (label, value as str) pairs.
+
+        Args:
+            verbose - Bool: Print every warning rather than the first of each
+                kind
+            relay - Bool: Keep warnings to print for drain() instead of
+                printing them, in worker processes
+    """
+    def __init__(self, verbose = False, relay = False):
+        self.lock = threading.Lock()
+        self.verbose = verbose
+        self.relay = relay
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+            self.warned = set()
+            self.relayed = []
+            self.started = time.time()
+
+    def count(self, name, value = 1, **labels):
+        key = metricKey(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets = latencyBuckets, **labels):
+        """ Add value to the histogram name. Bucket counts are per bucket
+            (not cumulative) with a final +Inf bucket. """
+
+        key = metricKey(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': list(buckets),
+                    'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            i = 0
+            while i < len(hist['buckets']) and value > hist['buckets'][i]:
+                i += 1
+            hist['counts'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Count a call of stage name and its CPU (of the calling thread) and
+            wall time. Nested stages are each counted in full. """
+
+        cpuStart, wallStart = time.thread_time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count('stage_cpu_seconds', time.thread_time() - cpuStart,
+                stage = name)
+            self.count('stage_wall_seconds', time.perf_counter() - wallStart,
+                stage = name)
+            self.count('stage_calls', stage = name)
+
+    def timed(self, name):
+        """ Decorator running the function as stage name """
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def warn(self, kind, message = None):
+        """ Count a warning of kind, printing message for the first one of
+            each kind (every one with verbose). Without a message the warning
+            is only counted. """
+
+        self.count('warnings_total', kind = kind)
+        if message is None:
+            return
+        self.announce(kind, message)
+
+    def announce(self, kind, message):
+        """ Print (or with relay, keep for drain()) message if it is the first
+            warning of kind, or with verbose """
+
+        with self.lock:
+            first = kind not in self.warned
+            self.warned.add(kind)
+            if (first or self.verbose is True) and self.relay is True:
+                self.relayed.append((kind, message))
+                return
+        if first or self.verbose is True:
+            print('{0}{1}'.format(message, '' if self.verbose is True else
+                ' (further "{0}" warnings are counted in the run metrics)'
+                .format(kind)))
+
+    def snapshot(self):
+        """ Picklable copy of the counters, histograms, warned kinds and
+            relayed warnings """
+
+        with self.lock:
+            return {'counters': dict(self.counters), 'histograms': {k:
+                dict(v, counts = list(v['counts'])) for (k,v) in
+                self.histograms.items()}, 'warned': set(self.warned),
+                'relayed': list(self.relayed)}
+
+    def drain(self):
+        """ snapshot() and reset the counts and relayed warnings, for worker
+            processes that report to the parent after each job. The warned
+            kinds are kept, so a worker relays each kind once. """
+
+        with self.lock:
+            snap = {'counters': self.counters, 'histograms': self.histograms,
+                'warned': set(self.warned), 'relayed': self.relayed}
+            self.counters, self.histograms, self.relayed = dict(), dict(), []
+        return snap
+
+    def merge(self, snap):
+        """ Add a snapshot() or drain() taken in another process, printing
+            its relayed warnings of kinds not warned of yet """
+
+        with self.lock:
+            for key, value in snap['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snap['histograms'].items():
+                hist = self.histograms.get(key)
+                if hist is None:
+                    self.histograms[key] = dict(other, counts =
+                        list(other['counts']))
+                    continue
+                hist['counts'] = [a + b for (a, b) in zip(hist['counts'],
+                    other['counts'])]
+                hist['sum'] += other['sum']
+                hist['count'] += other['count']
+        for kind, message in snap.get('relayed', []):
+            self.announce(kind, message)
+        with self.lock:
+            self.warned.update(snap['warned'])
+
+    def total(self, name, **labels):
+        """ Sum of counter name over all label sets matching labels """
+
+        with self.lock:
+            return sum(v for ((n, l), v) in self.counters.items() if n == name
+                and all(x in l for x in metricKey(name, labels)[1]))
+
+    def report(self):
+        """ The run's metrics as a JSON-able dict """
+
+        snap = self.snapshot()
+        finished = time.time()
+        counters = dict()
+        for (name, labels), value in sorted(snap['counters'].items()):
+            counters.setdefault(name, []).append({'labels': dict(labels),
+                'value': value})
+        histograms = dict()
+        for (name, labels), hist in sorted(snap['histograms'].items()):
+            histograms.setdefault(name, []).append({'labels': dict(labels),
+                'buckets': hist['buckets'], 'counts': hist['counts'],
+                'sum': hist['sum'], 'count': hist['count']})
+
+        cacheHitRate = dict()
+        lookups = dict()
+        for (name, labels), value in snap['counters'].items():
+            if name == 'cache_lookups_total':
+                labels = dict(labels)
+                hits, allLookups = lookups.get(labels['host'], (0, 0))
+                lookups[labels['host']] = (hits + (value if labels['result'] ==
+                    'hit' else 0), allLookups + value)
+        for host, (hits, allLookups) in sorted(lookups.items()):
+            cacheHitRate[host] = hits / allLookups if allLookups else None
+
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+            time.localtime(self.started)), 'finished': time.strftime(
+            '%Y-%m-%dT%H:%M:%S', time.localtime(finished)), 'elapsedSeconds':
+            finished - self.started, 'cacheHitRate': cacheHitRate, 'counters':
+            counters, 'histograms': histograms}
+
+    def prometheusText(self):
+        """ The counters and histograms in the Prometheus text format """
+
+        snap = self.snapshot()
+        lines = []
+
+        def labelText(labels, extra = ()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\',
+                '\\\\').replace('"', '\\"')) for (k, v) in labels) + '}'
+
+        typed = set()
+        for (name, labels), value in sorted(snap['counters'].items()):
+            metric = prometheusPrefix + name
+            if metric not in typed:
+                lines.append('# TYPE {0} counter'.format(metric))
+                typed.add(metric)
+            lines.append('{0}{1} {2}'.format(metric, labelText(labels), value))
+        for (name, labels), hist in sorted(snap['histograms'].items()):
+            metric = prometheusPrefix + name
+            if metric not in typed:
+                lines.append('# TYPE {0} histogram'.format(metric))
+                typed.add(metric)
+            cumulative = 0
+            for bound, n in zip(hist['buckets'] + ['+Inf'], hist['counts']):
+                cumulative += n
+                lines.append('{0}_bucket{1} {2}'.format(metric, labelText(labels,
+                    [('le', bound)]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(metric, labelText(labels),
+                hist['sum']))
+            lines.append('{0}_count{1} {2}'.format(metric, labelText(labels),
+                hist['count']))
+        return '\n'.join(lines) + '\n'
+
+    def writeJSON(self, path):
+        writeAtomic(path, json.dumps(self.report(), indent = 4) + '\n')
+
+    def writePrometheus(self, path):
+        """ Written to a temporary file and renamed, as the textfile collector
+            expects """
+
+        writeAtomic(path, self.prometheusText())
+
+
+def writeAtomic(path, text):
+    if os.path.dirname(path) != '':
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmpPath = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmpPath, 'w') as fout:
+        fout.write(text)
+    os.replace(tmpPath, path)
+
+
+metrics = RunMetrics()
+
+count = metrics.count
+observe = metrics.observe
+stage = metrics.stage
+timed = metrics.timed
+warn = metrics.warn
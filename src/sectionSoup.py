@@ -0,0 +1,72 @@
+""" Shared full-text page handling for the PMID tier of age extraction
+    (maxSectionMatch/findSectionText, in both the metadataExtract and the
+    gds_scraper_mt pipelines). Candidate full-text links are fetched
+    concurrently with a size and time cap per page, and each page is parsed
+    once, with lxml when it is installed, into a soup that is shared by all the
+    h1/h2/h6 header attempts and by the final section split.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup, NavigableString
+import requests
+import geoFetch, runMetrics
+
+try:
+    import lxml
+    soupParser = 'lxml'
+except ImportError:
+    soupParser = 'html.parser'
+
+maxPageBytes = 8 * 1024 ** 2
+pageTimeout = 60
+
+
+def fetchPages(links, headers = None, maxWorkers = 4, maxBytes = maxPageBytes,
+    timeout = pageTimeout):
+    """ Lowercased text of each link, in the order of links, or None for links
+        that could not be fetched. Pages are cut at maxBytes, and a download
+        taking over timeout seconds counts as failed. """
+
+    def fetch(link):
+        try:
+            return geoFetch.fetchText(link, headers = headers, resource =
+                'fulltext', maxBytes = maxBytes, timeout = timeout).lower()
+        except requests.exceptions.RequestException as e:
+            runMetrics.warn('fetchFailed', 'Could not fetch {0}: {1}'.format(
+                link, e))
+            return None
+
+    if len(links) <= 1:
+        return [fetch(link) for link in links]
+    with ThreadPoolExecutor(max_workers = min(maxWorkers, len(links))) as pool:
+        return list(pool.map(fetch, links))
+
+
+def parsePage(text):
+    return BeautifulSoup(text, features = soupParser)
+
+
+def sectionHeaders(soup, soupDiv):
+    """ Section header elements of a page for one header attempt: h1/h2
+        headings, or div containers with the h6 class """
+
+    if soupDiv in ['h1', 'h2']:
+        return soup.find_all(soupDiv)
+    elif soupDiv in ['h6']:
+        return soup.find_all('div', class_ = soupDiv)
+    return []
+
+
+def sectionCounts(soup, soupAttempts, possibleSections):
+    """ {attempt: number of (header, section name) pairs where the header has
+        a direct text child equal to the section name}, i.e. the count of
+        `name in header` over headers and names """
+
+    counts = dict()
+    for attempt in soupAttempts:
+        linkCount = 0
+        for sec in sectionHeaders(soup, attempt):
+            children = set(str(x) for x in sec.contents if isinstance(x,
+                NavigableString))
+            linkCount += len([x for x in possibleSections if x in children])
+        counts[attempt] = linkCount
+    return counts
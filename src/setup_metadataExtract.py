@@ -1,41 +1,140 @@
 import re, requests, os, random, sys 
 import numpy as np
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import geoFetch, sectionSoup, keywordMatch, runMetrics
+### Age parsing lives in ageEngine, shared with gds_scraper_mt
+from ageEngine import (numberDict, timeReDict, numericTimeConvert, 
+    checkTimeUnits, ageComponents, wideRangeCheck, numericTimeConvertBatch, 
+    enumAgeStrings, timeConversions)
 defaultAgent = {'User-Agent': 'SomeAgent 11.0'}
 
-numberDict = {'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
-    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'eleven': 11,
-    'twelve': 12, 'thirteen': 13, 'fourteen': 14, 'fifteen': 15, 'sixteen': 16,
-    'seventeen': 17, 'eighteen': 18, 'nineteen': 19, 'twenty': 20, 'thirty': 30,
-    'forty': 40, 'fifty': 50, 'sixty': 60, 'seventy': 70, 'eighty': 80,
-    'ninety': 90, 'hundred': 100, 'thousand': 1000, 'million': 1000000,
-    'billion': 1000000000, 'point': '.'}
-
-timeReDict = {'day': {'timeMatch1': r'[ \-]day', 'timeMatch2': r'[ \-]d[ \.s\,]', 
-                        'timeMatch3': r'[ \-]d[ \.s\,]?$', 'timeSub1': r' ?days?', 
-                        'timeSub2': r' ?ds?', 'flagRange': 84},
-            'week': {'timeMatch1': r'[ \-]week', 'timeMatch2': r'[ \-]wk[ \.s\,]',
-                        'timeMatch3': r'[ \-]wk[ \.s\,]?$', 'timeSub1': r' ?weeks?', 
-                        'timeSub2': r' ?wks?', 'flagRange': 12},
-            'month': {'timeMatch1': r'[ \-]month', 'timeMatch2': r'[ \-]mo[ \.s\,]', 
-                        'timeMatch3': r'[ \-]mo[ \.s\,]?$', 'timeSub1': r' ?months?', 
-                        'timeSub2': r' ?mos?', 'flagRange': 3},
-            'year': {'timeMatch1': r'[ \-]year', 'timeMatch2': r'[ \-]yr[ \.s\,]', 
-                        'timeMatch3': r'[ \-]yr[ \.s\,]?$', 'timeSub1': r' ?years?', 
-                        'timeSub2': r' ?yrs?', 'flagRange': 0.25}}
+tagStrip = re.compile(r'<.*?>|\\n')
+rowIDPattern = re.compile(r'\<td nowrap\>(.*)\<\/td\>')
+sampleIDPattern = re.compile(r'acc\=(GSM\d+)\"')
+charAgePattern = re.compile(r'\<br\>age\:(.*)\<br\>')
+seriesLabel = re.compile(r'Series \(\d+\)')
+genderTerms = {'female': ['female ', 'females'], 'male': ['male ', 'males']}
+cellDetectTerms = ['DMEM', 'FBS', 'bovine serum', 'passage']
+sortDetectTerms = ['CD4+', 'T cells', 'sort-purified', 'cell-sort', 'FACS',
+    'cell sorting', 'flow cytometry']
+### The default cell, cell-sort and sex vocabularies, compiled once. Checks
+### called with other vocabularies build their own matcher; pass it in as
+### keywords to build it once.
+defaultVocabularies = dict({'cell': cellDetectTerms, 'sort': sortDetectTerms},
+    **genderTerms)
+sampleKeywords = keywordMatch.KeywordMatcher(defaultVocabularies)
+
+class SampleExcluded(Exception):
+    """ extractGEOSampleInfo() leaves the sample out on purpose (invalid
+        accession, other organism, multi-channel, cells), as opposed to
+        failing on it. Recorded as 'excluded' by metadataExtract.py, and not
+        retried. """
+
+class InvalidSample(SampleExcluded, ValueError):
+    """ Not a public GEO sample, or a sample of another organism """
+
+class FilteredSample(SampleExcluded, AttributeError):
+    """ Multi-channel or cell sample, with those not kept """
+
+class SamplePage:
+    """ A GEO accession page (GSM, or GSE, which shares the same table layout)
+        parsed once. Tags are stripped a single time and every row label of 
+        the page table is indexed against the line holding its value, so that
+        extractors look fields up instead of re-cleaning and re-scanning the 
+        full page with their own regexes. A row label is a line ending in a 
+        single space (the stripped '</td>'), e.g. 'Characteristics ', and its 
+        value is the next line. All extractors accept either raw page text or
+        a SamplePage.
 
+        Args:
+            urlText - Str: requests.get(sampleID).text
+    """
+    def __init__(self, urlText):
+        self.text = urlText
+        self.cleanText = tagStrip.sub(' ', urlText)
+        self.lines = self.cleanText.split('\n')
+        self.fields = dict()
+        for i, line in enumerate(self.lines[:-1]):
+            if line.endswith(' '):
+                self.fields.setdefault(line[:-1].lstrip(), []).append(i + 1)
+        self.rowIDs = rowIDPattern.findall(urlText)
+        self.sampleIDs = set(sampleIDPattern.findall(urlText))
+        self.series = [x for label in self.fields if seriesLabel.fullmatch(label)
+            for x in self.fields[label]]
+        self.series.sort()
+        self.scans = dict()
+
+    @classmethod
+    def parse(cls, urlText):
+        """ Return urlText unchanged if already parsed, otherwise parse it """
+
+        if isinstance(urlText, cls):
+            return urlText
+        return cls(urlText)
+
+    def values(self, label, lead = '', trail = '', closed = True):
+        """ Values of every row labelled `label`, in page order, keeping those
+            that start with `lead` and end with `trail` (both removed). closed 
+            requires the value line to be newline-terminated. """
+
+        return self.lineValues(self.fields.get(label, []), lead = lead, 
+            trail = trail, closed = closed)
+
+    def value(self, label, lead = '', trail = '', closed = True):
+        """ First of values(), or None """
+
+        found = self.values(label, lead = lead, trail = trail, closed = closed)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def lineValues(self, indices, lead = '', trail = '', closed = True):
+        found = []
+        for i in indices:
+            line = self.lines[i]
+            if closed is True and i == len(self.lines) - 1:
+                continue
+            if (len(line) >= len(lead) + len(trail) and line.startswith(lead) 
+                and line.endswith(trail)):
+                found.append(line[len(lead):len(line) - len(trail)])
+        return found
+
+    def seriesIDs(self):
+        """ GSE IDs listed under the 'Series (n)' row(s) """
+
+        return self.lineValues(self.series, lead = '     ', trail = '  ')
+
+    def keywordHits(self, text, matcher):
+        """ (start, label, term) of every matcher term in text, scanned once
+            per text and matcher, so the cell, sort and gender checks share
+            one pass over each field """
+
+        key = (id(matcher), text)
+        if key not in self.scans:
+            self.scans[key] = list(matcher.finditer(text))
+        return self.scans[key]
+
+    def charAge(self):
+        """ Raw 'age:' entry of the Characteristics row, or None """
+
+        ageMatch = charAgePattern.search(self.text)
+        if ageMatch is None:
+            return None
+        return ageMatch.group(1)
+
+@runMetrics.timed('extractGEOSampleInfo')
 def extractGEOSampleInfo(sampleID, organism = 'Mus musculus', extracts = ['ID', 
     'Study', 'Organism', 'Sample type', 'Extracted molecule', 'Age', 'Gender', 
     'Expression', 'Cells'], keepCells = True, cellDetectChar = 'cell lines?\:', 
-    cellDetectProt = ['DMEM', 'FBS', 'bovine serum', 'passage'],  
-    parseCellIDs = ['Treatment', 'Growth'], keepMultiChannel = False, 
+    cellDetectProt = cellDetectTerms, parseCellIDs = ['Treatment', 'Growth'],
+    keepMultiChannel = False, 
     parseAgeIDs = ['Characteristics', 'Description', 'Treatment protocol', 
     'Growth protocol'], convertAgeTo = 'week', checkAgeConverts = ['day', 'week',
     'month', 'year'], nullReturn = 'n/a', tryAgeStudy = True,
     parseStudyIDs = ['Summary', 'Overall design'], tryAgePMID = True,
     pmidSection = 'methods', flagRange = True, flagSort = True,
-    sortDetectProt = ['CD4+', 'T cells', 'sort-purified', 'cell-sort', 'FACS',
-    'cell sorting', 'flow cytometry']):
+    sortDetectProt = sortDetectTerms, keywords = None):
     """ Extract metadata from a GEO GSM ID. Options to keep detected
         in vitro samples, and to exclude multichannel expression assays (e.g. 
         microarrays). Not all structured entries need to be parsed, however
@@ -72,46 +171,61 @@ def extractGEOSampleInfo(sampleID, organism = 'Mus musculus', extracts = ['ID',
                 value. Default to 'methods'
             flagSort: Bool - Flag potential cell-sort protocols
             sortDetect: List - List of cell-sort tags, use geoSampleCellCheck()
+            keywords - KeywordMatcher: cellDetectProt under 'cell',
+                sortDetectProt under 'sort' and the genderTerms labels.
+                sampleKeywords for the default vocabularies, else built per
+                call if not given
             
         Returns:
             meta - Dict: Items in extracts for sampleID
+
+        Raises requests' HTTPError if GEO answers with an error rather than
+        the sample page (see geoFetch.isTransient()).
     """
     url = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={0}'.format(sampleID)
-    urlGetText = requests.get(url).text
+    urlGetText = geoFetch.fetchText(url, raiseForStatus = True)
 
     if 'Could not find a public or private accession' in urlGetText:
-        raise ValueError('Is {0} a valid GEO sample?'.format(sampleID))
+        raise InvalidSample('Is {0} a valid GEO sample?'.format(sampleID))
     
-    IDs = [x for x in re.findall('\<td nowrap\>(.*)\<\/td\>', urlGetText)]
+    page = SamplePage(urlGetText)
+    if keywords is None:
+        if cellDetectProt is cellDetectTerms and sortDetectProt is sortDetectTerms:
+            keywords = sampleKeywords
+        else:
+            keywords = keywordMatch.KeywordMatcher(dict({'cell': 
+                cellDetectProt, 'sort': sortDetectProt}, **genderTerms))
+    IDs = page.rowIDs
     misMatches = [x for x in extracts if x not in IDs + ['ID', 'Study', 'Age', 
         'Gender', 'Expression', 'Cells']]
     if len(misMatches) > 0:
-        print('Warning, {0} IDs not found. Will be returned as null'.format(misMatches))
-
-    cleanText = re.sub(r'<.*?>|\\n', ' ', urlGetText) 
+        runMetrics.warn('extractsNotFound', 'Warning, {0} IDs not found. Will '
+            'be returned as null'.format(misMatches))
 
     if keepMultiChannel == False:
-        if 'Channel 1' in cleanText and 'Channel 2' in cleanText:
-            raise AttributeError('Multi-channel not allowed!')
+        if 'Channel 1' in page.cleanText and 'Channel 2' in page.cleanText:
+            raise FilteredSample('Multi-channel not allowed!')
     
     if keepCells == False:
-        if geoSampleCellCheck(urlText = cleanText, cellDetectChar = cellDetectChar,
-            cellDetectProt = cellDetectProt, protocolEntries = parseCellIDs):
-            raise AttributeError('Cells not allowed!')
+        if geoSampleCellCheck(urlText = page, cellDetectChar = cellDetectChar,
+            cellDetectProt = cellDetectProt, protocolEntries = parseCellIDs,
+            keywords = keywords):
+            raise FilteredSample('Cells not allowed!')
 
-    GEOOrganism = re.findall(r'Organism \n  (.*)  \n', cleanText)[0]
+    GEOOrganism = page.values('Organism', lead = '  ', trail = '  ')[0]
     if GEOOrganism != organism:
-        raise ValueError('Organism mismatch for sample {0}'.format(sampleID))
+        raise InvalidSample('Organism mismatch for sample {0}'.format(sampleID))
 
-    sampType = re.findall(r'Sample type \n (.*) \n', cleanText)[0]
-    moleExtract = re.findall(r'Extracted molecule \n (.*) \n', cleanText)[0]
+    sampType = page.values('Sample type', lead = ' ', trail = ' ')[0]
+    moleExtract = page.values('Extracted molecule', lead = ' ', trail = ' ')[0]
 
     meta = dict()
     meta['Flags'] = dict()
     if flagSort is True:
-        meta['Flags']['Sort'] = geoSampleCellCheck(urlText = cleanText, 
+        meta['Flags']['Sort'] = geoSampleCellCheck(urlText = page, 
             cellDetectChar = 'null', cellDetectProt = sortDetectProt, 
-            protocolEntries = parseCellIDs)
+            protocolEntries = parseCellIDs, keywords = keywords,
+            label = 'sort')
     else:
         meta['Flags']['Sort'] = False
 
@@ -119,8 +233,7 @@ def extractGEOSampleInfo(sampleID, organism = 'Mus musculus', extracts = ['ID',
         if extract == 'ID':
             meta[extract] = sampleID
         elif extract == 'Study':
-            meta[extract] = re.findall(r'Series \(\d+\) \n     (.*)  \n', 
-                cleanText)[0]
+            meta[extract] = page.seriesIDs()[0]
         elif extract == 'Sample type':
             meta[extract] = sampType
         elif extract == 'Extracted molecule':
@@ -128,34 +241,68 @@ def extractGEOSampleInfo(sampleID, organism = 'Mus musculus', extracts = ['ID',
         elif extract == 'Organism':
             meta[extract] = GEOOrganism
         elif extract == 'Age':
-            meta[extract], ageSource, flagged = geoAgeExtract(urlText = urlGetText, 
+            meta[extract], ageSource, flagged = geoAgeExtract(urlText = page, 
                     parseAgeIDs = parseAgeIDs, convertTo = convertAgeTo, 
                     nullReturn = nullReturn, checkConverts = checkAgeConverts,
                     tryAgeStudy = tryAgeStudy, parseStudyIDs = parseStudyIDs,
                     tryAgePMID = tryAgePMID, pmidSection = pmidSection,
                     flagRange = flagRange)
             meta['Age Source'] = ageSource
+            runMetrics.count('age_source_total', source = ageSource, found = 
+                meta[extract] != nullReturn)
             meta['Flags']['Age'] = flagged
         elif extract == 'Gender':
-            meta[extract] = geoGenderExtract(urlGetText)
+            meta[extract] = geoGenderExtract(page, keywords = keywords)
         elif extract == 'Expression':
             if ('RNA' in sampType or 'RNA' in moleExtract):
                 meta[extract] = True
             else:
                 meta[extract] = False
         elif extract == 'Cells':
-            meta[extract] = geoSampleCellCheck(urlText = cleanText, 
+            meta[extract] = geoSampleCellCheck(urlText = page, 
                 cellDetectChar = cellDetectChar, cellDetectProt = cellDetectProt, 
-                protocolEntries = parseCellIDs)
+                protocolEntries = parseCellIDs, keywords = keywords)
         else:
             meta[extract] = nullReturn
     
     return meta
 
 
+def extractGEOSampleInfoBatch(sampleIDs, maxWorkers = 8, requestsPerSecond = 3,
+    **kwargs):
+    """ Run extractGEOSampleInfo() over many GSM IDs concurrently. Nearly all of
+        the time spent per sample is network idle (GSM page, then GSE, PubMed
+        and full-text fallbacks), so a thread pool keeps several samples in
+        flight while geoFetch holds all of them under one requests-per-second
+        ceiling per host. Per-sample results are identical to calling
+        extractGEOSampleInfo() sequentially; only the completion order differs.
+
+        Args:
+            sampleIDs - List: GSM IDs
+            maxWorkers - Int: Number of samples processed at once
+            requestsPerSecond - Float: Per-host request ceiling. NCBI allows
+                3/sec without an API key, 10/sec with one
+            kwargs: Passed through to extractGEOSampleInfo()
+
+        Yields:
+            (sampleID, meta, err) as each sample finishes. meta is None and err
+                holds the raised exception if extraction failed
+    """
+    geoFetch.setRequestsPerSecond(requestsPerSecond)
+
+    with ThreadPoolExecutor(max_workers = maxWorkers) as pool:
+        futures = {pool.submit(extractGEOSampleInfo, sampleID = sample,
+            **kwargs): sample for sample in sampleIDs}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as err:
+                yield futures[future], None, err
+
+
 def geoSampleCellCheck(urlText, cellDetectChar = 'cell lines?\:', 
-    cellDetectProt = ['DMEM', 'FBS', 'bovine serum', 'passage'], 
-    protocolEntries = ['Treatment', 'Growth'], nullReturn = False):
+    cellDetectProt = cellDetectTerms, protocolEntries = ['Treatment', 'Growth'],
+    nullReturn = False, keywords = None, label = 'cell'):
     """ Boolean check for presence of cells in a GEO sample (GSM) in either the 
         'Characteristics' or protocols entries. nullReturn is in the event that
         cells are not detected in characteristics, nor are the protocol entries
@@ -165,29 +312,40 @@ def geoSampleCellCheck(urlText, cellDetectChar = 'cell lines?\:',
         cells does not likely correspond to age in a meaningful way.
 
         Args:
-            urlText - Str: requests.get(sampleID).text
+            urlText - Str/SamplePage: requests.get(sampleID).text
             cellDetectChar - Str: Regex for cell detection under "Characteristics"
             cellDetectProt - List: Common keywords to indicate in vitro assays 
             protocolEntries - List: Protocol entries to check for cellDetectProt
                 items
+            keywords - KeywordMatcher: Matcher holding cellDetectProt under 
+                label, e.g. one shared with the sort and gender checks. 
+                sampleKeywords for a default vocabulary, else built from 
+                cellDetectProt if not given
+            label - Str: Vocabulary label of cellDetectProt in keywords
         Return:
             bool
     """
-    cleanText = re.sub(r'<.*?>|\\n', ' ', urlText)
-    if re.findall(r'Characteristics \n(.*)\n', cleanText):
-        if re.findall(cellDetectChar, re.findall(r'Characteristics \n(.*)\n', 
-            cleanText)[0]):
+    page = SamplePage.parse(urlText)
+    if keywords is None:
+        if defaultVocabularies.get(label) is cellDetectProt:
+            keywords = sampleKeywords
+        else:
+            keywords = keywordMatch.KeywordMatcher({label: cellDetectProt})
+    charText = page.value('Characteristics')
+    if charText is not None:
+        if re.search(cellDetectChar, charText):
             return True 
 
     for prot in protocolEntries:
-        if re.findall('{0} protocol \n(.*)\n'.format(prot), cleanText):
-            if any([x for x in cellDetectProt if x in re.findall('{0} protocol \n(.*)\n'.format(prot), 
-                cleanText)[0]]):
+        protText = page.value('{0} protocol'.format(prot))
+        if protText is not None:
+            if any(x[1] == label for x in page.keywordHits(protText, keywords)):
                 return True
 
     return False
 
 
+@runMetrics.timed('geoAgeExtract')
 def geoAgeExtract(urlText, checkCell = True, parseAgeIDs = ['Characteristics',
      'Description', 'Treatment protocol', 'Growth protocol'], convertTo = 'week',
     nullReturn = 'n/a', checkConverts = ['day', 'week', 'month', 'year'],
@@ -202,7 +360,7 @@ def geoAgeExtract(urlText, checkCell = True, parseAgeIDs = ['Characteristics',
         conversion dictionary pre-defined in globals().
             
         Args:   
-            urlText: Str - requests.get(sampleID).text
+            urlText: Str/SamplePage - requests.get(sampleID).text
             parseAgeIDs: List - Entries within url text
             convertTo: Str - Converted time units ['day', 'week', 'month', 'year']
             nullReturn: Str - Return if no numbers found
@@ -222,29 +380,27 @@ def geoAgeExtract(urlText, checkCell = True, parseAgeIDs = ['Characteristics',
                 checked, a la flagRange arg
     """
     flagged = False
-    if geoSampleCellCheck(urlText) is True and checkCell == True:
+    page = SamplePage.parse(urlText)
+    if geoSampleCellCheck(page) is True and checkCell == True:
         return nullReturn, nullReturn, flagged
 
     ageCounter, charAge, flags = [], nullReturn, []
     
-    cleanText = re.sub(r'<.*?>|\\n', ' ', urlText)
     for i in parseAgeIDs:
-        if re.findall('({0}) \n (.*)'.format(i), cleanText):
-            matches = list(re.findall('({0}) \n (.*)'.format(i), cleanText))[0]
-            if len(matches) > 1:
-                if i == 'Characteristics' and 'age:' in matches[1]:
-                    ageMatch = re.findall('\<br\>age\:(.*)\<br\>', urlText)[0]
-                    charAge, iRange = numericTimeConvert(text = ageMatch, 
-                        convertTo = convertTo, nullReturn = nullReturn,
-                        flagRange = flagRange)
-                    flags.append(iRange)
-
-                elif i != 'Characteristics':
-                    iAge, iRange = numericTimeConvert(text = matches[1], 
-                        convertTo = convertTo, nullReturn = nullReturn,
-                        flagRange = flagRange)
-                    ageCounter.append(iAge)
-                    flags.append(iRange)
+        match = page.value(i, lead = ' ', closed = False)
+        if match is not None:
+            if i == 'Characteristics' and 'age:' in match:
+                charAge, iRange = numericTimeConvert(text = page.charAge(), 
+                    convertTo = convertTo, nullReturn = nullReturn,
+                    flagRange = flagRange)
+                flags.append(iRange)
+
+            elif i != 'Characteristics':
+                iAge, iRange = numericTimeConvert(text = match, 
+                    convertTo = convertTo, nullReturn = nullReturn,
+                    flagRange = flagRange)
+                ageCounter.append(iAge)
+                flags.append(iRange)
 
     ageCounter = [x for x in ageCounter if x != nullReturn]
 
@@ -264,12 +420,12 @@ def geoAgeExtract(urlText, checkCell = True, parseAgeIDs = ['Characteristics',
         return sum(ageCounter), 'Sample', flagged
     else:
         if tryAgeStudy is True:
-            gseAttempt, flagged = gseAgeExtract(urlText = urlText, 
+            gseAttempt, flagged = gseAgeExtract(urlText = page, 
                 convertTo = convertTo, checkConverts = checkConverts, 
                 parseIDs = parseStudyIDs, nullReturn = nullReturn, 
                 flagRange = flagRange)
             if gseAttempt == nullReturn and tryAgePMID is True:
-                pmidAttempt, flagged = pmidAgeExtract(urlText = urlText, 
+                pmidAttempt, flagged = pmidAgeExtract(urlText = page, 
                     sectionID = pmidSection, convertTo = convertTo, 
                     checkConverts = checkConverts, nullReturn =  nullReturn,
                     flagRange = flagRange)
@@ -283,272 +439,7 @@ def geoAgeExtract(urlText, checkCell = True, parseAgeIDs = ['Characteristics',
             return nullReturn, 'Sample', flagged
 
 
-def numericTimeConvert(text, convertTo = 'week', checkConverts = ['day', 'week', 
-    'month', 'year'], nullReturn = 'n/a', flagRange = True):
-    """ Convert text into a numerical time. Some general rules: Check will be 
-        made for a range of numbers, e.g. 12-13, and averaged. If no match, then 
-        check for single numbers, e.g. 12. However, if "for|after" is in front of 
-        this number, then it will be added to other numeric matches (e.g. "12 
-        weeks old for 2 weeks" == 14). Currently only able to process
-        days, weeks, months, and years (shorter time units are typically reserved
-        for exposures, such as a drug, rather than the animal's age). The regexes
-        are read in from a built-in internal dictionary (timeReDict). Additionally,
-        extremely wide time ranges can be flagged, as some experiments may only
-        sacrifice mice as they reach a certain physiological state, which could
-        vary months, and thus would be uninformative to extract a "true" age.
-
-        Args:
-            text: Str - text to be parsed
-            convertTo: Str - Converted time units ['day', 'week', 'month', 'year']
-            nullReturn: Str - Return if no numbers found
-            checkConverts: List - Time units to convert to convertTo unit
-            flagRange: Bool - Flag a unexpectedly wide range with a printout.
-                The range will be read on the built-in timeReDict dictionary.
-        
-        Return:
-            numSum - Float - Converted number in the text (to weeks) from average
-                of total ages plus durations
-            flagged: Bool - If requested, a T/F flag for wide age ranges
-        
-    TODO: add sentence split, excl terms (cell-stuff)
-    """
-    flagged = False
-    if text == nullReturn:
-        return nullReturn, flagged
-
-    checkConverts = [re.sub('s$', '', x.lower()) for x in checkConverts]
-    convertTo = re.sub('s$', '', convertTo.lower())
-
-    if (any([x for x in checkConverts if x not in ['day', 'week', 'month', 'year']]) or
-        convertTo not in ['day', 'week', 'month', 'year']):
-        raise ValueError("Times must be in ['day', 'week', 'month', 'year']")
-    
-    text = re.sub('(\D)\-(\D)', '\\1 \\2', text) #keep '7-8', convert 'seven-week'
-    text = re.sub('(\d+)\-(\D)', '\\1 \\2', text).lower()
-    
-    nums, durs  = [], []
-        
-    for convertFrom in checkConverts:
-        
-        re1, re2 = timeReDict[convertFrom]['timeSub1'], timeReDict[convertFrom]['timeSub2']
-        timeSub = re.compile('(\d+\.?\d?){0}(\-\d+\.?\d?{0})|(\d+\.?\d?){1}(\-\d+\.?\d?{1})'.format(re1, re2))
-        timeSpacer1 = re.compile('(\d+\.?\d?){0}(\-\d+\.?\d?{1})'.format(re1, re2))
-        timeSpacer2 = re.compile('(\d+\.?\d?){0}(\-\d+\.?\d?{1})'.format(re2, re1))
-        timeSpacer3 = re.compile('(\d+\.?\d?)({0})'.format(re1))
-        timeSpacer4 = re.compile('(\d+\.?\d?)({0})'.format(re2))
-        if timeSub.findall(text):
-            textUse = ''.join([x for x in timeSub.findall(text)[0]])
-        else:
-            textUse = text
-
-        if timeSpacer1.findall(textUse):
-            textUse = timeSpacer1.sub('\\1\\2', textUse)    
-        elif timeSpacer2.findall(textUse):
-            textUse = timeSpacer2.sub('\\1\\2', textUse)    
-        elif timeSpacer3.findall(textUse):
-            textUse = timeSpacer3.sub('\\1 \\2', textUse)    
-        elif timeSpacer4.findall(textUse):
-            textUse = timeSpacer4.sub('\\1 \\2', textUse)    
-        
-        splitWords = textUse.lower().strip().split()
-        strToNumConvert = []
-        for word in splitWords:
-            if word in numberDict:
-                strToNumConvert.append(str(numberDict[word]))
-            else:
-                strToNumConvert.append(word)
-        strToNumConvert = ' '.join(strToNumConvert)
-        
-        nums, durs = enumAgeStrings(nums, durs, strToNumConvert = strToNumConvert, 
-            convertFrom = convertFrom, convertTo = convertTo)
-        
-    if len(nums) > 0:
-        
-        if flagRange is True:
-            nums.sort()
-            for i, j in enumerate(nums):
-                if i+1 != len(nums):
-                    if (nums[i+1] - nums[i]) > timeReDict[convertTo]['flagRange']:
-                        print('Warning, very wide range of ages found ({0} to '
-                            '{1} {2})'.format(nums[i], nums[i+1], convertTo))
-                        flagged = True
-
-        numSum = np.nanmean(nums)
-        if len(durs) > 0:
-            if flagRange is True:
-                durs.sort()
-                for i, j in enumerate(durs):
-                    if i+1 != len(durs):
-                        if (durs[i+1] - durs[i]) > timeReDict[convertTo]['flagRange']:
-                            print('Warning, very wide range of durations found ({0} to '
-                                '{1} {2})'.format(durs[i], durs[i+1], convertTo))
-                            flagged = True    
-            
-            numSum += np.nansum(durs)
-
-        if numSum == 0:
-            return nullReturn, flagged
-        else:
-            return numSum, flagged
-
-    elif len(nums) == 0 and len(durs) > 0:
-        if flagRange is True:
-                durs.sort()
-                for i, j in enumerate(durs):
-                    if i+1 != len(durs):
-                        if (durs[i+1] - durs[i]) > timeReDict[convertTo]['flagRange']:
-                            print('Warning, very wide range of durations found ({0} to '
-                                '{1} {2})'.format(durs[i], durs[i+1], convertTo))
-                            flagged = True    
-            
-        numSum = np.nansum(durs)
-        if numSum == 0:
-            return nullReturn, flagged
-        else:
-            return numSum, flagged
-
-    elif len(nums) == 0 and len(durs) == 0:
-        return nullReturn, flagged
-
-
-def enumAgeStrings(nums, durs, strToNumConvert, convertFrom = 'day', 
-    convertTo = 'week'):
-    """ Find instances of time, and convert to a quantitative value (perhaps of 
-        another time unit). Add time matches to counter, converted. Checks made 
-        for durations, e.g. "for 2 weeks", and if found, these are added to nums.
-        For other matches, checks are made for multiple numbers (12-13 weeks), 
-        and if found, these are averaged. Assume no ranges are reported for the 
-        duration (e.g. no instances of "adminstered for 2-3 weeks"). Arguments
-        for convertFrom and convertTo are checked in numericTimeConvert().
-
-        Args:
-            nums: Float - counter (in weeks)
-            strToNumConvert: Str - string, presumably converted words to integers
-            convertFrom: Str - Any of ['day', 'week', 'month', 'year]
-            convertTo: Str - Any of ['day', 'week', 'month', 'year] 
-        Returns:
-            Updated nums
-    """
-    convertCoef = timeConversions(convertFrom = convertFrom, convertTo = convertTo)
-
-    re1 = timeReDict[convertFrom]['timeMatch1']
-    re2 = timeReDict[convertFrom]['timeMatch2']
-    re3 = timeReDict[convertFrom]['timeMatch3']
-
-    timeMatches1 = re.compile('(?<!for )(\d+\-?\d+?){0}|(?<!for )(\d+\-?\d+?){1}|'
-                '(?<!for )(\d+){0}|(?<!for )(\d+){1}|(?<!for )(\d+\.?\d+?){0}|'
-                '(?<!for )(\d+\.?\d+?){1}|(?<!for )(\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                '(?<!for )(\d+\.?\d+?\-\d+\.?\d+?){1}|(?<!after )(\d+\-?\d+?){0}|'
-                '(?<!after )(\d+\-?\d+?){1}|(?<!after )(\d+){0}|(?<!after )(\d+){1}|'
-                '(?<!after )(\d+\.?\d+?){0}|(?<!after )(\d+\.?\d+?){1}|'
-                '(?<!after )(\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                '(?<!after )(\d+\.?\d+?\-\d+\.?\d+?){1}'.format(re1, re2))
-
-    timeMatches2 = re.compile('(?<!for )(\d+\-?\d+?){0}|(?<!for )(\d+\-?\d+?){1}|'
-                '(?<!for )(\d+){0}|(?<!for )(\d+){1}|(?<!for )(\d+\.?\d+?){0}|'
-                '(?<!for )(\d+\.?\d+?){1}|(?<!for )(\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                '(?<!for )(\d+\.?\d+?\-\d+\.?\d+?){1}|'
-                '(?<!after )(\d+\-?\d+?){0}|(?<!after )(\d+\-?\d+?){1}|'
-                '(?<!after )(\d+){0}|(?<!after )(\d+){1}|(?<!after )(\d+\.?\d+?){0}|'
-                '(?<!after )(\d+\.?\d+?){1}|(?<!after )(\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                '(?<!after )(\d+\.?\d+?\-\d+\.?\d+?){1}'.format(re1, re3))
-
-    timeMatchesDur1 = re.compile('for (\d+\-?\d+?){0}|for (\d+\-?\d+?){1}|'
-                'for (\d+){0}|for (\d+){1}|for (\d+\.?\d+?){0}|for (\d+\.?\d+?){1}|'
-                'for (\d+\.?\d+?\-\d+\.?\d+?){0}|for (\d+\.?\d+?\-\d+\.?\d+?){1}|'
-                'after (\d+\-?\d+?){0}|after (\d+\-?\d+?){1}|'
-                'after (\d+){0}|after (\d+){1}|after (\d+\.?\d+?){0}|'
-                'after (\d+\.?\d+?){1}|after (\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                'after (\d+\.?\d+?\-\d+\.?\d+?){1}'.format(re1, re2))
-
-    timeMatchesDur2 = re.compile('for (\d+\-?\d+?){0}|for (\d+\-?\d+?){1}|'
-                'for (\d+){0}|for (\d+){1}|for (\d+\.?\d+?){0}|for (\d+\.?\d+?){1}|'
-                'for (\d+\.?\d+?\-\d+\.?\d+?){0}|for (\d+\.?\d+?\-\d+\.?\d+?){1}|'
-                'after (\d+\-?\d+?){0}|after (\d+\-?\d+?){1}|'
-                'after (\d+){0}|after (\d+){1}|after (\d+\.?\d+?){0}|'
-                'after (\d+\.?\d+?){1}|after (\d+\.?\d+?\-\d+\.?\d+?){0}|'
-                'after (\d+\.?\d+?\-\d+\.?\d+?){1}'.format(re1, re3))
-    
-    if timeMatches1.findall(strToNumConvert):
-        times = set(timeMatches1.findall(strToNumConvert))
-    elif timeMatches2.findall(strToNumConvert):
-        times = set(timeMatches2.findall(strToNumConvert)) 
-    else:
-        times = [] 
-
-    if timeMatchesDur1.findall(strToNumConvert):
-        timeDurs = set(timeMatchesDur1.findall(strToNumConvert))
-    elif timeMatchesDur2.findall(strToNumConvert):
-        timeDurs = set(timeMatchesDur2.findall(strToNumConvert))   
-    else:
-        timeDurs = []
-    
-    for match in times:
-        for x in match:
-            if len(x.split('-')) == 2:
-                try:
-                    nums.append(np.mean([float(n) for n in x.split('-') if float(n) not in timeDurs])*convertCoef)
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-            else:
-                try:
-                    if x not in [''.join(x) for x in timeDurs]:
-                        nums.append(float(x)*convertCoef)
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-
-    for match in timeDurs:
-        for x in match:
-            if len(x.split('-')) == 2:
-                try:
-                    durs.append(np.mean([float(n) for n in x.split('-')])*convertCoef)
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-            else:
-                try:
-                    durs.append(float(x)*convertCoef)
-                except ValueError:
-                    continue
-                except Exception as err:
-                    print(str(err))
-    
-    return nums, durs
-
-
-def timeConversions(convertFrom, convertTo):
-    """ Return coefficients of converting from e.g. days to weeks. Inherits from
-        addAgeStrings. Some matches are approximate (30 days per month) """
-    
-    if convertFrom == convertTo:
-        return 1 
-    if convertFrom == 'day' and convertTo == 'week':
-        return (1/7)
-    if convertFrom == 'day' and convertTo == 'month':
-        return (1/30)
-    if convertFrom == 'day' and convertTo == 'year':
-        return (1/365)
-    if convertFrom == 'week' and convertTo == 'month':
-        return (1/4)
-    if convertFrom == 'week' and convertTo == 'year':
-        return (1/52)
-    if convertFrom == 'week' and convertTo == 'day':
-        return 7
-    if convertFrom == 'month' and convertTo == 'day':
-        return 30
-    if convertFrom == 'year' and convertTo == 'day':
-        return 365
-    if convertFrom == 'month' and convertTo == 'week':
-        return 4
-    if convertFrom == 'year' and convertTo == 'week':
-        return 52
-
-
+@runMetrics.timed('gseAgeExtract')
 def gseAgeExtract(urlText, convertTo = 'week', 
     checkConverts = ['day', 'week', 'month', 'year'], 
     parseIDs = ['Summary', 'Overall design'], nullReturn = 'n/a',
@@ -568,17 +459,15 @@ def gseAgeExtract(urlText, convertTo = 'week',
     flagged = False
     ageCounter, charAge, flags = [], nullReturn, []
 
-    newText = sampToGSEText(urlText)
-    cleanText = re.sub(r'<.*?>|\\n', ' ', newText)
+    gsePage = sampToGSEPage(urlText)
     for i in parseIDs:
-        if re.findall('({0}) \n (.*)'.format(i), cleanText):
-            matches = list(re.findall('({0}) \n (.*)'.format(i), cleanText))[0]
-            if len(matches) > 1:
-                iAge, iRange = numericTimeConvert(text = matches[1], 
-                        convertTo = convertTo, nullReturn = nullReturn, 
-                        flagRange = flagRange)
-                ageCounter.append(iAge)
-                flags.append(iRange)
+        match = gsePage.value(i, lead = ' ', closed = False)
+        if match is not None:
+            iAge, iRange = numericTimeConvert(text = match, 
+                    convertTo = convertTo, nullReturn = nullReturn, 
+                    flagRange = flagRange)
+            ageCounter.append(iAge)
+            flags.append(iRange)
 
     ageCounter = [x for x in ageCounter if x != nullReturn]
     if flagRange is True:
@@ -600,9 +489,17 @@ def gseAgeExtract(urlText, convertTo = 'week',
 
 
 def sampToGSEText(urlText):
-    """ Extract the GEO study ID from a GSM/sample request get """
+    """ Extract the GEO study ID from a GSM/sample request get, and return the
+        text of that study's page """
+
+    return sampToGSEPage(urlText).text
+
 
-    sampleID = set(re.findall(r'acc\=(GSM\d+)\"', urlText))
+def sampToGSEPage(urlText):
+    """ As sampToGSEText(), returning the parsed SamplePage of the study """
+
+    page = SamplePage.parse(urlText)
+    sampleID = page.sampleIDs
     if len(sampleID) > 1:
         raise Exception('Multiple sample IDs found under GEO GSM page')
     elif len(sampleID) == 0:
@@ -612,21 +509,20 @@ def sampToGSEText(urlText):
             raise Exception('Sample ID extraction from GEO GSM page failed')
         sampleID = list(sampleID)[0]
 
-    cleanText = re.sub(r'<.*?>|\\n', ' ', urlText) 
-    GSEExtract = re.findall(r'Series \(\d+\) \n     (.*)  \n', cleanText)
+    GSEExtract = page.seriesIDs()
 
     if len(GSEExtract) == 0:
         raise Exception('No GSE study IDs found from GEO GSM page')
 
     elif len(GSEExtract) > 1:
-        print('Warning, multiple GSEs found for a samples url text. An attempt '
-            'will be made to select the study with the sample in the sample list')
+        runMetrics.warn('multipleGSEs', 'Warning, multiple GSEs found for a '
+            'samples url text. An attempt will be made to select the study with '
+            'the sample in the sample list')
         
         matched = False 
         for GSE in GSEExtract:
-            url = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={0}'.format(GSE)
-            newText = requests.get(url).text
-            if sampleID in newText:
+            newPage = fetchGSEPage(GSE)
+            if sampleID in newPage.text:
                 matched = True 
                 break
         
@@ -635,46 +531,70 @@ def sampToGSEText(urlText):
                 'GSE studies')
         
     elif len(GSEExtract) == 1: 
-        url = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={0}'.format(GSEExtract[0])
-        newText = requests.get(url).text
+        newPage = fetchGSEPage(GSEExtract[0])
+
+    return newPage 
+
+
+gseTextMemo = geoFetch.SingleFlight()
+
+def fetchGSEPage(GSE):
+    """ GSE study page, fetched and parsed at most once per accession for the
+        life of a run. Every sample of a series resolves to the same study page
+        (twice per sample when both gseAgeExtract and pmidAgeExtract run), and
+        concurrent workers asking for the same series wait on a single request.
+        Call gseTextMemo.clear() to start a fresh run in the same process.
+        An error response is raised, not parsed (nor memoized). """
+
+    url = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={0}'.format(GSE)
+    return gseTextMemo.do(GSE, lambda: SamplePage(geoFetch.fetchText(url,
+        raiseForStatus = True)))
 
-    return newText 
+
+def fetchGSEText(GSE):
+    """ Text of fetchGSEPage() """
+
+    return fetchGSEPage(GSE).text
 
 
 def geoGenderExtract(urlText, protocolEntries = ['Treatment', 'Growth'], 
-    nullReturn = 'n/a'):
+    nullReturn = 'n/a', keywords = None):
     """ Male/female check for a GEO sample (GSM) in either the 'Characteristics' 
         or protocols entries. May need adjustment for non-mammals (e.g. 
         hermaphrodites in C elegans)
 
         Args:
-            urlText - Str: requests.get(sampleID).text
-            cellDetectChar - Str: Regex for cell detection under "Characteristics"
-            cellDetectProt - List: Common keywords to indicate in vitro assays 
+            urlText - Str/SamplePage: requests.get(sampleID).text
+            protocolEntries - List: Protocol entries to check after 
+                'Characteristics'
+            keywords - KeywordMatcher: Matcher holding the genderTerms labels,
+                sampleKeywords by default
 
         Return:
             'Male'/'Female'/nullReturn
     """
-    cleanText = re.sub(r'<.*?>|\\n', ' ', urlText)
-    charCheck = re.findall(r'Characteristics \n(.*)\n', cleanText)
-    if len(charCheck) > 0:
-        if re.findall('female[ s]', charCheck[0]):
-            return 'Female' 
-        if re.findall('(?<!fe)male[ s]', charCheck[0]):
-            return 'Male' 
+    page = SamplePage.parse(urlText)
+    if keywords is None:
+        keywords = sampleKeywords
 
+    checkTexts = page.values('Characteristics')[:1]
     for prot in protocolEntries:
-        protCheck = re.findall('{0} protocol \n(.*)\n'.format(prot), cleanText)
-        if len(protCheck) > 0:
-            if re.findall('female[ s]', protCheck[0]):
-                return 'Female' 
-            if re.findall('(?<!fe)male[ s]', protCheck[0]):
-                return 'Male' 
+        checkTexts += page.values('{0} protocol'.format(prot))[:1]
+
+    for text in checkTexts:
+        hits = page.keywordHits(text, keywords)
+        if any(label == 'female' for _, label, _ in hits):
+            return 'Female'
+        # 'male' preceded by 'fe' is part of 'female'
+        if any(label == 'male' and text[max(start - 2, 0):start] != 'fe'
+            for start, label, _ in hits):
+            return 'Male'
 
     return nullReturn
 
 
 
+@runMetrics.timed('pmidAgeExtract')
 def pmidAgeExtract(urlText, sectionID = 'methods', convertTo = 'week', 
     checkConverts = ['day', 'week', 'month', 'year'], nullReturn = 'n/a',
     flagRange = True):
@@ -684,16 +604,18 @@ def pmidAgeExtract(urlText, sectionID = 'methods', convertTo = 'week',
     pmidExtract = re.findall(r'\/pubmed\/(\d+)', newText)
 
     if len(pmidExtract) == 0 or 'Citation missing' in newText:
-        print('No PMIDs found from GEO GSE study page. Returning')
+        runMetrics.warn('noPMID', 'No PMIDs found from GEO GSE study page. '
+            'Returning')
         return nullReturn
 
     elif len(pmidExtract) > 1:
-        print('Warning, multiple PMIDs found from a GEO GSE study page. An attempt '
-            'to extract age on the first publication will be made')
+        runMetrics.warn('multiplePMIDs', 'Warning, multiple PMIDs found from a '
+            'GEO GSE study page. An attempt to extract age on the first '
+            'publication will be made')
     
     pmid = pmidExtract[0]
     url = 'https://www.ncbi.nlm.nih.gov/pubmed/{0}'.format(pmid)
-    pubText = requests.get(url).text
+    pubText = geoFetch.fetchText(url)
 
     sectionText = pmidSectionExtraction(pmidText = pubText, sectionID = sectionID)
 
@@ -760,7 +682,8 @@ def pmidSectionExtraction(pmidText, sectionID, possibleSections = ['abstract',
     
     linkExtract = re.findall(r'(Full text links.*)\n', pmidText)
     if len(linkExtract) == 0:
-        print('No links to full text papers found on PubMed PMID site. Returning')
+        runMetrics.warn('noFullTextLinks', 'No links to full text papers found '
+            'on PubMed PMID site. Returning')
 
         return nullReturn 
 
@@ -780,25 +703,29 @@ def pmidSectionExtraction(pmidText, sectionID, possibleSections = ['abstract',
             elif len(paperURL) == 1:
                 links = paperURL
 
-    winLink, winText, winDiv = maxSectionMatch(links = links, 
+    winLink, winText, winDiv, winSoup = maxSectionMatch(links = links, 
                 possibleSections = possibleSections, soupAttempts = soupAttempts,
-                nullReturn = nullReturn)
+                nullReturn = nullReturn, returnSoup = True)
 
     sectionText = findSectionText(fullText = winText, sectionTags = tags, 
-                soupDiv = winDiv, nullReturn = nullReturn)
+                soupDiv = winDiv, nullReturn = nullReturn, soup = winSoup)
 
     return sectionText
 
 
+@runMetrics.timed('maxSectionMatch')
 def maxSectionMatch(links, possibleSections = ['abstract', 'introduction', 
     'figures', 'materials and methods', 'methods', 'experimental procedures', 
     'results', 'discussion', 'method summary', 'supplementary material', 
     'acknowledgements', 'references', 'conclusions', 'supporting information', 
-    'funding'], soupAttempts = ['h2', 'h1', 'h6'], nullReturn = 'n/a'):
+    'funding'], soupAttempts = ['h2', 'h1', 'h6'], nullReturn = 'n/a', 
+    returnSoup = False):
     """ Over a list of links, scan through a set of bs4 parsers and choose that
         which has the maximal number of matches to possible section IDs. Then 
         return the url and the get() text of the link which wins (max-max) and
-        the Soup div. """
+        the Soup div. Links are fetched concurrently (size and time capped, see
+        sectionSoup) and each page is parsed once for all soupAttempts; 
+        returnSoup also returns the winning page's soup for findSectionText. """
 
     missings = [x for x in soupAttempts if x not in ['h1', 'h2', 'h6']]
     if len(missings) > 0:
@@ -808,28 +735,18 @@ def maxSectionMatch(links, possibleSections = ['abstract', 'introduction',
     soupAttempts = [x for x in soupAttempts if x not in missings]
 
     linkResults = dict() 
-    for link in links:
+    for link, linkGet in zip(links, sectionSoup.fetchPages(links, 
+        headers = defaultAgent)):
         linkResults[link] = dict()
-        linkGet = requests.get(link, headers = defaultAgent).text.lower()
-        linkResults[link]['text'] = linkGet 
-        
-        linkResults[link]['divs'] = dict()
-        for attempt in soupAttempts:
-            linkCount = 0
-            soup = BeautifulSoup(linkGet, features = 'html.parser')
-            if attempt in ['h1', 'h2']:
-                for sec in soup.find_all(attempt):
-                    for x in possibleSections:
-                        if x in sec:
-                            linkCount += 1
-                        
-            elif attempt in ['h6']:
-                for sec in soup.find_all('div', class_ = attempt):
-                    for x in possibleSections:
-                        if x in sec:
-                            linkCount += 1
+        if linkGet is None:
+            linkResults[link]['text'], linkResults[link]['soup'] = '', None
+            linkResults[link]['divs'] = {x: 0 for x in soupAttempts}
+            continue
 
-            linkResults[link]['divs'][attempt] = linkCount 
+        linkResults[link]['text'] = linkGet 
+        linkResults[link]['soup'] = sectionSoup.parsePage(linkGet)
+        linkResults[link]['divs'] = sectionSoup.sectionCounts(
+            linkResults[link]['soup'], soupAttempts, possibleSections)
 
     maxes = dict()
     for link in linkResults:
@@ -837,29 +754,40 @@ def maxSectionMatch(links, possibleSections = ['abstract', 'introduction',
 
     maxVal = max(maxes.values())
     if maxVal == 0:
-        print('No section matches found for any link. Returning null')
+        runMetrics.warn('noSectionMatch', 'No section matches found for any '
+            'link. Returning null')
+        if returnSoup is True:
+            return nullReturn, nullReturn, nullReturn, None
         return nullReturn, nullReturn, nullReturn
     
     maxLink = [x for x in linkResults if maxes[x] == maxVal]
     if len(maxLink) > 1:
-        print('Tie for maximum number of matches, will return first link')
+        runMetrics.warn('sectionLinkTie', 'Tie for maximum number of matches, '
+            'will return first link')
 
     maxLink = maxLink[0]
     maxDivVal = max(linkResults[maxLink]['divs'].values())
     maxDiv = [x for x in linkResults[maxLink]['divs'] if linkResults[maxLink]['divs'][x] == maxDivVal]
     if len(maxDiv) > 1:
-        print('Tie for maximum div heading, will return first')
+        runMetrics.warn('sectionDivTie', 'Tie for maximum div heading, will '
+            'return first')
 
 
+    if returnSoup is True:
+        return (maxLink, linkResults[maxLink]['text'], maxDiv[0], 
+            linkResults[maxLink]['soup'])
     return maxLink, linkResults[maxLink]['text'], maxDiv[0]
 
 
-def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
+@runMetrics.timed('findSectionText')
+def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a', 
+    soup = None):
     """ Within the text of a paper (from maxSectionMatch()), and using the Soup 
         div argument (from maxSectionMatch()), look for the section headers
         defined by sectionTags. If the sections are found but cannot be located
         by an index-based re.findall(), an attempt is made to remove extra
-        newlines, otherwise the section cannot be found and null returned """  
+        newlines, otherwise the section cannot be found and null returned. 
+        soup is the already parsed fullText, if available """  
 
     if fullText == nullReturn:
         return nullReturn
@@ -867,28 +795,19 @@ def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
     updated = False
     methodSplit = []
     countSplit, splitIndex = 0, 0
-    soup = BeautifulSoup(fullText, features = 'html.parser')
-    if soupDiv in ['h1', 'h2']:
-        for link in soup.find_all(soupDiv):
-            methodSplit.append(str(link))
-            countSplit += 1 
-            for tag in sectionTags:
-                if tag in link.get_text().lower() and updated is False:
-                    updated = True
-                    splitIndex = countSplit
-    
-    elif soupDiv in ['h6']:
-        for link in soup.find_all('div', class_ = soupDiv):
-            methodSplit.append(str(link))
-            countSplit += 1 
-            for tag in sectionTags:
-                if tag in link.get_text().lower() and updated is False:
-                    updated = True
-                    splitIndex = countSplit
+    if soup is None:
+        soup = sectionSoup.parsePage(fullText)
+    for link in sectionSoup.sectionHeaders(soup, soupDiv):
+        methodSplit.append(str(link))
+        countSplit += 1 
+        for tag in sectionTags:
+            if tag in link.get_text().lower() and updated is False:
+                updated = True
+                splitIndex = countSplit
     
     if splitIndex == 0:
-        print('No section headings tagged with {0} found, returning '
-                'null'.format(sectionTags))
+        runMetrics.warn('noSectionHeadings', 'No section headings tagged with '
+            '{0} found, returning null'.format(sectionTags))
 
         return nullReturn
 
@@ -900,12 +819,13 @@ def findSectionText(fullText, sectionTags, soupDiv, nullReturn = 'n/a'):
         fullText = re.sub(r'\n', '', fullText)
         findText = re.findall(findMe, fullText)
         if len(findText) == 0:
-            print('No text found with {0} section headers, returning '
-                    'null'.format(sectionTags))
+            runMetrics.warn('noSectionText', 'No text found with {0} section '
+                'headers, returning null'.format(sectionTags))
 
             return nullReturn
     
     if len(findText) > 1:
-        print('Warning, multiple method sections matched. Returning first')
+        runMetrics.warn('multipleSections', 'Warning, multiple method sections '
+            'matched. Returning first')
 
     return findText[0]
\ No newline at end of file
@@ -8,8 +8,12 @@
     a fixed df structure and column is assumed from the 
 """
 import json, os, re, time, requests
+import numpy as np
 import pandas as pd 
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import geoFetch
 defaultAgent = {'User-Agent': 'SomeAgent 11.0'}
 
 def geneWrangler(df, organism, valsToAlphaNumLower = True):
@@ -38,29 +42,112 @@ def geneWrangler(df, organism, valsToAlphaNumLower = True):
     return geneDict
 
 
+geneColumns = ['Org_name', 'GeneID', 'Symbol', 'Aliases']
+
+def geneWranglerFile(path, organism, valsToAlphaNumLower = True, 
+    chunkSize = 200000):
+    """ geneWrangler() straight from a gene .txt (tab-separated) file, for
+        exports too big to load whole (human, multi-organism). Only the four
+        needed columns are read, as strings and chunkSize rows at a time, and
+        rows of other organisms are dropped from each chunk before anything is
+        normalized. Aliases are then split, exploded and grouped per gene with
+        vectorized pandas/numpy operations instead of a per-row loop.
+
+        Returns the same dict as geneWrangler() on the drop_duplicates()'d
+        file, except that genes without aliases get an empty list (rather than
+        ['nan']).
+
+        Args:
+            path - Str: Gene .txt file
+            organism - Str: Organism name, as in the Org_name column
+            valsToAlphaNumLower - Bool: see geneWrangler()
+            chunkSize - Int: Rows read at a time
+    """
+    alphaNum = r'[^0-9a-zA-Z\,\ +]+'
+    if valsToAlphaNumLower is True:
+        normalize = lambda x: re.sub(alphaNum, '', x).lower()
+    else:
+        normalize = lambda x: x
+    target = normalize(organism)
+
+    chunks = [pd.DataFrame(columns = geneColumns, dtype = str)]
+    for chunk in pd.read_csv(path, sep = '\t', usecols = geneColumns, 
+        dtype = str, chunksize = chunkSize):
+        ### Few distinct organisms per chunk: normalize those, not every row
+        keep = [x for x in chunk['Org_name'].dropna().unique() if 
+            normalize(x) == target]
+        chunks.append(chunk.loc[chunk['Org_name'].isin(keep), geneColumns])
+    df = pd.concat(chunks, ignore_index = True).drop_duplicates()
+    df['Aliases'] = df['Aliases'].fillna('')
+
+    if valsToAlphaNumLower is True:
+        for col in ['GeneID', 'Symbol', 'Aliases']:
+            df[col] = df[col].astype(str).str.replace(alphaNum, '', 
+                regex = True).str.lower()
+    else:
+        df['GeneID'] = df['GeneID'].astype(int)
+
+    ### Genes numbered in order of first appearance. The last symbol seen
+    ### for a gene wins, as in geneWrangler()
+    codes, geneIDs = pd.factorize(df['GeneID'])
+    symbols = np.empty(len(geneIDs), dtype = object)
+    symbols[codes] = df['Symbol'].to_numpy()
+
+    ### Splitting on ' ?, ?' after trimming the ends of the whole string is
+    ### geneWrangler()'s one-space trim of every alias, in one pass per row
+    aliases = df['Aliases'].reset_index(drop = True).str.replace(r'^ | $', '', 
+        regex = True).str.split(r' ?, ?', regex = True).explode()
+    aliases = aliases[aliases.notna() & (aliases != '')]
+    ### Stable sort by gene keeps each gene's aliases in file order
+    aliasCodes = codes[aliases.index.to_numpy()]
+    order = np.argsort(aliasCodes, kind = 'stable')
+    ends = np.cumsum(np.bincount(aliasCodes, minlength = len(geneIDs))).tolist()
+    sortedAliases = aliases.to_numpy()[order].tolist()
+
+    geneDict = dict()
+    start = 0
+    for geneID, end, symbol in zip(geneIDs.tolist(), ends, symbols):
+        geneDict[geneID] = {'Aliases': sortedAliases[start:end], 'Symbol': symbol}
+        start = end
+
+    return geneDict
+
+
 def mouseDietWrangler(baseUrl = 'https://www.researchdiets.com',
     dietLinks = ['/opensource-diets/in-stock-diets', 
-    '/opensource-diets/dio-series-diets']):
+    '/opensource-diets/dio-series-diets'], refresh = False, maxWorkers = 4,
+    requestsPerSecond = 4):
     """ Extract macronutrient informatin from diets off researchdiets.com. These
         diets are most commonly used in research. Macro numbers are in percentages
-        of total calories. """
+        of total calories. 
+
+        Formula pages are collected from all listing pages first, so a diet
+        listed on several of them is fetched once, and then fetched by 
+        maxWorkers threads over geoFetch's pooled session, with no more than
+        requestsPerSecond requests to the site. Pages come from the response
+        cache while fresh. refresh = True checks every cached page with the 
+        site instead, and only pages that changed are downloaded again. """
 
+    geoFetch.setHostRate(urlparse(baseUrl).netloc, requestsPerSecond)
     dietDict = dict()
 
     for link in dietLinks:
-        urlGet = requests.get(baseUrl+link, headers = defaultAgent)
-        soup = BeautifulSoup(urlGet.text, features = 'html.parser')
+        urlGetText = geoFetch.fetchText(baseUrl+link, headers = defaultAgent,
+            revalidate = refresh)
+        soup = BeautifulSoup(urlGetText, features = 'html.parser')
         for subLink in soup.find_all('a', href=True):
             if 'formula' in subLink['href']:
                 dietID = re.sub('\/formulas\/', '', subLink['href'])
-                dietDict[dietID] = dict()
-                dietDict[dietID]['url'] = baseUrl + subLink['href']
+                if dietID not in dietDict:
+                    dietDict[dietID] = {'url': baseUrl + subLink['href']}
+
+    def fetchDiet(dietID):
+        return dietID, geoFetch.fetchText(dietDict[dietID]['url'], 
+            headers = defaultAgent, revalidate = refresh)
+
+    with ThreadPoolExecutor(max_workers = maxWorkers) as pool:
+        for dietID, urlGetText in pool.map(fetchDiet, list(dietDict)):
 
-        for dietID in dietDict:
-            time.sleep(0.25)
-            urlGetText = requests.get(dietDict[dietID]['url'], 
-                headers = defaultAgent).text
-            
             prot = re.findall('Protein\:.*\n(.*)\n', urlGetText)[0]
             fat = re.findall('Fat\:.*\n(.*)\n', urlGetText)[0]
             carb = re.findall('Carbohydrate\:.*\n(.*)\n', urlGetText)[0]
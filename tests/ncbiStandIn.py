@@ -0,0 +1,253 @@
+""" Local stand-in for the NCBI/GEO hosts the pipelines talk to (acc.cgi,
+    E-utilities esearch/efetch, PubMed and full-text pages, MINiML .tgz
+    downloads), serving recorded responses from tests/fixtures. Point the
+    pipelines at it with NCBI_BASE_URL (see geoFetch.rewriteURL()), which
+    sends '<scheme>://<host><path>' as '<base>/<scheme>/<host><path>'.
+
+    Recordings are listed in fixtures/recordings.json as {original URL:
+    {'file', 'status', 'contentType', 'tgzMember'}}, where tgzMember serves
+    the file packed as that member of a .tgz. With record = True, requests
+    without a recording are fetched live, saved as new fixtures and served.
+
+    Faults can be injected for load and failure testing: a fixed latency
+    (plus random jitter), error responses (429/5xx) at a given rate or for
+    the first failFirst requests of each URL, and bodies truncated short of
+    their Content-Length (urllib's ContentTooShortError case). faultPattern
+    restricts faults to URLs matching a regex.
+
+    Successful responses carry an ETag (a hash of the body), and requests
+    sending it back in If-None-Match get a 304, as from hosts that support
+    conditional requests.
+
+    Usage:
+        python tests/ncbiStandIn.py --port 8765 --latency 0.2 --errorRate 0.1
+        NCBI_BASE_URL=http://127.0.0.1:8765 python metadataExtract.py
+
+        python tests/ncbiStandIn.py --port 8765 --record
+        NCBI_BASE_URL=http://127.0.0.1:8765 python -m unittest tests.tests_ageExtraction
+"""
+
+import argparse, contextlib, hashlib, io, json, os, random, re, sys, tarfile
+import threading, time, urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+    'src'))
+import responseCache
+
+fixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'fixtures')
+indexName = 'recordings.json'
+
+
+class Faults:
+    """ Fault injection settings.
+
+        Args:
+            latency - Float: Seconds added to every response
+            jitter - Float: Up to this many random seconds added on top
+            errorRate - Float: Fraction of requests answered with an error
+            errorStatuses - List: Error statuses to pick from
+            failFirst - Int: Answer the first failFirst requests of each URL
+                with an error, for deterministic retry tests
+            truncateRate - Float: Fraction of bodies cut short
+            retryAfter - Int: Retry-After header sent with 429s, or None
+            faultPattern - Str: Regex on the original URL, only matching URLs
+                get faults
+            seed - Int: Random seed
+    """
+    def __init__(self, latency = 0, jitter = 0, errorRate = 0, errorStatuses =
+        [429, 500, 502, 503], failFirst = 0, truncateRate = 0, retryAfter = None,
+        faultPattern = None, seed = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorStatuses = errorStatuses
+        self.failFirst = failFirst
+        self.truncateRate = truncateRate
+        self.retryAfter = retryAfter
+        self.faultPattern = re.compile(faultPattern) if faultPattern else None
+        self.random = random.Random(seed)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ Threaded HTTP server holding the recordings, fault settings and a
+        count of requests per original URL (requestCounts) """
+
+    daemon_threads = True
+
+    def __init__(self, address, fixtures = fixtureDir, record = False,
+        faults = None):
+        super().__init__(address, StandInHandler)
+        self.fixtures = fixtures
+        self.record = record
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.requestCounts = dict()
+        indexPath = os.path.join(fixtures, indexName)
+        self.recordings = dict()
+        if os.path.exists(indexPath):
+            with open(indexPath, 'r') as fin:
+                self.recordings = json.load(fin)
+        self.recordingKeys = {responseCache.cacheKey(url): url for url in
+            self.recordings}
+
+    @property
+    def baseURL(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def count(self, url):
+        with self.lock:
+            self.requestCounts[url] = self.requestCounts.get(url, 0) + 1
+            return self.requestCounts[url]
+
+    def response(self, url):
+        """ (status, content type, body) recorded for url, recording it first
+            in record mode, or None """
+
+        with self.lock:
+            recordedURL = self.recordingKeys.get(responseCache.cacheKey(url))
+        if recordedURL is None:
+            if self.record is False:
+                return None
+            recordedURL = self.recordURL(url)
+
+        entry = self.recordings[recordedURL]
+        with open(os.path.join(self.fixtures, entry['file']), 'rb') as fin:
+            body = fin.read()
+        if entry.get('tgzMember'):
+            body = packTgz(entry['tgzMember'], body)
+        return entry.get('status', 200), entry.get('contentType',
+            'application/octet-stream'), body
+
+    def recordURL(self, url):
+        """ Fetch url live and add it to the recordings. API keys are kept out
+            of the recorded URL. """
+
+        try:
+            with urllib.request.urlopen(url) as resp:
+                status, contentType, body = (resp.status,
+                    resp.headers.get('Content-Type'), resp.read())
+        except urllib.error.HTTPError as e:
+            status, contentType, body = e.code, e.headers.get('Content-Type'), e.read()
+
+        recordedURL = responseCache.cacheKey(url)
+        name = 'rec_{0}{1}'.format(hashlib.sha1(recordedURL.encode()).hexdigest()
+            [:12], os.path.splitext(recordedURL.split('?')[0])[1][:8])
+        with open(os.path.join(self.fixtures, name), 'wb') as fout:
+            fout.write(body)
+        with self.lock:
+            self.recordings[recordedURL] = {'file': name, 'status': status,
+                'contentType': contentType}
+            self.recordingKeys[recordedURL] = recordedURL
+            with open(os.path.join(self.fixtures, indexName), 'w') as fout:
+                json.dump(self.recordings, fout, indent = 4)
+                fout.write('\n')
+        print('Recorded {0} as {1}'.format(recordedURL, name))
+        return recordedURL
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server, faults = self.server, self.server.faults
+        parts = self.path.lstrip('/').split('/', 1)
+        if len(parts) < 2 or parts[0] not in ['http', 'https', 'ftp']:
+            return self.reply(400, 'text/plain', b'Expected /<scheme>/<host>/<path>')
+        url = '{0}://{1}'.format(*parts)
+        nth = server.count(url)
+
+        faulty = faults.faultPattern is None or faults.faultPattern.search(url)
+        delay = faults.latency + faults.random.uniform(0, faults.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if faulty and (nth <= faults.failFirst or
+            faults.random.random() < faults.errorRate):
+            status = faults.random.choice(faults.errorStatuses)
+            headers = dict()
+            if status == 429 and faults.retryAfter is not None:
+                headers['Retry-After'] = str(faults.retryAfter)
+            return self.reply(status, 'text/plain', 'Injected {0}'.format(
+                status).encode(), headers = headers)
+
+        found = server.response(url)
+        if found is None:
+            return self.reply(404, 'text/plain', 'No recording of {0}'.format(
+                url).encode())
+        status, contentType, body = found
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest()[:16])
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            return self.reply(304, contentType, b'', headers = {'ETag': etag})
+        truncate = faulty and faults.random.random() < faults.truncateRate
+        self.reply(status, contentType, body, headers = {'ETag': etag} if
+            status == 200 else dict(), truncate = truncate)
+
+    def reply(self, status, contentType, body, headers = dict(), truncate = False):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if truncate is True:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2] if truncate else body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def packTgz(member, body):
+    """ body as the only member of an in-memory .tgz """
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj = buffer, mode = 'w:gz') as tar:
+        info = tarfile.TarInfo(member)
+        info.size = len(body)
+        tar.addfile(info, io.BytesIO(body))
+    return buffer.getvalue()
+
+
+@contextlib.contextmanager
+def running(fixtures = fixtureDir, port = 0, record = False, **faults):
+    """ Run a stand-in in a background thread for the duration of the block.
+        Yields the server; its baseURL goes to geoFetch.setBaseURL(). """
+
+    server = StandInServer(('127.0.0.1', port), fixtures = fixtures,
+        record = record, faults = Faults(**faults))
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local NCBI/GEO stand-in '
+        'serving recorded responses')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--fixtures', default = fixtureDir)
+    parser.add_argument('--record', action = 'store_true',
+        help = 'Fetch and record URLs without a recording')
+    parser.add_argument('--latency', type = float, default = 0)
+    parser.add_argument('--jitter', type = float, default = 0)
+    parser.add_argument('--errorRate', type = float, default = 0)
+    parser.add_argument('--errorStatuses', type = int, nargs = '+',
+        default = [429, 500, 502, 503])
+    parser.add_argument('--failFirst', type = int, default = 0)
+    parser.add_argument('--truncateRate', type = float, default = 0)
+    parser.add_argument('--retryAfter', type = int, default = None)
+    parser.add_argument('--faultPattern', default = None)
+    parser.add_argument('--seed', type = int, default = None)
+    args = vars(parser.parse_args())
+
+    server = StandInServer(('127.0.0.1', args.pop('port')), fixtures =
+        args.pop('fixtures'), record = args.pop('record'), faults = Faults(**args))
+    print('Serving {0} on {1}'.format(server.fixtures, server.baseURL))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
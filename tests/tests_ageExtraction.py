@@ -1,11 +1,27 @@
-""" Unit-testing for age-related functions. Keep < 30sec if possible """
+""" Unit-testing for age-related functions. Keep < 30sec if possible. Pages
+    are served by tests/ncbiStandIn.py from the recordings in tests/fixtures,
+    never the live site; run with NCBI_RECORD=1 to fetch and record pages
+    that have none. """
 
-import unittest, sys, os, re, warnings, requests
+import unittest, sys, os, re, warnings, requests, contextlib
+import numpy as np
 
 sys.path.append('./src/')
+sys.path.append('./tests/')
 import setup_metadataExtract as util
+import geoFetch, ncbiStandIn
 
 gsmURL = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc='
+standIn = contextlib.ExitStack()
+
+def setUpModule():
+    server = standIn.enter_context(ncbiStandIn.running(record = 
+        os.environ.get('NCBI_RECORD') == '1'))
+    geoFetch.setBaseURL(server.baseURL)
+
+def tearDownModule():
+    geoFetch.setBaseURL(None)
+    standIn.close()
 
 class TestDataProcess(unittest.TestCase):
 
@@ -199,24 +215,89 @@ class TestDataProcess(unittest.TestCase):
             self.assertEqual(1, val)
         
 
+    def test_numericTimeConvertBatch(self):
+        """ Check: Batch results match numericTimeConvert, text by text """
+
+        cases = ['10 weeks old', '10-week-old', 'ten-week old', 
+            '10 weeks for 5 weeks', '6-10 weeks for 7 days', '6-8 days for 7 days',
+            '4day-10mos for 1 week', '6.5-10.5 weeks', '20wks-1.5yrs', 
+            '6-10 eons for 7 iotas', '10 weeks old', float('nan')]
+
+        for convertTo in ['week', 'day', 'month', 'year']:
+            ages, durs, flags = util.numericTimeConvertBatch(cases, 
+                convertTo = convertTo)
+            self.assertEqual(len(cases), len(ages))
+            for i, text in enumerate(cases):
+                if not isinstance(text, str):
+                    self.assertTrue(np.isnan(ages[i]))
+                    continue
+                val, flag = util.numericTimeConvert(text, convertTo = convertTo)
+                if val == 'n/a':
+                    self.assertTrue(np.isnan(ages[i]))
+                else:
+                    self.assertAlmostEqual(val, ages[i])
+                self.assertEqual(flag, flags[i])
+
+        ages, durs, flags = util.numericTimeConvertBatch(cases[:4])
+        self.assertTrue(np.isnan(durs[0]))
+        self.assertEqual(5, durs[3])
+
+
+    def test_gdsNumericTimeConvert(self):
+        """ Check: gds_scraper_mt reads the same ages as numericTimeConvert, as
+            both parse with ageEngine """
+
+        sys.path.insert(0, './gds_scraper_mt')
+        from src.geo_extraction_funcs import numericTimeConvert as gdsConvert
+
+        with open('tests/fixtures/ageStrings.txt', 'r') as fin:
+            cases = fin.read().splitlines()
+        for convertTo in ['week', 'day']:
+            for text in cases:
+                val, _ = util.numericTimeConvert(text, convertTo = convertTo,
+                    flagRange = False)
+                self.assertEqual(val, gdsConvert(text, convertTo = convertTo))
+
+
+    def test_gdsSeriesAge(self):
+        """ Check: gds_scraper_mt samples without an age take the age read once
+            from their series text """
+
+        sys.path.insert(0, './gds_scraper_mt')
+        from src.geo_extraction_funcs import geoAgeExtract as gdsAgeExtract
+        from src.processing_data import series_age_extract
+
+        series = {'pmid': '19000000', 'series_summary': 'Mice aged 8-10 '
+            'weeks', 'series_design': 'fed for 3 weeks'}
+        sample = dict(series, cells = False, sample_age = '', characteristics =
+            '', description = '', treatment_protocol = '', growth_protocol = '')
+
+        age = series_age_extract(series)
+        self.assertEqual(12, age)
+        self.assertEqual(gdsAgeExtract(sample), gdsAgeExtract(sample,
+            series_age = age))
+        self.assertEqual((6, 'Study'), gdsAgeExtract(sample, series_age = 6))
+        self.assertEqual('n/a', series_age_extract(dict(series, pmid = '')))
+
+
     def test_geoAgeExtract(self):
         """ Check: Proper age on hand-picked test samples. Failed pickups on 
             alternative parse IDs. Check age extraction from GSE if age cannot
-            be detected from sample. 
-            
-            TODO: Full text checks"""
-
-        samp1, samp2, samp3 = 'GSM400641', 'GSM937915', 'GSM1402452'
-        samp4, samp5, samp6 = 'GSM1418737', 'GSM1282831', 'GSM172972'
-        samp1Text = requests.get(gsmURL + samp1).text
-        samp2Text = requests.get(gsmURL + samp2).text
-        samp3Text = requests.get(gsmURL + samp3).text
-        samp4Text = requests.get(gsmURL + samp4).text
-        samp5Text = requests.get(gsmURL + samp5).text
-        samp6Text = requests.get(gsmURL + samp6).text
+            be detected from sample, and from the full text if not from GSE 
+            either. """
+
+        samp1, samp2, samp3 = 'GSM401234', 'GSM401260', 'GSM401261'
+        samp4, samp5, samp6 = 'GSM401262', 'GSM401250', 'GSM401240'
+        samp1Text = geoFetch.fetchText(gsmURL + samp1)
+        samp2Text = geoFetch.fetchText(gsmURL + samp2)
+        samp3Text = geoFetch.fetchText(gsmURL + samp3)
+        samp4Text = geoFetch.fetchText(gsmURL + samp4)
+        samp5Text = geoFetch.fetchText(gsmURL + samp5)
+        samp6Text = geoFetch.fetchText(gsmURL + samp6)
         
+        ### 8 weeks old, plus 2 weeks of treatment
         v1, s1, f1 = util.geoAgeExtract(samp1Text)
-        self.assertAlmostEqual(4.28571428, v1)
+        self.assertEqual(10, v1)
         self.assertEqual('Sample', s1)
         self.assertEqual(False, f1)
 
@@ -231,40 +312,45 @@ class TestDataProcess(unittest.TestCase):
         self.assertEqual(False, f3)
 
         v4, s4, f4 = util.geoAgeExtract(samp4Text)
-        self.assertEqual(13.5, v4)
+        self.assertEqual(8, v4)
         self.assertEqual('Sample', s4)
         self.assertEqual(False, f4)
 
-        v5, s5, f5 = util.geoAgeExtract(samp5Text)
-        self.assertEqual(16, v5)
-        self.assertEqual('Sample', s5)
+        ### 10-12 weeks old, fed for 4 weeks (methods of PMC2700001)
+        v5a, s5a, f5 = util.geoAgeExtract(samp5Text)
+        self.assertEqual(15, v5a)
+        self.assertEqual('Text', s5a)
         self.assertEqual(False, f5)
 
+        v5b, s5b, _ = util.geoAgeExtract(samp5Text, tryAgePMID = False)
+        self.assertEqual('n/a', v5b)
+        self.assertEqual('Study', s5b)
+
         v6a, s6a, f6 = util.geoAgeExtract(samp6Text, tryAgeStudy = False)
         self.assertEqual('n/a', v6a)
         self.assertEqual('Sample', s6a)
         self.assertEqual(False, f6)
         
         v6b, s6b, _ = util.geoAgeExtract(samp6Text, tryAgeStudy = True)
-        self.assertEqual(6.75, v6b)
+        self.assertEqual(11, v6b)
         self.assertEqual('Study', s6b)
 
         v1, s1, _ = util.geoAgeExtract(samp1Text, parseAgeIDs = ['Characteristics'])
-        self.assertAlmostEqual(4.28571428, v1)
+        self.assertEqual(8, v1)
         
         v2, s2, _ = util.geoAgeExtract(samp2Text, parseAgeIDs = ['Characteristics'])
         self.assertEqual('n/a', v2)
         
         v4, s4, _ = util.geoAgeExtract(samp4Text, parseAgeIDs = ['Characteristics'])
-        self.assertEqual(1, v4)
+        self.assertEqual(6, v4)
         
-        v5a, s5a, _ = util.geoAgeExtract(samp5Text, parseAgeIDs = ['Characteristics'],
+        v6a, s6a, _ = util.geoAgeExtract(samp6Text, parseAgeIDs = ['Characteristics'],
             tryAgeStudy = False)
-        self.assertEqual('n/a', v5a)
+        self.assertEqual('n/a', v6a)
         
-        v5b, s5b, _ = util.geoAgeExtract(samp5Text, parseAgeIDs = ['Characteristics'],
+        v6b, s6b, _ = util.geoAgeExtract(samp6Text, parseAgeIDs = ['Characteristics'],
             tryAgeStudy = True)
-        self.assertEqual(16, v5b)
+        self.assertEqual(11, v6b)
         
 
 if __name__ == '__main__':
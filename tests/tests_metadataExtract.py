@@ -1,23 +1,626 @@
 """ Unit-testing for metadata extraction. Keep < 30sec if possible. 
-    Age-specific functions moved to separate test .py """
+    Age-specific functions moved to separate test .py. Pages are served by
+    tests/ncbiStandIn.py from the recordings in tests/fixtures, never the live
+    site; run with NCBI_RECORD=1 to fetch and record pages that have none. """
 
-import unittest, sys, os, re, warnings, requests
+import unittest, sys, os, re, time, json, tempfile, warnings, requests
+import contextlib, copy, io, sqlite3, subprocess
+import pandas as pd
 
 sys.path.append('./src/')
+sys.path.append('./tests/')
 import setup_metadataExtract as util
+import setup_wrangler as wrangler
+import geoFetch, responseCache, resultStore, keywordMatch, runMetrics, geneAlias
+import ncbiStandIn, sampleListGen, shardSamples
 
 gsmURL = 'https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc='
+standIn = contextlib.ExitStack()
+
+def setUpModule():
+    server = standIn.enter_context(ncbiStandIn.running(record = 
+        os.environ.get('NCBI_RECORD') == '1'))
+    geoFetch.setBaseURL(server.baseURL)
+
+def tearDownModule():
+    geoFetch.setBaseURL(None)
+    standIn.close()
+
+@contextlib.contextmanager
+def standInCache(cacheEnabled = True, **faults):
+    """ Run a stand-in with faults and an empty response cache (and no
+        memoized GSE pages) in a temporary directory for the duration of the
+        block, yielding the server. The cache settings and base URL in use
+        before are restored after. """
+
+    settings = (geoFetch.cache, geoFetch.cacheEnabled, geoFetch.baseURL)
+    with tempfile.TemporaryDirectory() as tmp:
+        geoFetch.configureCache(path = os.path.join(tmp, 'c.sqlite'), 
+            enabled = cacheEnabled)
+        util.gseTextMemo.clear()
+        try:
+            with ncbiStandIn.running(**faults) as server:
+                geoFetch.setBaseURL(server.baseURL)
+                yield server
+        finally:
+            util.gseTextMemo.clear()
+            geoFetch.cache, geoFetch.cacheEnabled = settings[:2]
+            geoFetch.setBaseURL(settings[2])
 
 class TestDataProcess(unittest.TestCase):
+
+    def test_RateLimiter(self):
+        """ Check: Calls are spaced to the requested rate, across threads, and
+            a zero rate disables the limit. """
+
+        limiter = geoFetch.RateLimiter(requestsPerSecond = 20)
+        start = time.monotonic()
+        with util.ThreadPoolExecutor(max_workers = 4) as pool:
+            list(pool.map(lambda x: limiter.wait(), range(11)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+        limiter = geoFetch.RateLimiter(requestsPerSecond = 0)
+        start = time.monotonic()
+        for _ in range(100):
+            limiter.wait()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_SingleFlight(self):
+        """ Check: Concurrent callers for one key share a single call, later
+            callers get the memoized result, and distinct keys are separate. """
+
+        memo, calls = geoFetch.SingleFlight(), []
+        def fetch():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'GSE16012 text'
+
+        with util.ThreadPoolExecutor(max_workers = 8) as pool:
+            results = list(pool.map(lambda x: memo.do('GSE16012', fetch), range(8)))
+        self.assertEqual(['GSE16012 text'] * 8, results)
+        self.assertEqual(1, len(calls))
+
+        memo.do('GSE16012', fetch)
+        self.assertEqual(1, len(calls))
+        memo.do('GSE1867', fetch)
+        self.assertEqual(2, len(calls))
+
+    def test_ResponseCache(self):
+        """ Check: Round trip, per-resource TTL expiry, negative entries with
+            their own TTL, API keys dropped from keys, and LRU eviction under
+            the size cap. """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = responseCache.ResponseCache(path = os.path.join(tmp, 'c.sqlite'),
+                maxBytes = 1000, ttls = {'gse': 0}, negativeTTL = 100)
+
+            gsmKey = gsmURL + 'GSM400641'
+            cache.put(gsmKey, b'<html>GSM400641</html>', encoding = 'utf-8')
+            self.assertEqual((b'<html>GSM400641</html>', 'utf-8'), cache.get(gsmKey))
+            self.assertIsNone(cache.get(gsmURL + 'GSM0'))
+
+            time.sleep(0.01)
+            cache.put(gsmURL + 'GSE16012', b'<html>GSE16012</html>')
+            self.assertIsNone(cache.get(gsmURL + 'GSE16012'))
+
+            cache.put(gsmURL + 'GSM9999999', b'Could not find a public or '
+                b'private accession "GSM9999999"')
+            self.assertIsNotNone(cache.get(gsmURL + 'GSM9999999'))
+            cache.negativeTTL = 0
+            time.sleep(0.01)
+            self.assertIsNone(cache.get(gsmURL + 'GSM9999999'))
+
+            self.assertEqual(responseCache.cacheKey('https://eutils.ncbi.nlm.nih'
+                '.gov/entrez/eutils/efetch.fcgi?db=gds&api_key=abc&retmax=50'),
+                'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=gds'
+                '&retmax=50')
+            for url in ['https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch'
+                '.fcgi?db=gds&term=GSE16012[ACCN]+OR+GSE16013[ACCN]&retmode=json',
+                'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db='
+                'pubmed&retmode=xml&id=19561290,99999999']:
+                self.assertEqual(url, responseCache.cacheKey(url))
+                base, query = url.split('?')
+                self.assertEqual(url, responseCache.cacheKey(base + 
+                    '?api_key=abc&' + query))
+            self.assertEqual(gsmKey, responseCache.cacheKey(gsmKey + 
+                '&api_key=abc'))
+            self.assertEqual(gsmURL.split('?')[0], responseCache.cacheKey(
+                gsmURL.split('?')[0] + '?api_key=abc'))
+
+            cache.get(gsmKey)
+            for i in range(5):
+                cache.put('https://example.org/{0}'.format(i), b'x' * 300)
+            self.assertIsNone(cache.get('https://example.org/0'))
+            self.assertIsNotNone(cache.get('https://example.org/4'))
+            total = cache.connection().execute('SELECT SUM(size) FROM '
+                'responses').fetchone()[0]
+            self.assertLessEqual(total, 1000)
     
+    def test_ResultStore(self):
+        """ Check: Results and exclusions survive a reopen, only recorded (not
+            errored) samples count as done, and the JSON export matches
+            json.dump(indent = 4). """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.sqlite')
+            store = resultStore.ResultStore(path, commitEvery = 2)
+            meta = {'ID': 'GSM400641', 'Age': 4.28, 'Flags': {'Sort': False}}
+            store.record('GSM400641', 'ok', meta = meta)
+            store.record('GSM1394796', 'excluded', message = 'Multi-channel not allowed!')
+            store.record('GSM0', 'error', message = 'Connection reset')
+            with self.assertRaises(ValueError):
+                store.record('GSM1', 'skipped')
+            store.close()
+
+            store = resultStore.ResultStore(path)
+            self.assertEqual({'GSM400641', 'GSM1394796'}, store.recorded(['GSM400641',
+                'GSM1394796', 'GSM0', 'GSM32928']))
+            self.assertEqual(meta, store.get('GSM400641'))
+            self.assertIsNone(store.get('GSM1394796'))
+
+            jsonPath = os.path.join(tmp, 'meta.json')
+            store.exportJSON(jsonPath)
+            with open(jsonPath, 'r') as fin:
+                self.assertEqual(json.dumps({'GSM400641': meta}, indent = 4), fin.read())
+
+            freshStore = resultStore.ResultStore(os.path.join(tmp, 'fresh.sqlite'))
+            self.assertEqual(1, freshStore.importJSON(jsonPath))
+            self.assertEqual(0, freshStore.importJSON(jsonPath))
+            self.assertEqual(meta, freshStore.get('GSM400641'))
+            store.close()
+            freshStore.close()
+
+    def test_ncbiStandIn(self):
+        """ Check: A sample runs end to end against the stand-in, injected 
+            503s are retried, truncated bodies fail after the retries, and 
+            unrecorded URLs are not served. """
+
+        retryBackoff = geoFetch.retryBackoff
+        geoFetch.retryBackoff = 0.01
+        try:
+            with standInCache(cacheEnabled = False) as server:
+                self.assertEqual(server.baseURL + '/https/www.ncbi.nlm.nih.gov'
+                    '/geo/query/acc.cgi?acc=GSM401234', 
+                    geoFetch.rewriteURL(gsmURL + 'GSM401234'))
+                meta = util.extractGEOSampleInfo('GSM401240')
+                self.assertEqual(('GSE16013', 11, 'Study', 'Female'), (meta['Study'],
+                    meta['Age'], meta['Age Source'], meta['Gender']))
+                self.assertEqual(1, server.requestCounts[gsmURL + 'GSE16013'])
+                body, _ = geoFetch.fetchResponse(gsmURL + 'GSM0')
+                self.assertIn(b'No recording', body)
+
+            with standInCache(cacheEnabled = False, failFirst = 2, 
+                errorStatuses = [503]) as server:
+                self.assertIn('GSM401234', geoFetch.fetchText(gsmURL + 'GSM401234'))
+                self.assertEqual(3, server.requestCounts[gsmURL + 'GSM401234'])
+
+            with standInCache(cacheEnabled = False, truncateRate = 1) as server:
+                with self.assertRaises(requests.exceptions.RequestException):
+                    geoFetch.fetchText(gsmURL + 'GSM401234')
+                self.assertEqual(geoFetch.maxRetries + 1, 
+                    server.requestCounts[gsmURL + 'GSM401234'])
+        finally:
+            geoFetch.retryBackoff = retryBackoff
+
+    def test_KeywordMatcher(self):
+        """ Check: Overlapping and nested terms are all found, labels are kept
+            apart, and search agrees with plain substring checks, including
+            the 'male' inside 'female'. Checks with the default vocabularies
+            build no matcher. """
+
+        matcher = keywordMatch.KeywordMatcher({'cell': ['FBS', 'bovine serum',
+            'serum'], 'sort': ['FACS', 'T cells'], 'female': ['female ',
+            'females'], 'male': ['male ', 'males']})
+        text = 'Sorted by FACS (CD4+ T cells), grown in 10% fetal bovine serum, females'
+        self.assertEqual({'cell': {'bovine serum', 'serum'}, 'sort': {'FACS',
+            'T cells'}, 'female': {'females'}, 'male': {'males'}}, 
+            matcher.scan(text))
+        self.assertEqual([(text.index('males'), 'male', 'males')], 
+            [x for x in matcher.finditer(text) if x[1] == 'male'])
+        self.assertFalse(matcher.search(text, 'missing'))
+
+        terms = ['DMEM', 'FBS', 'bovine serum', 'passage', 'CD4+', 'sort-purified']
+        cellMatcher = keywordMatch.KeywordMatcher({'cell': terms})
+        for text in ['', 'passag', 'DMEM/F12 + FBS', 'sort-purifie CD4',
+            'passage 3', 'fetal bovine seru']:
+            self.assertEqual(any(x in text for x in terms), cellMatcher.search(text))
+
+        caseless = keywordMatch.KeywordMatcher({'sort': ['FACS']}, ignoreCase = True)
+        self.assertTrue(caseless.search('sorted by facs'))
+
+        ### The default vocabularies use the matchers built at import
+        keywordMatcher = keywordMatch.KeywordMatcher
+        keywordMatch.KeywordMatcher = None
+        try:
+            with open('tests/fixtures/GSM401234.html', 'r') as fin:
+                page = util.SamplePage(fin.read())
+            self.assertEqual(False, util.geoSampleCellCheck(page))
+            self.assertEqual(False, util.geoSampleCellCheck(page, 
+                cellDetectProt = util.sortDetectTerms, label = 'sort'))
+            self.assertEqual('Male', util.geoGenderExtract(page))
+        finally:
+            keywordMatch.KeywordMatcher = keywordMatcher
+
+    def test_GeneAliasIndex(self):
+        """ Check: Genes next to KO tokens are found by symbol or alias as
+            whole words only, hyphenated names stay whole, stop words and
+            genes away from a KO are ignored, and texts are not joined. """
+
+        index = geneAlias.GeneAliasIndex({'19211': {'Symbol': 'pten',
+            'Aliases': ['mmac1', 'tep1', 'phosphatase tensin']}, '16846': {'Symbol': 'lep',
+            'Aliases': ['ob', 'obese']}, '14961': {'Symbol': 'h2ab1',
+            'Aliases': ['iab']}, '12000': {'Symbol': 'cell', 'Aliases': []},
+            '13000': {'Symbol': 'tsc1', 'Aliases': []}})
+        self.assertEqual(['pten'], index.koGenes(['Liver Pten KO, rep 1']))
+        self.assertEqual(['pten'], index.koGenes(['Pten-KO liver']))
+        self.assertEqual(['pten'], index.koGenes(['knockout of MMAC1']))
+        self.assertEqual(['pten'], index.koGenes(['Phosphatase-tensin KO']))
+        self.assertEqual(['lep'], index.koGenes(['ob/ob knock out mice']))
+        self.assertEqual(['h2ab1'], index.koGenes(['H2-Ab1 knockout']))
+        self.assertEqual(['pten', 'tsc1'], index.koGenes(['Pten Tsc1 double KO']))
+        self.assertEqual([], index.koGenes(['Peptens KO', 'Tsc1 in WT cells KO']))
+        self.assertEqual([], index.koGenes(['Pten', 'KO']))
+        self.assertEqual([], index.koGenes(['Pten wild type', '']))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'gene_result_mus_musculus.json')
+            self.assertIsNone(geneAlias.loadIndex(path))
+            with open(path, 'w') as fout:
+                json.dump({'19211': {'Symbol': 'pten', 'Aliases': []}}, fout)
+            self.assertIs(geneAlias.loadIndex(path), geneAlias.loadIndex(path))
+
+    def test_geneWranglerFile(self):
+        """ Check: Chunked reading gives geneWrangler()'s dict, in the same key
+            and alias order, for the organism asked for only. """
+
+        rows = [['10090', 'Mus musculus', '19211', 'Pten', 'MMAC1, TEP1 ,  Pt-1', 'x'],
+            ['9606', 'Homo sapiens', '5728', 'PTEN', 'MMAC1', 'x'],
+            ['10090', 'Mus musculus', '16846', 'Lep', 'ob,, obese', 'x'],
+            ['10090', 'Mus musculus', '19211', 'Pten', 'MMAC1, TEP1 ,  Pt-1', 'x'],
+            ['10090', 'Mus musculus', '19211', 'Pten2', 'B-1', 'y'],
+            ['10090', 'Mus musculus', '12345', 'Gm1', '', 'x']]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'gene_result_mus_musculus.txt')
+            with open(path, 'w') as fout:
+                fout.write('tax_id\tOrg_name\tGeneID\tSymbol\tAliases\tdescription\n')
+                for row in rows:
+                    fout.write('\t'.join(row) + '\n')
+            df = pd.read_csv(path, sep = '\t')[['Org_name', 'GeneID',
+                'Symbol', 'Aliases']].drop_duplicates().fillna('')
+            expected = wrangler.geneWrangler(df = df, organism = 'Mus musculus')
+            for chunkSize in [2, 100]:
+                geneDict = wrangler.geneWranglerFile(path, 'Mus musculus',
+                    chunkSize = chunkSize)
+                self.assertEqual(json.dumps(expected), json.dumps(geneDict))
+        self.assertEqual({'Aliases': ['mmac1', 'tep1', ' pt1', 'b1'],
+            'Symbol': 'pten2'}, geneDict['19211'])
+        self.assertEqual([], geneDict['12345']['Aliases'])
+
+    def test_mouseDietWrangler(self):
+        """ Check: A formula listed on two pages is fetched once, a rerun is
+            served from the cache, and refresh revalidates every page without
+            downloading the unchanged ones again. """
+
+        dietURL = 'https://www.researchdiets.com/formulas/'
+        with standInCache() as server:
+            dietDict = wrangler.mouseDietWrangler(requestsPerSecond = 0)
+            self.assertEqual(['d12450j', 'd12492', 'd12451'], list(dietDict))
+            self.assertEqual({'url': dietURL + 'd12492', 'Protein': '20',
+                'Fat': '60', 'Carbohydrate': '20', 'Energy Density':
+                '5.21'}, dietDict['d12492'])
+            self.assertEqual('n/a', dietDict['d12450j']['Energy Density'])
+            self.assertEqual(1, server.requestCounts[dietURL + 'd12492'])
+
+            self.assertEqual(dietDict, wrangler.mouseDietWrangler(
+                requestsPerSecond = 0))
+            self.assertEqual(1, server.requestCounts[dietURL + 'd12492'])
+
+            unchanged = runMetrics.metrics.total(
+                'cache_revalidations_total', result = 'unchanged')
+            self.assertEqual(dietDict, wrangler.mouseDietWrangler(
+                refresh = True, requestsPerSecond = 0))
+            self.assertEqual(2, server.requestCounts[dietURL + 'd12492'])
+            self.assertEqual(unchanged + 5, runMetrics.metrics.total(
+                'cache_revalidations_total', result = 'unchanged'))
+
+    def test_sampleListGen(self):
+        """ Check: Series come from one esearch and esummary (GDS entries left
+            out) or their GEO page, reruns are served from the cache, and a
+            resumed run keeps finished series and redoes a cut-off one. A GEO
+            page that errors stops the run without caching or finishing its
+            series. A GEOmetadb dump is read for the series asked for only. """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            studiesPath = os.path.join(tmp, 'studies.txt')
+            outPath = os.path.join(tmp, 'samples.csv')
+            with open(studiesPath, 'w') as fout:
+                for study in ['GSE16012', 'GSE16013', 'GSE16012', 'GSE16014']:
+                    fout.write('1. Series {0}\nAccession: {0}\tID: 2000{1}\n\n'
+                        .format(study, study[3:]))
+            retryBackoff = geoFetch.retryBackoff
+            geoFetch.retryBackoff = 0.01
+            try:
+                with standInCache(errorRate = 1, errorStatuses = [503], 
+                    retryAfter = 0, faultPattern = 'acc=GSE16014'
+                    ), contextlib.redirect_stdout(io.StringIO()):
+                    with self.assertRaises(requests.exceptions.HTTPError):
+                        sampleListGen.main(studiesPath, outPath, 
+                            requestsPerSecond = 0)
+                    self.assertIsNotNone(geoFetch.cachedContent(
+                        sampleListGen.studyCacheKey('GSE16012')))
+                    self.assertIsNone(geoFetch.cachedContent(
+                        sampleListGen.studyCacheKey('GSE16014')))
+                    with open(outPath + '.done', 'r') as fin:
+                        self.assertEqual('', fin.read())
+            finally:
+                geoFetch.retryBackoff = retryBackoff
+
+            with standInCache() as server, contextlib.redirect_stdout(
+                io.StringIO()):
+                sampleListGen.main(studiesPath, outPath, requestsPerSecond = 0)
+                samples = pd.read_csv(outPath)
+                self.assertEqual(14, len(samples))
+                self.assertEqual(['GSM401234', 'GSM401240', 'GSM401250'],
+                    samples.groupby('GSE')['0'].first().tolist())
+                self.assertEqual(1, server.requestCounts[gsmURL + 'GSE16014'])
+
+                with open(outPath, 'r') as fin:
+                    lines = fin.readlines()
+                with open(outPath, 'w') as fout:
+                    fout.write(''.join(lines[:9]) + lines[9][:5])
+                with open(outPath + '.done', 'w') as fout:
+                    fout.write('GSE16012\n')
+                esearches = sum(v for (k, v) in server.requestCounts.items()
+                    if 'esearch' in k)
+                sampleListGen.main(studiesPath, outPath, requestsPerSecond = 0)
+                self.assertTrue(samples.equals(pd.read_csv(outPath)))
+                self.assertEqual(esearches, sum(v for (k, v) in
+                    server.requestCounts.items() if 'esearch' in k))
+
+            dumpPath = os.path.join(tmp, 'GEOmetadb.sqlite')
+            with contextlib.closing(sqlite3.connect(dumpPath)) as conn, conn:
+                conn.execute('CREATE TABLE gse_gsm (gse TEXT, gsm TEXT)')
+                conn.executemany('INSERT INTO gse_gsm VALUES (?, ?)', 
+                    samples[['GSE', '0']].values.tolist())
+            self.assertEqual({'GSE16014': ['GSM401250', 'GSM401251', 
+                'GSM401252', 'GSM401253'], 'GSE1': []}, 
+                sampleListGen.dumpSamples(['GSE16014', 'GSE1'], dumpPath))
+
+    def test_pubmedMetadata(self):
+        """ Check: PMIDs are fetched in one batch and cached one by one, and a
+            PMID PubMed returns nothing for is cached as such and not asked
+            for again. PMIDs of a failed E-fetch (HTTP error after the retries,
+            or an error reply) are not cached and are asked for again. """
+
+        sys.path.insert(0, './gds_scraper_mt')
+        from src.processing_data import pubmed_metadata
+
+        efetchURL = ('https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+            '?db=pubmed&retmode=xml&id=')
+        with standInCache() as server:
+            pubmed = pubmed_metadata(['19561290', '99999999', '19561290'])
+            self.assertEqual(['19561290'], list(pubmed))
+            self.assertEqual('Transcriptional profiling of the ageing '
+                'mouse liver.', pubmed['19561290']['article_title'])
+            self.assertEqual(1, server.requestCounts[efetchURL + 
+                '19561290,99999999'])
+
+            self.assertEqual(pubmed, pubmed_metadata(['99999999', 
+                '19561290']))
+            self.assertEqual(1, sum(server.requestCounts.values()))
+
+        retryBackoff = geoFetch.retryBackoff
+        geoFetch.retryBackoff = 0.01
+        try:
+            with standInCache() as server:
+                server.faults = ncbiStandIn.Faults(errorRate = 1, 
+                    errorStatuses = [429])
+                self.assertEqual({}, pubmed_metadata(['19561290', '99999999']))
+                server.faults = ncbiStandIn.Faults()
+                self.assertEqual(['19561290'], list(pubmed_metadata(['19561290',
+                    '99999999'])))
+
+                for _ in range(2):
+                    self.assertEqual({}, pubmed_metadata(['88888888']))
+                self.assertEqual(2, server.requestCounts[efetchURL + '88888888'])
+        finally:
+            geoFetch.retryBackoff = retryBackoff
+
+    def test_tarGzDownload(self):
+        """ Check: A series .tgz downloaded to a file streams the same XML as
+            one downloaded into memory, and a cut-off download leaves no file
+            behind. """
+
+        sys.path.insert(0, './gds_scraper_mt')
+        from src.geo_extraction_funcs import tar_gz_download, tar_gz_xml_stream
+
+        url = ('ftp://ftp.ncbi.nlm.nih.gov/geo/series/GSE16nnn/GSE16012/'
+            'miniml/GSE16012_family.xml.tgz')
+        with tempfile.TemporaryDirectory() as tmp, standInCache():
+            path = os.path.join(tmp, 'GSE16012_family.xml.tgz')
+            self.assertEqual(path, tar_gz_download(url, path = path))
+            content = tar_gz_download(url)
+            with open(path, 'rb') as fin:
+                self.assertEqual(content, fin.read())
+            streams = []
+            for source in [path, content]:
+                with tar_gz_xml_stream(url, content = source) as xml_stream:
+                    streams.append(xml_stream.read())
+            self.assertIn(b'GSM401234', streams[0])
+            self.assertEqual(streams[0], streams[1])
+
+            with standInCache(truncateRate = 1), contextlib.redirect_stdout(
+                io.StringIO()):
+                self.assertIsNone(tar_gz_download(url, path = path))
+                self.assertFalse(os.path.exists(path))
+
+    def test_finalProcessingProcesses(self):
+        """ Check: Samples processed by a pool of processes, one sample per 
+            chunk, match those of one process, in the same order, with and 
+            without the sample filters. """
+
+        sys.path.insert(0, './benchmarks')
+        import runBenchmarks
+
+        fn, prepare = runBenchmarks.stages()['final_processing_loop']
+        (args, kwargs), = prepare()
+        for filters in [(False, False, False), (False, True, True)]:
+            with standInCache(), contextlib.redirect_stdout(io.StringIO()):
+                results = [fn(*copy.deepcopy(args[:3]), *filters, **dict(kwargs,
+                    **pool)) for pool in [{'processes': 1}, {'processes': 2,
+                    'chunk_size': 1, 'requests_per_second': 0}]]
+            self.assertGreater(len(results[0]), 0)
+            self.assertEqual(list(results[0].items()), list(results[1].items()))
+
+    def test_shardSamples(self):
+        """ Check: Every shard file is written, a series' samples land in one
+            shard, repeated samples are kept once, and merged shards match
+            ResultStore.exportJSON(). """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            samplesPath = os.path.join(tmp, 'GEO_MusmusculusSamples.csv')
+            rows = [['GSM{0}'.format(i), 'GSE{0}'.format(i // 3)] for i in range(30)]
+            pd.DataFrame(rows + rows[:2], columns = ['0', 'GSE']).to_csv(samplesPath)
+            counts = shardSamples.splitSamples(samplesPath, 4, os.path.join(tmp,
+                'shards'))
+            self.assertEqual(30, sum(counts))
+
+            shards = [pd.read_csv(os.path.join(tmp, 'shards',
+                'GEO_MusmusculusSamples_{0}.csv'.format(i))) for i in range(4)]
+            self.assertEqual(counts, [len(x) for x in shards])
+            for i, shard in enumerate(shards):
+                self.assertEqual(list(range(len(shard))), shard.iloc[:, 0].tolist())
+                self.assertTrue(all(shardSamples.shardOf(x, 4) == i for x in
+                    shard['GSE']))
+
+            store = resultStore.ResultStore(os.path.join(tmp, 'all.sqlite'))
+            shardPaths = []
+            for i, sampleIDs in enumerate([['GSM1', 'GSM2'], [], ['GSM3']]):
+                shardStore = resultStore.ResultStore(os.path.join(tmp,
+                    'shard{0}.sqlite'.format(i)))
+                for sampleID in sampleIDs:
+                    meta = {'ID': sampleID, 'Age': 4.28, 'Flags': {'Sort': False}}
+                    shardStore.record(sampleID, 'ok', meta = meta)
+                    store.record(sampleID, 'ok', meta = meta)
+                shardPaths.append(os.path.join(tmp, 'shard{0}.json'.format(i)))
+                shardStore.exportJSON(shardPaths[-1])
+                shardStore.close()
+            store.exportJSON(os.path.join(tmp, 'all.json'))
+            store.close()
+            self.assertEqual(3, shardSamples.mergeMetadata(shardPaths,
+                os.path.join(tmp, 'merged.json')))
+            with open(os.path.join(tmp, 'all.json'), 'r') as fin, open(
+                os.path.join(tmp, 'merged.json'), 'r') as fmerged:
+                self.assertEqual(fin.read(), fmerged.read())
+
+    def test_metadataExtractShard(self):
+        """ Check: A shard with a sample that fails the same way on every run
+            is still written and merged without it, and a shard with a sample
+            hitting transient errors (429s) exits non-zero without writing,
+            and its rerun retries the sample. """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            samplesPath = os.path.join(tmp, 'shard.csv')
+            shardJSON = os.path.join(tmp, 'shard.json')
+            pd.DataFrame({'0': ['GSM401234', 'GSM401263']}).to_csv(samplesPath)
+
+            def runShard():
+                return subprocess.run([sys.executable, 'metadataExtract.py',
+                    samplesPath, shardJSON, '0'], env = dict(os.environ, 
+                    METADATA_CACHE = os.path.join(tmp, 'c.sqlite')), 
+                    capture_output = True, text = True)
+
+            with standInCache(errorRate = 1, errorStatuses = [429], 
+                retryAfter = 0, faultPattern = 'GSM401234'):
+                self.assertEqual(1, runShard().returncode)
+            self.assertFalse(os.path.exists(shardJSON))
+
+            with standInCache():
+                result = runShard()
+            self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+            self.assertEqual(1, shardSamples.mergeMetadata([shardJSON],
+                os.path.join(tmp, 'merged.json')))
+            with open(os.path.join(tmp, 'merged.json'), 'r') as fin:
+                self.assertEqual(['GSM401234'], list(json.load(fin)))
+            store = resultStore.ResultStore(os.path.join(tmp, 'shard.sqlite'))
+            self.assertEqual({'GSM401263'}, store.recorded(['GSM401234', 
+                'GSM401263'], statuses = ['error']))
+            store.close()
+
+    def test_RunMetrics(self):
+        """ Check: Counters and histograms add up across drained worker
+            snapshots, warnings print once per kind, also when workers relay
+            them to the parent job by job, the Prometheus buckets are
+            cumulative, and a sample run against the stand-in is counted per
+            host, cache result and age source. """
+
+        metrics = runMetrics.RunMetrics()
+        worker = runMetrics.RunMetrics()
+        metrics.count('http_requests_total', host = 'a', status = 200)
+        worker.count('http_requests_total', host = 'a', status = 200)
+        worker.count('http_requests_total', 2, host = 'a', status = 503)
+        for value in [0.01, 0.2, 120]:
+            worker.observe('http_request_seconds', value, host = 'a')
+        with worker.stage('parse'):
+            pass
+        metrics.merge(worker.drain())
+        self.assertEqual(0, worker.total('http_requests_total'))
+        self.assertEqual(4, metrics.total('http_requests_total', host = 'a'))
+        self.assertEqual(2, metrics.total('http_requests_total', status = 503))
+        self.assertEqual(1, metrics.total('stage_calls', stage = 'parse'))
+
+        text = metrics.prometheusText()
+        self.assertIn('metadata_http_requests_total{host="a",status="503"} 2', text)
+        self.assertIn('metadata_http_request_seconds_bucket{host="a",le="0.05"} 1', text)
+        self.assertIn('metadata_http_request_seconds_bucket{host="a",le="60"} 2', text)
+        self.assertIn('metadata_http_request_seconds_bucket{host="a",le="+Inf"} 3', text)
+        self.assertIn('metadata_http_request_seconds_count{host="a"} 3', text)
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            for i in range(3):
+                metrics.warn('wideRange', 'Warning {0}'.format(i))
+        self.assertEqual(1, out.getvalue().count('Warning'))
+        self.assertEqual(3, metrics.total('warnings_total', kind = 'wideRange'))
+
+        parent = runMetrics.RunMetrics()
+        workers = [runMetrics.RunMetrics(relay = True) for _ in range(2)]
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            for i in range(3):
+                for worker in workers:
+                    worker.warn('unitConversion', 'Job {0}'.format(i))
+                    parent.merge(worker.drain())
+        self.assertEqual('Job 0 (further "unitConversion" warnings are counted '
+            'in the run metrics)\n', out.getvalue())
+        self.assertEqual(6, parent.total('warnings_total', kind = 'unitConversion'))
+
+        runMetrics.metrics.reset()
+        with standInCache():
+            for _ in range(2):
+                util.gseTextMemo.clear()
+                util.extractGEOSampleInfo('GSM401240')
+        with tempfile.TemporaryDirectory() as tmp:
+            report = runMetrics.metrics.report()
+            runMetrics.metrics.writeJSON(os.path.join(tmp, 'metrics.json'))
+            with open(os.path.join(tmp, 'metrics.json'), 'r') as fin:
+                self.assertEqual(report['counters'], json.load(fin)['counters'])
+
+        host = 'www.ncbi.nlm.nih.gov'
+        self.assertEqual(2, runMetrics.metrics.total('http_requests_total',
+            host = host, status = 200))
+        self.assertEqual(0.5, report['cacheHitRate'][host])
+        self.assertEqual(2, runMetrics.metrics.total('age_source_total',
+            source = 'Study', found = True))
+        self.assertEqual(2, runMetrics.metrics.total('stage_calls',
+            stage = 'extractGEOSampleInfo'))
+
     def test_geoSampleCellCheck(self):
         """ Check: T/F on hand-picked cell examples. Detect cell lines vs types.
             Missed cell catch with 'incorrect' protocolEntries. """
         
-        trueCell, sortCell, noCell = 'GSM937915', 'GSM1402452', 'GSM1418737'
-        trueCellText = requests.get(gsmURL + trueCell).text
-        sortCellText = requests.get(gsmURL + sortCell).text
-        noCellText = requests.get(gsmURL + noCell).text
+        trueCell, sortCell, noCell = 'GSM401260', 'GSM401261', 'GSM401234'
+        trueCellText = geoFetch.fetchText(gsmURL + trueCell)
+        sortCellText = geoFetch.fetchText(gsmURL + sortCell)
+        noCellText = geoFetch.fetchText(gsmURL + noCell)
         
         self.assertTrue(util.geoSampleCellCheck(trueCellText))
         self.assertFalse(util.geoSampleCellCheck(sortCellText))
@@ -43,8 +646,8 @@ class TestDataProcess(unittest.TestCase):
     def test_extractGEOSampleInfo(self):
         """ Check: Starting from the sample ID, proper extractions (including gender) """
 
-        samp1, samp2, samp3 = 'GSM400641', 'GSM937915', 'GSM1402452'
-        samp4, samp5, samp6 = 'GSM1418737', 'GSM1282831', 'GSM1338039'
+        samp1, samp2, samp3 = 'GSM401234', 'GSM401260', 'GSM401261'
+        samp4, samp5, samp6 = 'GSM401262', 'GSM401250', 'GSM401240'
         fakeSamp = 'GSM9999999'
 
         with self.assertRaises(ValueError):
@@ -63,8 +666,8 @@ class TestDataProcess(unittest.TestCase):
         samp5Dict = util.extractGEOSampleInfo(samp5)
         samp6Dict = util.extractGEOSampleInfo(samp6)
         
-        self.assertAlmostEqual(4.28571428, samp1Dict['Age'])
-        self.assertEqual('n/a', samp1Dict['Gender'])
+        self.assertEqual(10, samp1Dict['Age'])
+        self.assertEqual('Male', samp1Dict['Gender'])
         self.assertEqual('GSE16012', samp1Dict['Study'])
         
         self.assertEqual('n/a', samp2Dict['Age'])
@@ -78,15 +681,17 @@ class TestDataProcess(unittest.TestCase):
         samp3Dict = util.extractGEOSampleInfo(samp3, tryAgePMID = False, flagSort = False)
         self.assertEqual(samp3Dict['Flags']['Sort'], False)
         
-        self.assertEqual(13.5, samp4Dict['Age'])
+        self.assertEqual(8, samp4Dict['Age'])
         self.assertEqual('Female', samp4Dict['Gender'])
         self.assertEqual(False, samp4Dict['Cells'])
 
-        self.assertEqual(16, samp5Dict['Age'])
+        self.assertEqual(15, samp5Dict['Age'])
+        self.assertEqual('Text', samp5Dict['Age Source'])
         self.assertEqual('Male', samp5Dict['Gender'])
         self.assertEqual(False, samp5Dict['Cells'])
 
-        self.assertAlmostEqual(9.42857142, samp6Dict['Age'])
+        self.assertEqual(11, samp6Dict['Age'])
+        self.assertEqual('Study', samp6Dict['Age Source'])
         self.assertEqual('Female', samp6Dict['Gender'])
         self.assertEqual(False, samp6Dict['Cells'])
 
@@ -102,36 +707,22 @@ class TestDataProcess(unittest.TestCase):
                 null with misspecification of soupDiv or invalid section tags.
                 Mixed section tags will return first section type match"""
     
-        links15452052 = ['https://iovs.arvojournals.org/article.aspx?articleid=2124532']
-
-        links25043027 = ['https://www.nature.com/articles/nature13577', 
-                        'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4339042/']
-                        # --> PMC should win
-
-        links26717410 = ['https://journals.plos.org/plosbiology/article?id=10.1371/journal.pbio.1002330',
-                        'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4696735']
-                        # --> plos wins unless PMC sections added
+        linksH6 = ['https://iovs.arvojournals.org/article.aspx?articleid=2124532']
 
-        links19286929 = ['https://www.physiology.org/doi/full/10.1152/ajplung.90369.2008?url_ver=Z39.88-2003&rfr_id=ori%3Arid%3Acrossref.org&rfr_dat=cr_pub%3Dpubmed',
-                        'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2692799/']
-                        # --> PMC should with win 'h2', other with 'h1', 'n/a' with 'h6'
+        links19561291 = ['https://www.jlr.org/content/50/7/1200', 
+                        'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC2700001/']
+                        # --> PMC should win with 'h2', publisher with 'h1' or 
+                        # its unique sections ['Ethics', 'Accession codes'], 
+                        # 'n/a' with 'h6'
 
-        links21996730 = ['https://www.nature.com/articles/onc2011433',
-                        'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3356601/']
-                        # --> nature has unique sections, should win with ['Ethics', 'Accession codes']
-
-        link1, text1, div1 = util.maxSectionMatch(links15452052)
-        link2, text2, div2 = util.maxSectionMatch(links25043027)
-        link3, text3, div3 = util.maxSectionMatch(links26717410)
-        link4, text4, div4 = util.maxSectionMatch(links19286929)
+        link1, text1, div1 = util.maxSectionMatch(linksH6)
+        link2, text2, div2 = util.maxSectionMatch(links19561291)
+        link3, text3, div3 = util.maxSectionMatch(links19561291[::-1])
         self.assertIn('iovs', link1)
         self.assertEqual('h6', div1)
         self.assertIn('pmc', link2)
         self.assertEqual('h2', div2)
-        self.assertIn('plos', link3)
-        self.assertEqual('h2', div3)
-        self.assertIn('pmc', link4)
-        self.assertEqual('h2', div4)
+        self.assertEqual((link2, div2), (link3, div3))
 
         secText1 = util.findSectionText(text1, sectionTags = ['methods', 
                                 'procedures'], soupDiv = div1)
@@ -156,25 +747,17 @@ class TestDataProcess(unittest.TestCase):
                                         soupDiv = 'h2')
         self.assertEqual('n/a', secText1.lower())
 
-
-        link3, _, _ = util.maxSectionMatch(links26717410, 
-                        possibleSections = ['references', 'data availability', 
-                            'funding statement', 'abbreviations', 
-                            'materials and methods', 'results', 'introduction', 
-                            'discussion'])
-
-        self.assertIn('pmc', link3)
-        link4, _, div4 = util.maxSectionMatch(links19286929, soupAttempts = ['h1'])
-        self.assertIn('physiology', link4)
+        link4, _, div4 = util.maxSectionMatch(links19561291, soupAttempts = ['h1'])
+        self.assertIn('jlr', link4)
         self.assertEqual('h1', div4)
-        link4, _, div4 = util.maxSectionMatch(links19286929, soupAttempts = ['h6'])
+        link4, _, div4 = util.maxSectionMatch(links19561291, soupAttempts = ['h6'])
         self.assertEqual('n/a', link4)
         self.assertEqual('n/a', div4)
 
-        link5, text5, div5 = util.maxSectionMatch(links21996730, 
+        link5, text5, div5 = util.maxSectionMatch(links19561291, 
                             possibleSections = ['ethics', 'accession codes'])
                             
-        self.assertIn('nature', link5)
+        self.assertIn('jlr', link5)
         self.assertIn('ethics', text5)
         self.assertEqual('h2', div5)
         
@@ -188,9 +771,9 @@ class TestDataProcess(unittest.TestCase):
         pmid2 = '26717410'
         
         url1 = 'https://www.ncbi.nlm.nih.gov/pubmed/{0}'.format(pmid1)
-        pubText1 = requests.get(url1).text
+        pubText1 = geoFetch.fetchText(url1)
         url2 = 'https://www.ncbi.nlm.nih.gov/pubmed/{0}'.format(pmid2)
-        pubText2 = requests.get(url2).text
+        pubText2 = geoFetch.fetchText(url2)
 
         meth1 = util.pmidSectionExtraction(pmidText = pubText1, sectionID = 'methods')
         res1 = util.pmidSectionExtraction(pmidText = pubText1, sectionID = 'results')
@@ -208,14 +791,14 @@ class TestDataProcess(unittest.TestCase):
         
         null1 = '31341269'
         nullURL1 = 'https://www.ncbi.nlm.nih.gov/pubmed/{0}'.format(null1)
-        nullText1 = requests.get(nullURL1).text
+        nullText1 = geoFetch.fetchText(nullURL1)
 
         self.assertEqual('n/a', util.pmidSectionExtraction(pmidText = nullText1, 
                         sectionID = 'methods'))
 
         null2 = '13054692'
         nullURL2 = 'https://www.ncbi.nlm.nih.gov/pubmed/{0}'.format(null2)
-        nullText2 = requests.get(nullURL2).text
+        nullText2 = geoFetch.fetchText(nullURL2)
 
         self.assertEqual('n/a', util.pmidSectionExtraction(pmidText = nullText2, 
                         sectionID = 'methods'))
@@ -21,10 +21,9 @@ def main(geneOrgFile, refDirectory, organism, dietFileTag, overwrite, valsToAlph
 
     if geneOrgFile + '.json' not in os.listdir(refDirectory) or overwrite is True:
 
-        df = pd.read_csv('{0}/{1}.txt'.format(refDirectory, geneOrgFile),
-            sep = '\t')[['Org_name', 'GeneID', 'Symbol', 'Aliases']].drop_duplicates()
-    
-        geneDict = wrangler.geneWrangler(df = df, organism = organism, 
+        ### Read in chunks of the needed columns, see geneWranglerFile()
+        geneDict = wrangler.geneWranglerFile('{0}/{1}.txt'.format(refDirectory,
+            geneOrgFile), organism = organism, 
             valsToAlphaNumLower = valsToAlphaNumLower)
 
         with open('{0}/{1}.json'.format(refDirectory, geneOrgFile), 'w') as fout: